@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+キャプチャ方式ごとのCPU時間と最大RSSを比較する
+PulseAudioの代わりにWAVファイルを実時間のペースで読み込ませ、
+  ffmpeg        : ffmpegがソースを直接読んでエンコード（capture_engine=ffmpeg相当）
+  pipeline      : CapturePipeline + libsndfileでプロセス内エンコード（capture_engine=pyaudio相当）
+  pipeline+pipe : CapturePipeline + ffmpegの標準入力でエンコード
+を同じ長さだけ録音する。CPU時間は子プロセスを含めて os.wait4 で取得し、
+RSSはプロセスツリーの合計を psutil で定期的に計測して最大値を取る
+（ru_maxrss はfork元の値を引き継ぐため使わない）。
+
+使い方: python3 bench/bench_capture_engines.py [--wav 入力.wav] [--seconds 30]
+"""
+
+import argparse
+import math
+import os
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+
+import psutil
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import recorder_capture
+from recorder_capture import CapturePipeline, PipeEncoder, SoundFileEncoder, WavFileSource
+
+ENCODER_ARGS = ['-acodec', 'libvorbis', '-ab', '128k']
+
+
+def make_reference_wav(path, seconds, rate=44100):
+    """会話を模した合成音声（振幅変調したノイズと無音区間）を作る"""
+    rng = random.Random(0)
+    frames = bytearray()
+    for i in range(int(seconds * rate)):
+        t = i / rate
+        talking = math.sin(2 * math.pi * 0.2 * t) > -0.3
+        envelope = 0.5 + 0.5 * math.sin(2 * math.pi * 4 * t)
+        sample = rng.uniform(-1, 1) * envelope * 8000 if talking else rng.uniform(-1, 1) * 30
+        frames += struct.pack('<h', int(sample))
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(bytes(frames))
+
+
+def run_pipeline(wav_path, out_path, encoder_kind):
+    """子プロセスとして実行: WAVをソースにしたパイプラインで録音する"""
+    source = WavFileSource(wav_path)
+    done = []
+
+    def factory(name, rate, channels):
+        if done:
+            return _EmptySource()
+        done.append(True)
+        return source
+
+    pipeline = CapturePipeline(lambda: wav_path, source.rate, source.channels, source_factory=factory)
+    if encoder_kind == 'soundfile':
+        encoder = SoundFileEncoder(out_path, source.rate, source.channels)
+    else:
+        encoder = PipeEncoder(out_path, source.rate, source.channels, ENCODER_ARGS)
+    pipeline.attach(encoder)
+    pipeline.start()
+    while not done or pipeline.is_capturing():
+        time.sleep(0.1)
+    pipeline.detach()
+    pipeline.stop()
+    encoder.close()
+    print(pipeline.stats(), file=sys.stderr)
+
+
+class _EmptySource:
+    overruns = 0
+
+    def read_into(self, buffer):
+        time.sleep(0.1)
+        return 0
+
+    def interrupt(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def sample_peak_rss(pid, result, interval=0.05):
+    """プロセスツリーのRSS合計の最大値を result[0] に記録する"""
+    try:
+        root = psutil.Process(pid)
+        while root.is_running() and root.status() != psutil.STATUS_ZOMBIE:
+            rss = 0
+            for proc in [root] + root.children(recursive=True):
+                try:
+                    rss += proc.memory_info().rss
+                except psutil.Error:
+                    pass
+            result[0] = max(result[0], rss)
+            time.sleep(interval)
+    except psutil.Error:
+        pass
+
+
+def measure(cmd):
+    """コマンドを実行し、(経過秒, CPU秒, 最大RSS MB) を返す"""
+    started = time.monotonic()
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    peak = [0]
+    sampler = threading.Thread(target=sample_peak_rss, args=(proc.pid, peak), daemon=True)
+    sampler.start()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    sampler.join()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.monotonic() - started
+    if proc.returncode:
+        raise RuntimeError(f"{cmd[0]} が失敗しました: {proc.returncode}")
+    return elapsed, rusage.ru_utime + rusage.ru_stime, peak[0] / (1024 * 1024)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="キャプチャ方式のCPU/RSS比較")
+    parser.add_argument('--wav', help='入力WAV（16bit PCM）。省略時は合成音声を生成')
+    parser.add_argument('--seconds', type=float, default=30, help='合成音声の長さ')
+    parser.add_argument('--run-pipeline', nargs=3, metavar=('WAV', 'OUT', 'ENCODER'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_pipeline:
+        run_pipeline(*args.run_pipeline)
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        wav_path = args.wav
+        if not wav_path:
+            wav_path = os.path.join(workdir, 'reference.wav')
+            make_reference_wav(wav_path, args.seconds)
+
+        modes = [
+            ('ffmpeg', ['ffmpeg', '-loglevel', 'error', '-re', '-i', wav_path, *ENCODER_ARGS,
+                        '-y', os.path.join(workdir, 'ffmpeg.ogg')]),
+            ('pipeline+pipe', [sys.executable, __file__, '--run-pipeline', wav_path,
+                               os.path.join(workdir, 'pipe.ogg'), 'pipe']),
+        ]
+        if recorder_capture.soundfile is not None:
+            modes.insert(1, ('pipeline', [sys.executable, __file__, '--run-pipeline', wav_path,
+                                          os.path.join(workdir, 'soundfile.ogg'), 'soundfile']))
+
+        print(f"{'mode':<16}{'wall s':>8}{'cpu s':>8}{'cpu %':>8}{'max RSS MB':>12}")
+        for name, cmd in modes:
+            elapsed, cpu, rss = measure(cmd)
+            print(f"{name:<16}{elapsed:8.1f}{cpu:8.2f}{cpu / elapsed * 100:8.1f}{rss:12.1f}")
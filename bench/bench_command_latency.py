@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+コマンド送信からワーカー受理（ack）までの遅延を計測する
+旧方式（recorder_command.jsonを0.5秒周期でポーリング）と
+コマンドバス（Unixドメインソケット）を同じ条件で比較する。
+
+使い方: python3 bench/bench_command_latency.py [-n 回数]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recorder_ipc import CommandClient, CommandServer
+
+POLL_INTERVAL = 0.5
+
+
+def bench_file_polling(workdir, count):
+    """旧方式: ファイルに書き込み、ワーカーのポーリングで削除されるまでの時間"""
+    command_file = os.path.join(workdir, 'recorder_command.json')
+    running = True
+
+    def worker_loop():
+        while running:
+            if os.path.exists(command_file):
+                with open(command_file) as f:
+                    json.load(f)
+                os.remove(command_file)
+            time.sleep(POLL_INTERVAL)
+
+    thread = threading.Thread(target=worker_loop, daemon=True)
+    thread.start()
+
+    samples = []
+    for i in range(count):
+        # 送信タイミングがワーカーの周期と同期しないようにずらす
+        time.sleep((i * 0.137) % POLL_INTERVAL)
+        sent_at = time.monotonic()
+        with open(command_file, 'w') as f:
+            json.dump({'action': 'ping'}, f)
+        while os.path.exists(command_file):
+            time.sleep(0.001)
+        samples.append(time.monotonic() - sent_at)
+
+    running = False
+    return samples
+
+
+def bench_command_bus(workdir, count):
+    """新方式: ソケットで送信し、ack/replyが返るまでの時間"""
+    path = os.path.join(workdir, 'recorder_command.sock')
+    server = CommandServer(lambda command: (True, 'pong'), path=path)
+    server.start()
+    running = True
+
+    def worker_loop():
+        while running:
+            server.dispatch(timeout=POLL_INTERVAL)
+
+    thread = threading.Thread(target=worker_loop, daemon=True)
+    thread.start()
+
+    client = CommandClient(path=path)
+    acks, replies = [], []
+    for i in range(count):
+        time.sleep((i * 0.137) % POLL_INTERVAL)
+        reply = client.send({'action': 'ping'})
+        acks.append(reply['ack_latency'])
+        replies.append(reply['reply_latency'])
+
+    running = False
+    client.close()
+    server.close()
+    return acks, replies
+
+
+def report(label, samples):
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"{label:<24} median {statistics.median(samples) * 1000:8.2f} ms   "
+          f"p95 {p95 * 1000:8.2f} ms   max {samples[-1] * 1000:8.2f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="コマンド遅延ベンチマーク")
+    parser.add_argument('-n', '--count', type=int, default=20, help='計測回数')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        report('file polling (ack)', bench_file_polling(workdir, args.count))
+        acks, replies = bench_command_bus(workdir, args.count)
+        report('command bus (ack)', acks)
+        report('command bus (reply)', replies)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+/download/<filename> のスループットと再開ダウンロードを計測する
+一時ディレクトリに大きな録音ファイルを作り、RECORDINGS_DIRをそこに向けた
+recorder_web をHTTP/1.1でローカルに起動して、
+  full    : ファイル全体の取得
+  resume  : 途中（半分）からの Range 取得（If-Range に ETag を付ける）
+  stale   : 古い ETag での If-Range（全体が返ることを確認）
+をそれぞれ計測する。
+
+使い方: python3 bench/bench_download.py [--size-mb 100] [-n 3]
+"""
+
+import argparse
+import http.client
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import recorder_web
+
+READ_SIZE = 1024 * 1024
+
+
+def fetch(port, path, headers=None):
+    """GETして (ステータス, ヘッダー, 受信バイト数, 秒) を返す"""
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    started = time.perf_counter()
+    conn.request('GET', path, headers=headers or {})
+    response = conn.getresponse()
+    received = 0
+    while True:
+        data = response.read(READ_SIZE)
+        if not data:
+            break
+        received += len(data)
+    elapsed = time.perf_counter() - started
+    conn.close()
+    return response.status, dict(response.getheaders()), received, elapsed
+
+
+def report(name, results, size):
+    """計測結果を表示する"""
+    seconds = [r[3] for r in results]
+    median = statistics.median(seconds)
+    print(f"{name:<8} status={results[0][0]} bytes={results[0][2]:>10} "
+          f"median={median * 1000:8.1f}ms  {size / median / 1024 / 1024:8.1f} MB/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="ダウンロードのスループット計測")
+    parser.add_argument('--size-mb', type=int, default=100, help='テストファイルの大きさ（MB）')
+    parser.add_argument('-n', type=int, default=3, help='繰り返し回数')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        filename = 'recording_bench.ogg'
+        size = args.size_mb * 1024 * 1024
+        with open(os.path.join(workdir, filename), 'wb') as f:
+            block = os.urandom(READ_SIZE)
+            for _ in range(args.size_mb):
+                f.write(block)
+
+        recorder_web.RECORDINGS_DIR = workdir
+        WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+        server = make_server('127.0.0.1', 0, recorder_web.app, threaded=True)
+        port = server.server_port
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        path = f'/download/{filename}'
+        full = [fetch(port, path) for _ in range(args.n)]
+        etag = full[0][1]['ETag']
+        half = size // 2
+        resume = [fetch(port, path, {'Range': f'bytes={half}-', 'If-Range': etag}) for _ in range(args.n)]
+        stale = [fetch(port, path, {'Range': f'bytes={half}-', 'If-Range': '"stale"'}) for _ in range(args.n)]
+        server.shutdown()
+
+        print(f"file: {args.size_mb} MB, ETag: {etag}, Accept-Ranges: {full[0][1].get('Accept-Ranges')}")
+        report('full', full, size)
+        report('resume', resume, size - half)
+        print(f"         Content-Range: {resume[0][1].get('Content-Range')}")
+        report('stale', stale, size)
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+利用者が感じる遅延（エンドツーエンド）を計測する
+一時ディレクトリにアプリをコピーし、pactl・parec・bluetoothctl・hciconfig・ffmpeg を
+偽物の実行ファイル（遅延とデバイス数を設定できる）に差し替えて、recorder_web.py と
+recorder_worker.py を実際のプロセスとして動かす。
+
+  /get_devices        : ペアリング済みデバイス数ごとの応答時間と、1回あたりの外部コマンド呼び出し数
+  /get_status, /get_files : 応答時間
+  command             : コマンドバス（ping）の受理（ack）・応答までの時間
+  start (HTTP)        : 録音開始APIの応答時間
+  start -> captured   : 録音開始APIを呼んでから録音ファイルに最初のデータが書かれるまで
+  stop (HTTP)         : 録音停止APIの応答時間
+  stop -> finalised   : 録音停止APIを呼んでからワーカーが録音を確定（recording=false）するまで
+
+BlueZのD-Bus APIは使わず（DBUS_SYSTEM_BUS_ADDRESSを無効にする）、bluetoothctlでの
+一覧取得の費用を計る。--dbus を付けると実機のD-Busをそのまま使う。
+ワーカーは pyaudio をimportするため、実行にはPyAudioが必要。
+
+使い方: python3 bench/bench_latency.py [--devices 1,5,10,20] [-n 20] [--cycles 5]
+        [--bluetoothctl-delay 0.15] [--pactl-delay 0.05] [--ffmpeg-startup 0.3] ...
+"""
+
+import argparse
+import glob
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from recorder_ipc import CommandClient
+
+# 偽の実行ファイルの共通部分（設定は呼ばれるたびに bench.json から読む）
+FAKE_HEADER = """#!{python}
+import json, os, sys, time
+with open({config!r}) as f:
+    CONFIG = json.load(f)
+with open(CONFIG['call_log'], 'a') as f:
+    f.write(os.path.basename(sys.argv[0]) + '\\n')
+DEVICES = [('02:00:00:00:%02X:%02X' % (i // 256, i % 256), 'Bench Device %d' % i)
+           for i in range(CONFIG['devices'])]
+ADAPTERS = ['00:00:00:00:01:%02X' % i for i in range(CONFIG['adapters'])]
+"""
+
+FAKE_HCICONFIG = """
+time.sleep(CONFIG['delays']['hciconfig'])
+for number, address in enumerate(ADAPTERS):
+    print('hci%d:\\tType: Primary  Bus: UART' % number)
+    print('\\tBD Address: %s  ACL MTU: 1021:8  SCO MTU: 64:1' % address)
+    print('\\tUP RUNNING\\n')
+"""
+
+FAKE_BLUETOOTHCTL = """
+time.sleep(CONFIG['delays']['bluetoothctl'])
+lines = [' '.join(sys.argv[1:])] if len(sys.argv) > 1 else sys.stdin.read().splitlines()
+adapter = None
+for line in lines:
+    words = line.split()
+    if not words:
+        continue
+    if words[0] == 'select':
+        adapter = words[1]
+    elif words[0] == 'list':
+        for number, address in enumerate(ADAPTERS):
+            print('Controller %s bench-hci%d [default]' % (address, number))
+    elif words[0] == 'devices':
+        for index, (mac, name) in enumerate(DEVICES):
+            if adapter is None or ADAPTERS[index % len(ADAPTERS)] == adapter:
+                print('Device %s %s' % (mac, name))
+    elif words[0] == 'info':
+        for mac, name in DEVICES:
+            if mac == words[1]:
+                print('Device %s (public)\\n\\tName: %s\\n\\tPaired: yes\\n\\tTrusted: yes\\n\\tConnected: yes'
+                      % (mac, name))
+    elif words[0] == 'connect':
+        print('Connection successful')
+"""
+
+FAKE_PACTL = """
+time.sleep(CONFIG['delays']['pactl'])
+if sys.argv[1:4] == ['list', 'sources', 'short']:
+    for index, (mac, _) in enumerate(DEVICES):
+        print('%d\\tbluez_source.%s.handsfree_head_unit\\tmodule-bluez5-device.c\\ts16le 1ch 16000Hz\\tRUNNING'
+              % (index, mac.replace(':', '_')))
+"""
+
+FAKE_PAREC = """
+rate, channels = 44100, 1
+for arg in sys.argv[1:]:
+    if arg.startswith('--rate='):
+        rate = int(arg[7:])
+    elif arg.startswith('--channels='):
+        channels = int(arg[11:])
+time.sleep(CONFIG['delays']['parec'])
+block = bytes(rate // 50 * 2 * channels)
+started = time.monotonic()
+sent = 0
+while True:
+    sys.stdout.buffer.write(block)
+    sys.stdout.buffer.flush()
+    sent += 1
+    time.sleep(max(0, started + sent / 50 - time.monotonic()))
+"""
+
+# 出力ファイルには1KBずつ書く（OGGではないがワーカーは中身を見ない）
+FAKE_FFMPEG = """
+import signal, threading
+args = sys.argv[1:]
+outputs = [arg for arg in args if arg.endswith(('.ogg', '.part')) or '%' in arg]
+output = outputs[-1].replace('%03d', '001') if outputs else None
+stopping = threading.Event()
+signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+signal.signal(signal.SIGINT, lambda *_: stopping.set())
+
+def finish(code=0):
+    time.sleep(CONFIG['delays']['ffmpeg_finalize'])
+    sys.exit(code)
+
+if 'pulse' in args:
+    # PulseAudioから直接録音: 標準入力の 'q' か SIGTERM で止まる
+    def wait_quit():
+        while sys.stdin.buffer.read(1) not in (b'q', b''):
+            pass
+        stopping.set()
+    threading.Thread(target=wait_quit, daemon=True).start()
+    time.sleep(CONFIG['delays']['ffmpeg_startup'])
+    pcm = bytes(8000 // 10 * 2) if 'pipe:1' in args else None
+    with open(output, 'wb') as f:
+        while not stopping.is_set():
+            f.write(bytes(1024))
+            f.flush()
+            if pcm:
+                try:
+                    sys.stdout.buffer.write(pcm)
+                    sys.stdout.buffer.flush()
+                except BrokenPipeError:
+                    break
+            stopping.wait(0.1)
+    finish()
+elif 'pipe:0' in args:
+    # パイプラインのエンコーダー: 標準入力が閉じるまで読む
+    time.sleep(CONFIG['delays']['ffmpeg_startup'])
+    with open(output, 'wb') as f:
+        while True:
+            data = sys.stdin.buffer.read1(65536)
+            if not data:
+                break
+            f.write(bytes(max(1, len(data) // 10)))
+            f.flush()
+    finish()
+else:
+    # 後処理・結合など
+    if output:
+        with open(output, 'wb') as f:
+            f.write(bytes(1024))
+    finish()
+"""
+
+FAKES = {
+    'hciconfig': FAKE_HCICONFIG,
+    'bluetoothctl': FAKE_BLUETOOTHCTL,
+    'pactl': FAKE_PACTL,
+    'parec': FAKE_PAREC,
+    'ffmpeg': FAKE_FFMPEG,
+}
+
+
+def percentile(values, p):
+    """最近傍順位法でのパーセンタイル"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def report(name, seconds, extra=''):
+    """計測結果を1行で表示する"""
+    if not seconds:
+        print(f"{name:<28}{'-':>5}")
+        return
+    ms = [value * 1000 for value in seconds]
+    print(f"{name:<28}{len(ms):5d}{percentile(ms, 50):10.1f}{percentile(ms, 90):10.1f}"
+          f"{percentile(ms, 99):10.1f}{max(ms):10.1f}  {extra}")
+
+
+class Harness:
+    """一時ディレクトリに作ったアプリと偽のコマンド群"""
+
+    def __init__(self, workdir, args):
+        self.workdir = workdir
+        self.args = args
+        self.bin_dir = os.path.join(workdir, 'bin')
+        self.config_path = os.path.join(self.bin_dir, 'bench.json')
+        self.call_log = os.path.join(workdir, 'calls.log')
+        self.recordings_dir = os.path.join(workdir, 'recordings')
+        self.port = None
+        self.web = None
+
+    def setup(self):
+        """アプリをコピーし、偽のコマンドと録音設定を用意する"""
+        for path in glob.glob(os.path.join(ROOT, 'recorder_*.py')):
+            shutil.copy(path, self.workdir)
+        shutil.copytree(os.path.join(ROOT, 'templates'), os.path.join(self.workdir, 'templates'))
+        os.makedirs(self.bin_dir)
+        self.set_devices(self.args.device_counts[0])
+        for name, body in FAKES.items():
+            path = os.path.join(self.bin_dir, name)
+            with open(path, 'w') as f:
+                f.write(FAKE_HEADER.format(python=sys.executable, config=self.config_path) + body)
+            os.chmod(path, 0o755)
+        with open(os.path.join(self.workdir, 'recorder_config.json'), 'w') as f:
+            json.dump({'capture_engine': self.args.engine, 'preroll_seconds': 0}, f)
+
+    def set_devices(self, count):
+        """偽のコマンドが返すペアリング済みデバイス数を変える"""
+        with open(self.config_path, 'w') as f:
+            json.dump({
+                'devices': count,
+                'adapters': self.args.adapters,
+                'call_log': self.call_log,
+                'delays': {
+                    'hciconfig': self.args.hciconfig_delay,
+                    'bluetoothctl': self.args.bluetoothctl_delay,
+                    'pactl': self.args.pactl_delay,
+                    'parec': self.args.parec_delay,
+                    'ffmpeg_startup': self.args.ffmpeg_startup,
+                    'ffmpeg_finalize': self.args.ffmpeg_finalize,
+                },
+            }, f)
+
+    def calls(self):
+        """これまでの外部コマンドの呼び出し数"""
+        try:
+            with open(self.call_log) as f:
+                return sum(1 for _ in f)
+        except FileNotFoundError:
+            return 0
+
+    def start(self):
+        """Webサーバーを起動し、ワーカーが応答するまで待つ"""
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        env = dict(os.environ,
+                   PATH=self.bin_dir + os.pathsep + os.environ.get('PATH', ''),
+                   RECORDER_STATUS_SEGMENT=os.path.join(self.workdir, 'status.shm'))
+        if not self.args.dbus:
+            env['DBUS_SYSTEM_BUS_ADDRESS'] = 'unix:path=' + os.path.join(self.workdir, 'no-dbus')
+        self.log = open(os.path.join(self.workdir, 'web.log'), 'wb')
+        self.web = subprocess.Popen([sys.executable, os.path.join(self.workdir, 'recorder_web.py'),
+                                     '--port', str(self.port)],
+                                    cwd=self.workdir, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            try:
+                if self.request('GET', '/get_status')[1].get('status') != 'offline':
+                    return
+            except OSError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"Webサーバーが起動しませんでした（{self.workdir}/web.log を確認してください）")
+
+    def stop(self):
+        """Webサーバー（とワーカー）を止める"""
+        if self.web:
+            self.web.send_signal(2)
+            try:
+                self.web.wait(15)
+            except subprocess.TimeoutExpired:
+                self.web.kill()
+            self.log.close()
+
+    def request(self, method, path, body=None):
+        """HTTPリクエストを送り、(秒, JSON) を返す"""
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        started = time.perf_counter()
+        conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+        response = conn.getresponse()
+        data = response.read()
+        elapsed = time.perf_counter() - started
+        conn.close()
+        return elapsed, json.loads(data or b'{}')
+
+    def newest_recording(self, known):
+        """まだ知らない録音ファイル（なければNone）"""
+        for path in glob.glob(os.path.join(self.recordings_dir, '*.ogg')):
+            if path not in known:
+                return path
+        return None
+
+
+def bench_endpoints(harness, args):
+    """HTTPの各エンドポイントの応答時間"""
+    for count in args.device_counts:
+        harness.set_devices(count)
+        seconds = []
+        calls_before = harness.calls()
+        for _ in range(args.n):
+            elapsed, data = harness.request('GET', '/get_devices')
+            seconds.append(elapsed)
+        calls = (harness.calls() - calls_before) / args.n
+        report(f"/get_devices ({count} devices)", seconds, f"{calls:.1f} calls/req, {len(data['devices'])} found")
+    harness.set_devices(args.device_counts[0])
+    for path in ('/get_status', '/get_files'):
+        report(path, [harness.request('GET', path)[0] for _ in range(args.n)])
+
+
+def bench_command_path(harness, args):
+    """コマンドバスの受理・応答までの時間"""
+    client = CommandClient(os.path.join(harness.workdir, 'recorder_command.sock'))
+    acks, replies, round_trips = [], [], []
+    for _ in range(args.n):
+        started = time.perf_counter()
+        reply = client.send({'action': 'ping'})
+        round_trips.append(time.perf_counter() - started)
+        acks.append(reply['ack_latency'])
+        replies.append(reply['reply_latency'])
+    client.close()
+    report('command ack', acks)
+    report('command reply', replies)
+    report('command round trip', round_trips)
+
+
+def bench_recording(harness, args):
+    """録音の開始・停止の応答時間と、実際に録音が始まる・確定するまでの時間"""
+    device = {'mac': '02:00:00:00:00:00', 'name': 'Bench Device 0', 'adapter': '00:00:00:00:01:00'}
+    start_http, captured, stop_http, finalised = [], [], [], []
+    for _ in range(args.cycles):
+        known = set(glob.glob(os.path.join(harness.recordings_dir, '*.ogg')))
+        started = time.perf_counter()
+        elapsed, result = harness.request('POST', '/start_recording', {'device': device, 'duration': 120})
+        if not result.get('success'):
+            print(f"録音を開始できません: {result.get('message')}")
+            return
+        start_http.append(elapsed)
+        deadline = started + 30
+        while time.perf_counter() < deadline:
+            path = harness.newest_recording(known)
+            if path and os.path.getsize(path) > 0:
+                captured.append(time.perf_counter() - started)
+                break
+            time.sleep(0.005)
+
+        # ファイル名は秒単位のため、次の録音と重ならないよう1秒以上録音する
+        time.sleep(args.record_seconds)
+        started = time.perf_counter()
+        elapsed, result = harness.request('POST', '/stop_recording')
+        stop_http.append(elapsed)
+        deadline = started + 30
+        while time.perf_counter() < deadline:
+            if not harness.request('GET', '/get_status')[1].get('recording'):
+                finalised.append(time.perf_counter() - started)
+                break
+            time.sleep(0.01)
+        time.sleep(0.5)
+    report('start (HTTP)', start_http)
+    report('start -> captured', captured)
+    report('stop (HTTP)', stop_http)
+    report('stop -> finalised', finalised)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="エンドツーエンドの遅延計測（偽のBluetooth・PulseAudio・ffmpegを使用）")
+    parser.add_argument('--devices', default='1,5,10,20', help='ペアリング済みデバイス数（カンマ区切り）')
+    parser.add_argument('--adapters', type=int, default=1, help='Bluetoothアダプタ数')
+    parser.add_argument('-n', type=int, default=20, help='各エンドポイントの計測回数')
+    parser.add_argument('--cycles', type=int, default=5, help='録音の開始・停止の回数')
+    parser.add_argument('--record-seconds', type=float, default=1.5, help='1回の録音の長さ（秒）')
+    parser.add_argument('--engine', choices=('ffmpeg', 'pyaudio'), default='ffmpeg', help='capture_engine')
+    parser.add_argument('--hciconfig-delay', type=float, default=0.05, help='hciconfigの応答時間（秒）')
+    parser.add_argument('--bluetoothctl-delay', type=float, default=0.15, help='bluetoothctlの応答時間（秒）')
+    parser.add_argument('--pactl-delay', type=float, default=0.05, help='pactlの応答時間（秒）')
+    parser.add_argument('--parec-delay', type=float, default=0.05, help='parecが読み出しを始めるまでの時間（秒）')
+    parser.add_argument('--ffmpeg-startup', type=float, default=0.3, help='ffmpegが録音を始めるまでの時間（秒）')
+    parser.add_argument('--ffmpeg-finalize', type=float, default=0.1, help='ffmpegがファイルを確定するまでの時間（秒）')
+    parser.add_argument('--dbus', action='store_true', help='BlueZのD-Bus APIを無効にしない')
+    parser.add_argument('--keep', action='store_true', help='一時ディレクトリ（ログ）を残す')
+    args = parser.parse_args()
+    args.device_counts = [int(count) for count in args.devices.split(',')]
+
+    workdir = tempfile.mkdtemp(prefix='recorder_bench_')
+    harness = Harness(workdir, args)
+    try:
+        harness.setup()
+        harness.start()
+        print(f"{'':<28}{'n':>5}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        bench_endpoints(harness, args)
+        bench_command_path(harness, args)
+        bench_recording(harness, args)
+    finally:
+        harness.stop()
+        if args.keep:
+            print(f"ログ: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
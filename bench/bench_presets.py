@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+エンコードのプリセットごとのCPUとファイルサイズを比較する
+会話を模した合成音声（またはWAV）を各プリセットでffmpegにエンコードさせ、
+  RTF        : エンコードにかかった時間 / 音声の長さ（1未満なら実時間で追いつく）
+  cpu %      : 実時間で録音するときに使うCPUの割合（CPU秒 / 音声の長さ）
+  MB/hour    : 1時間あたりのファイルサイズ
+を表示する。CPU時間は os.wait4 で子プロセスを含めて取得する。
+Pi Zeroで実行し、録音しながら余裕をもって動くプリセットを選ぶ。
+
+使い方: python3 bench/bench_presets.py [--wav 入力.wav] [--seconds 60] [--rate 16000]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_capture_engines import make_reference_wav
+from recorder_presets import ENCODER_PRESETS, preset_for_rate
+
+
+def encode(wav_path, out_path, codec_args):
+    """WAVをエンコードし、(経過秒, CPU秒) を返す"""
+    cmd = ['ffmpeg', '-loglevel', 'quiet', '-i', wav_path, *codec_args, '-y', out_path]
+    started = time.monotonic()
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.monotonic() - started
+    if os.waitstatus_to_exitcode(status):
+        raise RuntimeError(f"ffmpeg が失敗しました: {' '.join(cmd)}")
+    return elapsed, rusage.ru_utime + rusage.ru_stime
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="エンコードのプリセットの比較")
+    parser.add_argument('--wav', help='入力WAV（16bit PCM）。省略時は合成音声を生成')
+    parser.add_argument('--seconds', type=float, default=60, help='合成音声の長さ')
+    parser.add_argument('--rate', type=int, default=16000, help='合成音声のサンプルレート（HFPは8000/16000）')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        wav_path = args.wav
+        if not wav_path:
+            wav_path = os.path.join(workdir, 'reference.wav')
+            make_reference_wav(wav_path, args.seconds, rate=args.rate)
+        with wave.open(wav_path, 'rb') as wav:
+            seconds = wav.getnframes() / wav.getframerate()
+            rate = wav.getframerate()
+            print(f"入力: {seconds:.0f}秒, {wav.getframerate()}Hz, {wav.getnchannels()}ch")
+
+        print(f"{'preset':<12}{'wall s':>8}{'RTF':>8}{'cpu %':>8}{'MB/hour':>10}  format")
+        for name, preset in ENCODER_PRESETS.items():
+            # 録音と同じく、入力のサンプリングレートに合わせた設定でエンコードする
+            preset = preset_for_rate(preset, rate)
+            out_path = os.path.join(workdir, f'{name}.ogg')
+            try:
+                elapsed, cpu = encode(wav_path, out_path, preset['codec_args'])
+            except RuntimeError:
+                # エンコーダーが入力のサンプリングレート・チャンネル数に対応していない
+                print(f"{name:<12}{'-':>8}{'-':>8}{'-':>8}{'-':>10}  {preset['format']}（エンコードできません）")
+                continue
+            per_hour = os.path.getsize(out_path) / seconds * 3600 / (1024 * 1024)
+            print(f"{name:<12}{elapsed:8.2f}{elapsed / seconds:8.3f}{cpu / seconds * 100:8.1f}{per_hour:10.1f}"
+                  f"  {preset['format']}")
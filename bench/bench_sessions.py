@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+同時に録音できるセッション数を計測する
+Bluetoothデバイスの代わりに合成音声のWAVを実時間のペースで読ませ、
+セッション数を1から増やしながら --seconds 秒ずつ同時に録音する。
+  ffmpeg   : セッションごとにffmpegがソースを読んでエンコード（capture_engine=ffmpeg相当）
+  pipeline : 1つのプロセスでセッション数分の CapturePipeline + ffmpegエンコーダー
+             （capture_engine=pyaudio相当、キャプチャはワーカーのプロセス内）
+録音が途切れなかった（全セッションの録音の長さが実時間に追いつき、
+overruns/dropped_chunks が0）最大のセッション数を表示する。
+max_sessions の値は、このベンチマークを実機（Pi Zero 2など）で実行して決める。
+
+使い方: python3 bench/bench_sessions.py [--max-sessions 4] [--seconds 30] [--mode ffmpeg]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+import psutil
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_capture_engines import ENCODER_ARGS, make_reference_wav
+from recorder_capture import CapturePipeline, PipeEncoder, WavFileSource
+from recorder_catalog import ogg_info
+
+# 録音の長さ・経過時間がこの割合を外れたら途切れたとみなす
+TOLERANCE = 0.02
+# プロセスの起動やエンコーダーの終了にかかる時間として許容する秒数
+STARTUP_ALLOWANCE = 2.0
+
+
+def run_pipelines(wav_path, out_dir, sessions, seconds):
+    """子プロセスとして実行: セッション数分のパイプラインで同時に録音し、統計をJSONで出力する"""
+    with wave.open(wav_path, 'rb') as wav:
+        rate = wav.getframerate()
+    pipelines = []
+    for index in range(sessions):
+        pipeline = CapturePipeline(lambda: wav_path, rate, 1,
+                                   source_factory=lambda name, r, c: WavFileSource(name, loop=True))
+        encoder = PipeEncoder(os.path.join(out_dir, f'session{index}.ogg'), rate, 1, ENCODER_ARGS)
+        pipeline.attach(encoder)
+        pipeline.start()
+        pipelines.append((pipeline, encoder))
+    time.sleep(seconds)
+    stats = []
+    for pipeline, encoder in pipelines:
+        pipeline.detach()
+        pipeline.stop()
+        encoder.close()
+        stats.append(pipeline.stats())
+    print(json.dumps(stats))
+
+
+def session_commands(mode, wav_path, out_dir, sessions, seconds):
+    """セッション数分の録音を行うコマンドの一覧"""
+    if mode == 'pipeline':
+        return [[sys.executable, __file__, '--run-pipelines', wav_path, out_dir, str(sessions), str(seconds)]]
+    return [['ffmpeg', '-loglevel', 'error', '-re', '-stream_loop', '-1', '-i', wav_path, '-t', str(seconds),
+             *ENCODER_ARGS, '-y', os.path.join(out_dir, f'session{index}.ogg')]
+            for index in range(sessions)]
+
+
+def measure(mode, wav_path, sessions, seconds):
+    """同時録音を1回行い、(経過秒, CPU%, 最短の録音秒, バッファあふれ) を返す"""
+    with tempfile.TemporaryDirectory() as out_dir:
+        psutil.cpu_percent()
+        started = time.monotonic()
+        procs = [subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+                 for cmd in session_commands(mode, wav_path, out_dir, sessions, seconds)]
+        outputs = [proc.communicate()[0] for proc in procs]
+        elapsed = time.monotonic() - started
+        cpu = psutil.cpu_percent()
+        if any(proc.returncode for proc in procs):
+            raise RuntimeError(f"{mode} の録音が失敗しました")
+
+        overflows = 0
+        if mode == 'pipeline':
+            overflows = sum(s['overruns'] + s['dropped_chunks'] for s in json.loads(outputs[0]))
+        durations = [ogg_info(os.path.join(out_dir, f'session{index}.ogg'))[1] or 0
+                     for index in range(sessions)]
+    return elapsed, cpu, min(durations), overflows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="同時録音できるセッション数の計測")
+    parser.add_argument('--max-sessions', type=int, default=4, help='試すセッション数の上限')
+    parser.add_argument('--seconds', type=float, default=30, help='1回の録音の長さ')
+    parser.add_argument('--rate', type=int, default=44100, help='合成音声のサンプルレート')
+    parser.add_argument('--mode', choices=['ffmpeg', 'pipeline', 'both'], default='both')
+    parser.add_argument('--run-pipelines', nargs=4, metavar=('WAV', 'OUT_DIR', 'SESSIONS', 'SECONDS'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_pipelines:
+        wav_path, out_dir, sessions, seconds = args.run_pipelines
+        run_pipelines(wav_path, out_dir, int(sessions), float(seconds))
+        sys.exit(0)
+
+    modes = ['ffmpeg', 'pipeline'] if args.mode == 'both' else [args.mode]
+    with tempfile.TemporaryDirectory() as workdir:
+        wav_path = os.path.join(workdir, 'reference.wav')
+        # ループさせるので短くてよい
+        make_reference_wav(wav_path, 10, rate=args.rate)
+
+        print(f"CPU: {psutil.cpu_count()}コア, 録音 {args.seconds:.0f}秒 x セッション数")
+        print(f"{'mode':<10}{'sessions':>9}{'wall s':>8}{'cpu %':>8}{'min rec s':>11}{'overflow':>10}  result")
+        for mode in modes:
+            sustained = 0
+            for sessions in range(1, args.max_sessions + 1):
+                elapsed, cpu, recorded, overflows = measure(mode, wav_path, sessions, args.seconds)
+                ok = (recorded >= args.seconds * (1 - TOLERANCE)
+                      and elapsed <= args.seconds * (1 + TOLERANCE) + STARTUP_ALLOWANCE
+                      and not overflows)
+                print(f"{mode:<10}{sessions:9d}{elapsed:8.1f}{cpu:8.1f}{recorded:11.1f}{overflows:10d}  "
+                      f"{'OK' if ok else 'NG'}")
+                if not ok:
+                    break
+                sustained = sessions
+            print(f"{mode}: 途切れずに録音できたセッション数 {sustained}")
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+無音の判定（silence_gate）によるエンコードCPUとファイルサイズの削減を計測する
+会議を模した合成音声（待機室の無音・発話と短い間・休憩・終了後の無音）を作り、
+  off  : そのままエンコード
+  mark : 無音区間を記録するだけ（判定のオーバーヘッド）
+  skip : 長い無音をエンコードせずに詰める
+をそれぞれ ffmpeg（PipeEncoder, Vorbis 128kbps）でエンコードする。PCMは実時間を待たずに
+流し込み、エンコーダー（子プロセス）とPython側のCPU時間を分けて表示する。
+
+使い方: python3 bench/bench_silence.py [--minutes 10] [--wav 入力.wav]
+"""
+
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+import wave
+
+import numpy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from recorder_capture import CHUNK_FRAMES, SAMPLE_WIDTH, PipeEncoder
+from recorder_catalog import ogg_info
+from recorder_silence import SilenceGate, SilenceIndex
+
+ENCODER_ARGS = ['-acodec', 'libvorbis', '-ab', '128k']
+RATE = 44100
+
+
+def make_meeting_wav(path, minutes, rate=RATE):
+    """会議を模した合成音声を作り、無音区間の割合を返す
+
+    待機室（15%）→ 発話（短い間を含む）→ 休憩（20%）→ 発話 → 終了後（10%）。
+    無音は -70dBFS 程度のノイズ、発話は4Hzで振幅変調したノイズ（約 -20dBFS）。
+    """
+    rng = numpy.random.default_rng(0)
+    total = int(minutes * 60 * rate)
+    samples = rng.normal(0, 10, total)
+    talking = numpy.zeros(total, dtype=bool)
+    for start, end in ((0.15, 0.45), (0.65, 0.90)):
+        position = int(start * total)
+        while position < int(end * total):
+            # 2〜15秒話して、0.2〜1.5秒の間をあける
+            length = int(rng.uniform(2, 15) * rate)
+            talking[position:min(position + length, int(end * total))] = True
+            position += length + int(rng.uniform(0.2, 1.5) * rate)
+    t = numpy.arange(total) / rate
+    envelope = 0.5 + 0.5 * numpy.sin(2 * numpy.pi * 4 * t)
+    samples[talking] = rng.normal(0, 3000, talking.sum()) * envelope[talking]
+    pcm = numpy.clip(samples, -32768, 32767).astype('<i2')
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(SAMPLE_WIDTH)
+        wav.setframerate(rate)
+        wav.writeframes(pcm.tobytes())
+    return 1 - talking.mean()
+
+
+def encode(wav_path, out_path, mode):
+    """WAVをチャンクごとにエンコードし、(経過秒, エンコーダーCPU秒, Python CPU秒, ゲート) を返す"""
+    with wave.open(wav_path, 'rb') as wav:
+        rate, channels = wav.getframerate(), wav.getnchannels()
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        started, cpu_started = time.perf_counter(), time.process_time()
+        encoder = PipeEncoder(out_path, rate, channels, ENCODER_ARGS)
+        gate = None
+        if mode != 'off':
+            index = SilenceIndex(os.path.splitext(out_path)[0] + '.silence.json', mode, -50, 5)
+            gate = encoder = SilenceGate(encoder, index, rate, channels, mode=mode)
+        while True:
+            data = wav.readframes(CHUNK_FRAMES)
+            if not data:
+                break
+            encoder.write(data)
+        python_cpu = time.process_time() - cpu_started
+        encoder.close(timeout=600)
+        elapsed = time.perf_counter() - started
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    encoder_cpu = (children.ru_utime - children_before.ru_utime) + (children.ru_stime - children_before.ru_stime)
+    return elapsed, encoder_cpu, python_cpu, gate
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="無音の判定によるエンコード量の削減")
+    parser.add_argument('--minutes', type=float, default=10, help='合成音声の長さ（分）')
+    parser.add_argument('--wav', help='入力WAV（16bit PCM）。省略時は合成音声を生成')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        wav_path = args.wav
+        if not wav_path:
+            wav_path = os.path.join(workdir, 'meeting.wav')
+            silent = make_meeting_wav(wav_path, args.minutes)
+            print(f"合成音声: {args.minutes}分, 無音の割合 {silent * 100:.0f}%")
+
+        print(f"{'mode':<6}{'wall s':>8}{'enc cpu s':>11}{'py cpu s':>10}{'size KB':>10}"
+              f"{'length s':>10}{'skipped s':>11}{'regions':>9}")
+        baseline = None
+        for mode in ('off', 'mark', 'skip'):
+            out_path = os.path.join(workdir, f'{mode}.ogg')
+            elapsed, encoder_cpu, python_cpu, gate = encode(wav_path, out_path, mode)
+            size = os.path.getsize(out_path)
+            _, length = ogg_info(out_path)
+            regions = len(gate.index.data['regions']) if gate else 0
+            skipped = gate.skipped_seconds() if gate else 0
+            print(f"{mode:<6}{elapsed:8.1f}{encoder_cpu:11.2f}{python_cpu:10.2f}{size / 1024:10.0f}"
+                  f"{length:10.1f}{skipped:11.1f}{regions:9d}")
+            if mode == 'off':
+                baseline = (encoder_cpu, size)
+            elif mode == 'skip':
+                print(f"skip: エンコーダーCPU {encoder_cpu / baseline[0] * 100:.0f}%, "
+                      f"サイズ {size / baseline[1] * 100:.0f}%（offを100%として）")
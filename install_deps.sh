@@ -16,8 +16,12 @@ fi
 echo "PyAudio依存関係をインストール中..."
 sudo apt-get install -y python3-pyaudio portaudio19-dev
 
+# BlueZのD-Bus連携（デバイス一覧のキャッシュ）
+echo "D-Bus連携用パッケージをインストール中..."
+sudo apt-get install -y python3-dbus python3-gi
+
 # Pythonパッケージ
 echo "Pythonパッケージをインストール中..."
-pip3 install flask pyaudio
+pip3 install flask waitress pyaudio soundfile numpy
 
 echo "インストール完了！"
\ No newline at end of file
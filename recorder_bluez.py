@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+"""
+BlueZ D-Bus経由のBluetoothデバイス管理
+DeviceInventory: ObjectManager.GetManagedObjects を1回呼んでアダプタと
+デバイスを取得し、以降は InterfacesAdded / InterfacesRemoved /
+PropertiesChanged シグナルでメモリ上のキャッシュを更新する。
+ConnectionManager: 選択中のデバイスをバックグラウンドで接続済みに保つ。
+
+dbus-python と PyGObject（python3-dbus, python3-gi）が必要。
+テストでは python-dbusmock の bluez5 テンプレートのバスを bus に渡せる。
+"""
+
+import logging
+import threading
+import time
+
+try:
+    import dbus
+    import dbus.mainloop.glib
+    from gi.repository import GLib
+except ImportError:
+    dbus = None
+
+BLUEZ_SERVICE = 'org.bluez'
+ADAPTER_INTERFACE = 'org.bluez.Adapter1'
+DEVICE_INTERFACE = 'org.bluez.Device1'
+OBJECT_MANAGER_INTERFACE = 'org.freedesktop.DBus.ObjectManager'
+PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
+
+# 再接続のバックオフ（秒）
+RECONNECT_BACKOFF_INITIAL = 2
+RECONNECT_BACKOFF_MAX = 60
+# 接続中のデバイスを再確認する間隔（秒）。D-Bus連携時はシグナルで即座に検知する
+VERIFY_INTERVAL_CLI = 30
+VERIFY_INTERVAL_DBUS = 300
+# Device1.Connect のタイムアウト（秒）
+CONNECT_TIMEOUT = 30
+
+logger = logging.getLogger(__name__)
+
+
+def _plain(value):
+    """dbusの型をPythonの組み込み型に変換"""
+    if isinstance(value, dbus.Boolean):
+        return bool(value)
+    if isinstance(value, (dbus.String, dbus.ObjectPath)):
+        return str(value)
+    if isinstance(value, (dbus.Byte, dbus.Int16, dbus.Int32, dbus.Int64,
+                          dbus.UInt16, dbus.UInt32, dbus.UInt64)):
+        return int(value)
+    if isinstance(value, dbus.Array):
+        return [_plain(v) for v in value]
+    if isinstance(value, dbus.Dictionary):
+        return {str(k): _plain(v) for k, v in value.items()}
+    return value
+
+
+class DeviceInventory:
+    """BlueZのアダプタとデバイスをキャッシュするサービス"""
+
+    def __init__(self, bus=None):
+        self._bus = bus
+        self._lock = threading.Lock()
+        self._adapters = {}  # オブジェクトパス -> Adapter1のプロパティ
+        self._devices = {}   # オブジェクトパス -> Device1のプロパティ
+        self._loop = None
+        self._matches = []
+        self.available = False
+        # デバイスの接続状態が変わったときに (MACアドレス, 接続中か) で呼ばれる
+        # （ConnectionManagerが登録する。stop()→start()しても残す）
+        self.listeners = []
+
+    def start(self):
+        """キャッシュを初期化し、シグナル受信用のメインループを開始する"""
+        if dbus is None:
+            logger.warning("dbus-pythonが見つからないため、BlueZのD-Bus連携は無効です")
+            return False
+        try:
+            if self._bus is None:
+                dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+                self._bus = dbus.SystemBus()
+            self._subscribe()
+            self.reload()
+        except dbus.DBusException as e:
+            logger.warning(f"BlueZに接続できません: {e}")
+            return False
+
+        self._loop = GLib.MainLoop()
+        thread = threading.Thread(target=self._loop.run, daemon=True)
+        thread.start()
+        self.available = True
+        return True
+
+    def stop(self):
+        """シグナルの受信とメインループを停止"""
+        for match in self._matches:
+            match.remove()
+        self._matches = []
+        if self._loop:
+            self._loop.quit()
+            self._loop = None
+        self.available = False
+
+    def reload(self):
+        """GetManagedObjectsで全オブジェクトを取得し直す"""
+        manager = dbus.Interface(self._bus.get_object(BLUEZ_SERVICE, '/'), OBJECT_MANAGER_INTERFACE)
+        objects = manager.GetManagedObjects()
+        adapters, devices = {}, {}
+        for path, interfaces in objects.items():
+            if ADAPTER_INTERFACE in interfaces:
+                adapters[str(path)] = _plain(interfaces[ADAPTER_INTERFACE])
+            if DEVICE_INTERFACE in interfaces:
+                devices[str(path)] = _plain(interfaces[DEVICE_INTERFACE])
+        with self._lock:
+            self._adapters = adapters
+            self._devices = devices
+        logger.info(f"BlueZから取得: アダプタ {len(adapters)}件, デバイス {len(devices)}件")
+
+    def _subscribe(self):
+        # 再度start()したときに同じシグナルを二重に受けないよう、stop()で外せるように持っておく
+        self._matches = [
+            self._bus.add_signal_receiver(
+                self._on_interfaces_added, dbus_interface=OBJECT_MANAGER_INTERFACE,
+                signal_name='InterfacesAdded', bus_name=BLUEZ_SERVICE),
+            self._bus.add_signal_receiver(
+                self._on_interfaces_removed, dbus_interface=OBJECT_MANAGER_INTERFACE,
+                signal_name='InterfacesRemoved', bus_name=BLUEZ_SERVICE),
+            self._bus.add_signal_receiver(
+                self._on_properties_changed, dbus_interface=PROPERTIES_INTERFACE,
+                signal_name='PropertiesChanged', bus_name=BLUEZ_SERVICE, path_keyword='path'),
+            # bluetoothdが再起動した場合はキャッシュを作り直す
+            self._bus.add_signal_receiver(
+                self._on_name_owner_changed, dbus_interface='org.freedesktop.DBus',
+                signal_name='NameOwnerChanged', arg0=BLUEZ_SERVICE)
+        ]
+
+    def _on_interfaces_added(self, path, interfaces):
+        path = str(path)
+        with self._lock:
+            if ADAPTER_INTERFACE in interfaces:
+                self._adapters[path] = _plain(interfaces[ADAPTER_INTERFACE])
+            if DEVICE_INTERFACE in interfaces:
+                self._devices[path] = _plain(interfaces[DEVICE_INTERFACE])
+
+    def _on_interfaces_removed(self, path, interfaces):
+        path = str(path)
+        with self._lock:
+            if ADAPTER_INTERFACE in interfaces:
+                self._adapters.pop(path, None)
+            if DEVICE_INTERFACE in interfaces:
+                self._devices.pop(path, None)
+
+    def _on_properties_changed(self, interface, changed, invalidated, path=None):
+        path = str(path)
+        changed = _plain(changed)
+        with self._lock:
+            if interface == ADAPTER_INTERFACE and path in self._adapters:
+                target = self._adapters[path]
+            elif interface == DEVICE_INTERFACE and path in self._devices:
+                target = self._devices[path]
+            else:
+                return
+            target.update(changed)
+            for name in invalidated:
+                target.pop(str(name), None)
+            address = target.get('Address')
+        if interface == DEVICE_INTERFACE and 'Connected' in changed:
+            for listener in list(self.listeners):
+                try:
+                    listener(address, bool(changed['Connected']))
+                except Exception as e:
+                    logger.error(f"接続状態コールバックでエラー: {e}")
+
+    def _on_name_owner_changed(self, name, old_owner, new_owner):
+        if new_owner:
+            logger.info("bluetoothdが再起動したため、デバイス一覧を再取得します")
+            try:
+                self.reload()
+            except dbus.DBusException as e:
+                logger.error(f"デバイス一覧の再取得に失敗: {e}")
+        else:
+            with self._lock:
+                self._adapters = {}
+                self._devices = {}
+
+    def devices(self):
+        """ペアリング済みデバイス一覧（get_bluetooth_devicesと同じ形式）"""
+        with self._lock:
+            adapters = dict(self._adapters)
+            devices = sorted(self._devices.values(), key=lambda d: d.get('Address', ''))
+            result = []
+            for props in devices:
+                if not props.get('Paired'):
+                    continue
+                adapter_path = props.get('Adapter', '')
+                adapter = adapters.get(adapter_path, {})
+                result.append({
+                    'mac': props.get('Address'),
+                    'name': props.get('Alias') or props.get('Name') or props.get('Address'),
+                    'adapter': adapter.get('Address', 'unknown'),
+                    'adapter_name': adapter_path.rsplit('/', 1)[-1] if adapter_path else 'unknown',
+                    'connected': bool(props.get('Connected')),
+                    'paired': True,
+                    'trusted': bool(props.get('Trusted'))
+                })
+            return result
+
+    def find_device(self, mac):
+        """MACアドレスから (オブジェクトパス, Device1のプロパティ) を返す"""
+        with self._lock:
+            for path, props in self._devices.items():
+                if props.get('Address', '').upper() == mac.upper():
+                    return path, dict(props)
+        return None, None
+
+    def connect(self, mac):
+        """Device1.Connectでデバイスに接続する（完了までブロックする）"""
+        path, props = self.find_device(mac)
+        if not path:
+            return False, "デバイスがBlueZに登録されていません"
+        if not props.get('Paired'):
+            return False, "デバイスがペアリングされていません"
+        if props.get('Connected'):
+            return True, "デバイスは正常に接続されています"
+        try:
+            device = dbus.Interface(self._bus.get_object(BLUEZ_SERVICE, path), DEVICE_INTERFACE)
+            device.Connect(timeout=CONNECT_TIMEOUT)
+            return True, "デバイスへの接続に成功しました"
+        except dbus.DBusException as e:
+            return False, f"デバイスへの接続に失敗しました: {e.get_dbus_message()}"
+
+
+class ConnectionManager:
+    """選択中のデバイスと、録音中のセッションのデバイスを接続済みに保つバックグラウンドサービス
+
+    接続と確認は専用スレッドでデバイスごとに行い、状態は state() で即座に参照できる。
+    切断されるとデバイスごとにバックオフしながら再接続を試みる。
+    選択中のデバイスは set_device()、録音中のセッションのデバイスは set_session_devices() で渡す。
+    state() と on_change は選択中のデバイスの状態。
+    check_fn はD-Bus連携が使えない場合の確認・接続関数で、
+    (接続済みか, メッセージ) を返す。
+    """
+
+    def __init__(self, check_fn, inventory=None, on_change=None):
+        self.check_fn = check_fn
+        self.inventory = inventory
+        self.on_change = on_change
+        self._device = None
+        # 録音中のセッションのデバイスと、一度だけ接続を試みるデバイス（MACアドレス → デバイス）
+        self._session_devices = {}
+        self._requested = {}
+        # デバイスごとの状態・次に確認する時刻・バックオフ（MACアドレスがキー）
+        self._states = {}
+        self._due = {}
+        self._backoff = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._running = False
+        self._idle_state = {'state': 'idle', 'device': None, 'message': None,
+                            'since': time.time(), 'attempts': 0, 'next_retry': None}
+        if inventory is not None:
+            inventory.listeners.append(self._on_connection_changed)
+
+    def start(self):
+        """監視スレッドを開始"""
+        self._running = True
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def stop(self):
+        """監視スレッドを停止"""
+        self._running = False
+        self._wake.set()
+
+    def set_device(self, device):
+        """接続を維持する選択中のデバイスを設定する（変更時は即座に接続を試みる）"""
+        mac = _mac(device)
+        with self._lock:
+            changed = mac != _mac(self._device)
+            self._device = device
+            if changed:
+                self._forget_unmanaged()
+                if mac:
+                    self._due[mac] = 0
+        if changed:
+            if mac:
+                self._set_state(mac, 'connecting', None, attempts=0)
+            elif self.on_change:
+                self.on_change(self.state())
+            self._wake.set()
+
+    def set_session_devices(self, devices):
+        """録音中のセッションのデバイスの一覧を設定する（新しいデバイスは即座に接続を試みる）"""
+        devices = {_mac(device): device for device in devices if _mac(device)}
+        with self._lock:
+            added = [mac for mac in devices if mac not in self._managed()]
+            self._session_devices = devices
+            for mac in added:
+                self._due[mac] = 0
+            self._forget_unmanaged()
+        if added:
+            self._wake.set()
+
+    def request_connect(self, device=None):
+        """待ち時間を無視して、すぐに接続を試みさせる（ブロックしない）
+
+        選択中でも録音中でもないデバイスは、一度だけ接続を試みる（選択中のデバイスは変えない）。
+        """
+        with self._lock:
+            mac = _mac(device) or _mac(self._device)
+            if not mac:
+                return
+            if mac not in self._managed():
+                self._requested[mac] = device
+            self._due[mac] = 0
+        self._wake.set()
+
+    def state(self):
+        """選択中のデバイスの接続状態"""
+        with self._lock:
+            mac = _mac(self._device)
+            if mac and mac in self._states:
+                return dict(self._states[mac])
+            return dict(self._idle_state)
+
+    def is_connected(self, device=None):
+        """指定デバイス（省略時は選択中のデバイス）が接続済みか"""
+        with self._lock:
+            mac = _mac(device) or _mac(self._device)
+            return bool(mac) and self._states.get(mac, {}).get('state') == 'connected'
+
+    def _managed(self):
+        """接続を管理しているデバイス（MACアドレス → デバイス、ロック内で呼ぶ）"""
+        managed = dict(self._requested)
+        managed.update(self._session_devices)
+        if self._device and _mac(self._device):
+            managed[_mac(self._device)] = self._device
+        return managed
+
+    def _forget_unmanaged(self):
+        """管理しなくなったデバイスの状態を捨てる（ロック内で呼ぶ）"""
+        managed = self._managed()
+        for table in (self._states, self._due, self._backoff):
+            for mac in [mac for mac in table if mac not in managed]:
+                del table[mac]
+
+    def _set_state(self, mac, state, message, **extra):
+        with self._lock:
+            previous = self._states.get(mac) or dict(self._idle_state, device=mac)
+            new_state = dict(previous, state=state, device=mac, message=message, **extra)
+            if state != previous['state']:
+                new_state['since'] = time.time()
+            self._states[mac] = new_state
+            selected = mac == _mac(self._device)
+        if selected and new_state != previous and self.on_change:
+            self.on_change(dict(new_state))
+
+    def _on_connection_changed(self, mac, connected):
+        mac = (mac or '').upper()
+        with self._lock:
+            if mac not in self._managed():
+                return
+        if connected:
+            self._set_state(mac, 'connected', "デバイスは正常に接続されています", attempts=0, next_retry=None)
+        else:
+            logger.info(f"デバイス {mac} が切断されました。再接続を試みます")
+            self._set_state(mac, 'disconnected', "デバイスが切断されました")
+            with self._lock:
+                self._due[mac] = 0
+            self._wake.set()
+
+    def _attempt(self, device):
+        if self.inventory is not None and self.inventory.available:
+            return self.inventory.connect(device['mac'])
+        return self.check_fn(device)
+
+    def _check(self, mac, device):
+        """1台のデバイスの接続を確認し、つながっていなければ接続を試みる"""
+        with self._lock:
+            state = self._states.get(mac, {}).get('state')
+        if state != 'connected':
+            self._set_state(mac, 'connecting', "デバイスに接続しています")
+        try:
+            connected, message = self._attempt(device)
+        except Exception as e:
+            connected, message = False, f"Bluetoothチェック中にエラーが発生しました: {e}"
+
+        with self._lock:
+            # 一度だけの接続の依頼は、試みたら終わり
+            self._requested.pop(mac, None)
+            if mac not in self._managed():
+                # 確認中に管理対象から外れた
+                self._forget_unmanaged()
+                return
+
+        if connected:
+            self._backoff.pop(mac, None)
+            self._set_state(mac, 'connected', message, attempts=0, next_retry=None)
+            use_dbus = self.inventory is not None and self.inventory.available
+            delay = VERIFY_INTERVAL_DBUS if use_dbus else VERIFY_INTERVAL_CLI
+        else:
+            delay = self._backoff.get(mac, RECONNECT_BACKOFF_INITIAL)
+            self._backoff[mac] = min(delay * 2, RECONNECT_BACKOFF_MAX)
+            with self._lock:
+                attempts = self._states.get(mac, {}).get('attempts', 0) + 1
+            logger.warning(f"デバイス {mac} に接続できません（{attempts}回目）: {message}")
+            self._set_state(mac, 'disconnected', message, attempts=attempts,
+                            next_retry=time.time() + delay)
+        with self._lock:
+            if mac in self._managed() and self._due.get(mac) != 0:
+                self._due[mac] = time.monotonic() + delay
+
+    def _run(self):
+        while self._running:
+            now = time.monotonic()
+            with self._lock:
+                managed = self._managed()
+                due = [(mac, device) for mac, device in managed.items() if self._due.get(mac, 0) <= now]
+                # 確認中に届いた依頼（_due が0に戻る）を取りこぼさないよう、確認前に次の時刻を仮に入れる
+                for mac, _ in due:
+                    self._due[mac] = now + RECONNECT_BACKOFF_MAX
+            for mac, device in due:
+                if not self._running:
+                    return
+                self._check(mac, device)
+
+            with self._lock:
+                pending = [self._due.get(mac, 0) for mac in self._managed()]
+            timeout = max(0, min(pending) - time.monotonic()) if pending else None
+            if self._wake.wait(timeout):
+                self._wake.clear()
+
+
+def _mac(device):
+    """デバイス（dict またはMACアドレス）のMACアドレス（大文字、なければNone）"""
+    if isinstance(device, dict):
+        device = device.get('mac')
+    return device.upper() if device else None
@@ -0,0 +1,823 @@
+#!/usr/bin/env python3
+"""
+録音ワーカーのPCMキャプチャ部品
+PulseAudioのソースから生のPCM（s16le）を固定サイズのチャンクで読み出し、
+事前確保したバッファプールと上限付きキューを通してエンコーダーに渡す。
+待機中はリングバッファに直近の音声を保持し（プリロール）、録音開始時に
+その音声を先頭に付けてからライブの音声を続けて書き込む。
+
+ソース: parec（PulseSource）、PyAudio（PyAudioSource）、WAVファイル（WavFileSource、計測用）、
+        2つのソースを左右のチャンネルにまとめたもの（DualSource）
+エンコーダー: ffmpegの標準入力（PipeEncoder）、libsndfile（SoundFileEncoder、プロセス内）、
+            一定時間・サイズごとのファイル分割（SegmentedEncoder）
+"""
+
+import array
+import collections
+import fcntl
+import logging
+import os
+import queue
+import subprocess
+import termios
+import threading
+import time
+import wave
+
+from recorder_metrics import observe_command
+
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+# 1回の読み出しサイズ（フレーム数）
+CHUNK_FRAMES = 1024
+# s16leの1サンプルのバイト数
+SAMPLE_WIDTH = 2
+# バッファプールのチャンク数（44.1kHzモノラルで約1.5秒分）
+POOL_CHUNKS = 64
+# parecから届いたフレーム数が経過時間よりこの秒数以上少ない状態が、
+# DROP_SETTLE_SECONDS 続いたら音声が欠けたとみなす
+DROP_TOLERANCE_SECONDS = 0.5
+DROP_SETTLE_SECONDS = 2.0
+# 読み出しでこの秒数以上待った場合だけ、ライブの先端にいるとして不足を判定する
+# （溜まったデータを読んでいる間の不足は読み出し側の遅れで、欠けではない）
+DROP_LIVE_WAIT_SECONDS = 0.002
+# 2トラックのソースの開始のずれとして揃える上限（秒）。これを超えたら測り損ないとみなす
+DUAL_ALIGN_MAX_SECONDS = 1.0
+# 2トラックの開始のずれを測る時間と間隔（秒）。ソースには転送単位ごとにまとめて届くため、
+# 何度も測って平均する
+DUAL_ALIGN_MEASURE_SECONDS = 0.3
+DUAL_ALIGN_MEASURE_INTERVAL = 0.005
+
+# PULSE_SOURCE はプロセス全体の環境変数なので、PyAudioのストリームを開く間だけ設定する
+_pulse_source_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+class RingBuffer:
+    """固定容量のリングバッファ（容量を超えた分は古い順に捨てる）"""
+
+    def __init__(self, capacity, align=1):
+        # サンプルの途中で切れないよう、容量をフレーム境界に揃える
+        self.capacity = capacity - capacity % align
+        self._buffer = bytearray(self.capacity)
+        self._pos = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def write(self, data):
+        """データを追記する"""
+        if not self.capacity:
+            return
+        data = memoryview(data)
+        if len(data) >= self.capacity:
+            self._buffer[:] = data[-self.capacity:]
+            self._pos = 0
+            self._size = self.capacity
+            return
+        end = self._pos + len(data)
+        if end <= self.capacity:
+            self._buffer[self._pos:end] = data
+        else:
+            first = self.capacity - self._pos
+            self._buffer[self._pos:] = data[:first]
+            self._buffer[:end - self.capacity] = data[first:]
+        self._pos = end % self.capacity
+        self._size = min(self._size + len(data), self.capacity)
+
+    def snapshot(self):
+        """保持しているデータを古い順に返す"""
+        if self._size < self.capacity:
+            return bytes(self._buffer[:self._size])
+        return bytes(self._buffer[self._pos:]) + bytes(self._buffer[:self._pos])
+
+    def clear(self):
+        """保持しているデータを破棄する"""
+        self._pos = 0
+        self._size = 0
+
+
+def parse_sample_spec(text):
+    """pactl のサンプル仕様（"s16le 1ch 16000Hz"）を {'format', 'channels', 'rate'} にする（読めなければNone）"""
+    parts = text.split()
+    try:
+        sample_format, channels, rate = parts[0], parts[1], parts[2]
+        if not channels.endswith('ch') or not rate.endswith('Hz'):
+            return None
+        return {'format': sample_format, 'channels': int(channels[:-2]), 'rate': int(rate[:-2])}
+    except (IndexError, ValueError):
+        return None
+
+
+class PulseSource:
+    """parecでPulseAudioのソースから生のPCMを読み出す
+
+    parecはサーバー側で欠けた音声を知らせないため、届いたフレーム数を
+    最初のデータからの経過時間と比べて、欠けた回数を overruns に、
+    欠けたおおよそのフレーム数を dropped_frames に数える。
+    """
+
+    def __init__(self, source_name, rate, channels):
+        self.source_name = source_name
+        self.rate = rate
+        self.channels = channels
+        cmd = [
+            'parec',
+            f'--device={source_name}',
+            '--format=s16le',
+            f'--rate={rate}',
+            f'--channels={channels}',
+            '--latency-msec=50',
+            '--raw'
+        ]
+        self.overruns = 0
+        self.dropped_frames = 0
+        self._clock_start = None
+        self._frames = 0
+        self._behind_since = None
+        self._behind_missing = 0
+        self._closed = False
+        self.started = time.monotonic()
+        # パイプに溜まっている量を pending_frames() で数えられるよう、Python側ではバッファしない
+        self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+
+    @property
+    def frames_read(self):
+        """これまでに読み出したフレーム数"""
+        return self._frames
+
+    def pending_frames(self):
+        """parecからパイプに届いていて、待たずに読み出せるフレーム数"""
+        pending = array.array('i', [0])
+        fcntl.ioctl(self.process.stdout.fileno(), termios.FIONREAD, pending)
+        return pending[0] // (SAMPLE_WIDTH * self.channels)
+
+    def read_into(self, buffer):
+        """bufferを埋めるまで読み出し、読んだバイト数を返す（0はソースの終了）"""
+        started = time.monotonic()
+        view = memoryview(buffer)
+        size = 0
+        while size < len(view):
+            read = self.process.stdout.readinto(view[size:])
+            if not read:
+                break
+            size += read
+        if size:
+            self._account(size // (SAMPLE_WIDTH * self.channels), time.monotonic() - started)
+        return size
+
+    def _account(self, frames, waited):
+        """届いたフレーム数を経過時間と比べ、欠けた音声を overruns に数える"""
+        now = time.monotonic()
+        self._frames += frames
+        if self._clock_start is None:
+            # 最初のデータが届いた時点から数える（接続までの時間は含めない）
+            self._clock_start = now - self._frames / self.rate
+        missing = (now - self._clock_start) * self.rate - self._frames
+        if missing < 0:
+            # ソースのクロックが速い分は基準をずらす
+            self._clock_start = now - self._frames / self.rate
+        if waited < DROP_LIVE_WAIT_SECONDS:
+            return
+        if missing <= DROP_TOLERANCE_SECONDS * self.rate:
+            self._behind_since = None
+        elif self._behind_since is None:
+            self._behind_since, self._behind_missing = now, missing
+        else:
+            # 届くタイミングのばらつきを除くため、不足が続いた間の最小値を欠けた量とする
+            self._behind_missing = min(self._behind_missing, missing)
+            if now - self._behind_since >= DROP_SETTLE_SECONDS:
+                self.overruns += 1
+                self.dropped_frames += int(self._behind_missing)
+                logger.warning(f"parecの音声が約{self._behind_missing / self.rate:.1f}秒欠けました: {self.source_name}")
+                self._clock_start += self._behind_missing / self.rate
+                self._behind_since = None
+
+    def interrupt(self):
+        """別スレッドからparecを止め、読み出し中の read_into を終わらせる"""
+        if self.process.poll() is None:
+            self.process.terminate()
+
+    def close(self):
+        """キャプチャを停止（2回目以降は何もしない）"""
+        if self._closed:
+            return
+        self._closed = True
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process.stdout.close()
+        observe_command('parec', time.monotonic() - self.started, self.process.returncode)
+
+
+class PyAudioSource:
+    """PyAudio（PortAudio）でPulseAudioのソースから直接PCMを読み出す
+
+    PortAudioのALSA経由の "pulse" デバイスを開き、PULSE_SOURCE環境変数で
+    録音するソースを指定する。環境変数はプロセス全体で共有されるため、
+    ストリームを開く間だけロックして設定し、開いたら元に戻す。
+    """
+
+    def __init__(self, source_name, rate, channels):
+        if pyaudio is None:
+            raise RuntimeError("PyAudioがインストールされていません")
+        self.source_name = source_name
+        self.rate = rate
+        self.channels = channels
+        self.overruns = 0
+        self.frames_read = 0
+        self._interrupted = False
+        self._closed = False
+        with _pulse_source_lock:
+            previous = os.environ.get('PULSE_SOURCE')
+            os.environ['PULSE_SOURCE'] = source_name
+            try:
+                self._pa = pyaudio.PyAudio()
+                try:
+                    self._stream = self._pa.open(
+                        format=pyaudio.paInt16,
+                        channels=channels,
+                        rate=rate,
+                        input=True,
+                        input_device_index=self._find_pulse_device(),
+                        frames_per_buffer=CHUNK_FRAMES
+                    )
+                except Exception:
+                    self._pa.terminate()
+                    raise
+            finally:
+                # 接続したストリームはソースが決まっているので、次のセッションのために戻す
+                if previous is None:
+                    os.environ.pop('PULSE_SOURCE', None)
+                else:
+                    os.environ['PULSE_SOURCE'] = previous
+
+    def _find_pulse_device(self):
+        for index in range(self._pa.get_device_count()):
+            info = self._pa.get_device_info_by_index(index)
+            if info.get('name') == 'pulse' and info.get('maxInputChannels', 0) > 0:
+                return index
+        return None  # 既定の入力デバイス
+
+    def read_into(self, buffer):
+        """bufferの大きさ分のフレームを読み出してbufferに書き込み、バイト数を返す"""
+        frames = len(buffer) // (SAMPLE_WIDTH * self.channels)
+        while not self._interrupted:
+            try:
+                data = self._stream.read(frames, exception_on_overflow=True)
+            except IOError as e:
+                if e.errno != pyaudio.paInputOverflowed:
+                    logger.error(f"PyAudioの読み出しエラー: {e}")
+                    return 0
+                # 読み出しが間に合わずPortAudio側で音声が欠けた
+                self.overruns += 1
+                continue
+            size = len(data)
+            buffer[:size] = data
+            self.frames_read += size // (SAMPLE_WIDTH * self.channels)
+            return size
+        return 0
+
+    def pending_frames(self):
+        """PortAudioに届いていて、待たずに読み出せるフレーム数"""
+        return self._stream.get_read_available()
+
+    def interrupt(self):
+        """別スレッドから読み出しを終わらせる（読み出し中のチャンクを読み終えると0を返す）"""
+        self._interrupted = True
+
+    def close(self):
+        """ストリームを閉じる（2回目以降は何もしない）"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._stream.stop_stream()
+            self._stream.close()
+        finally:
+            self._pa.terminate()
+
+
+class WavFileSource:
+    """WAVファイルを実時間のペースで読み出す（ベンチマーク用の代替ソース）"""
+
+    def __init__(self, path, rate=None, channels=None, loop=False):
+        self._wav = wave.open(path, 'rb')
+        if self._wav.getsampwidth() != SAMPLE_WIDTH:
+            raise ValueError("16bit PCMのWAVのみ対応しています")
+        self.rate = self._wav.getframerate()
+        self.channels = self._wav.getnchannels()
+        self.loop = loop
+        self.overruns = 0
+        self._interrupted = False
+        self._started = time.monotonic()
+        self._frames_read = 0
+
+    def read_into(self, buffer):
+        """1チャンク分を読み出す（ファイル終端で0）"""
+        if self._interrupted:
+            return 0
+        frames = len(buffer) // (SAMPLE_WIDTH * self.channels)
+        data = self._wav.readframes(frames)
+        if not data and self.loop:
+            self._wav.rewind()
+            data = self._wav.readframes(frames)
+        if not data:
+            return 0
+        buffer[:len(data)] = data
+        self._frames_read += len(data) // (SAMPLE_WIDTH * self.channels)
+        # 実際の録音と同じペースになるよう待つ
+        delay = self._started + self._frames_read / self.rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        return len(data)
+
+    def interrupt(self):
+        """別スレッドから読み出しを終わらせる"""
+        self._interrupted = True
+
+    def close(self):
+        """ファイルを閉じる"""
+        self._wav.close()
+
+
+class DualSource:
+    """2つのモノラルのソースを1つのステレオのソースとして読み出す
+
+    BluetoothのソースとそのシンクのモニターをL/Rにまとめ、1つのエンコーダーで
+    2トラックの録音にする。ソースは別々のプロセス・ストリームで開くため開始がずれる。
+    同じ時点までに各ソースに届いたフレーム数（読み出し済みと、待たずに読める分の合計）の差を
+    開始のずれとし、早く始まった側の先頭を捨てて揃える。届いたフレーム数を返さないソース
+    （frames_read と pending_frames() がない）は揃えない。
+    ソースが音声の欠けを数えていれば（dropped_frames）、欠けた分をそのチャンネルの
+    無音で埋め、検知した以降の位置を保つ。
+    PulseAudioのサーバー内やBluetoothの経路での遅れは測れないため、サンプル単位では揃わない。
+    """
+
+    def __init__(self, sources):
+        self.sources = sources
+        self.channels = len(sources)
+        self.rate = sources[0].rate
+        self._frames = 0
+        self._aligned = False
+        # ソースごとの、これまでに見た dropped_frames と、埋める無音のフレーム数
+        self._dropped = [0] * len(sources)
+        self._padding = [0] * len(sources)
+
+    @property
+    def overruns(self):
+        return sum(source.overruns for source in self.sources)
+
+    def _allocate(self, frames):
+        """チャンクの大きさに合わせて作業用のバッファを確保する"""
+        self._frames = frames
+        self._scratch = array.array('h', bytes(frames * SAMPLE_WIDTH))
+        self._scratch_view = memoryview(self._scratch).cast('B')
+        self._silence = array.array('h', bytes(frames * SAMPLE_WIDTH))
+        self._interleaved = array.array('h', bytes(frames * SAMPLE_WIDTH * self.channels))
+        self._interleaved_view = memoryview(self._interleaved).cast('B')
+
+    def read_into(self, buffer):
+        """各ソースから同じフレーム数を読み、インターリーブしてbufferに入れる（0はソースの終了）"""
+        frames = len(buffer) // (SAMPLE_WIDTH * self.channels)
+        if frames != self._frames:
+            self._allocate(frames)
+        if not self._aligned:
+            self._aligned = True
+            if not self._align():
+                return 0
+        for channel, source in enumerate(self.sources):
+            dropped = getattr(source, 'dropped_frames', 0)
+            if dropped > self._dropped[channel]:
+                self._padding[channel] += dropped - self._dropped[channel]
+                self._dropped[channel] = dropped
+            pad = min(self._padding[channel], frames)
+            if pad:
+                # 欠けた分だけこのチャンネルを無音にして、もう一方のトラックとの位置を保つ
+                self._scratch[:pad] = self._silence[:pad]
+                self._padding[channel] -= pad
+            if _read_full(source, self._scratch_view[pad * SAMPLE_WIDTH:]) < (frames - pad) * SAMPLE_WIDTH:
+                return 0
+            self._interleaved[channel::self.channels] = self._scratch
+        size = frames * SAMPLE_WIDTH * self.channels
+        buffer[:size] = self._interleaved_view
+        return size
+
+    def _align(self):
+        """各ソースに届いたフレーム数の差だけ、早く始まったソースの先頭を捨てる"""
+        # 最初のチャンクを並行して読み、すべてのソースが音声を送り始めるまで待つ（読んだ分は捨てる）
+        started = [False] * self.channels
+
+        def first_chunk(channel):
+            chunk = bytearray(self._frames * SAMPLE_WIDTH)
+            started[channel] = _read_full(self.sources[channel], chunk) == len(chunk)
+
+        threads = [threading.Thread(target=first_chunk, args=(channel,), daemon=True)
+                   for channel in range(self.channels)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if not all(started):
+            return False
+        if not all(hasattr(source, 'pending_frames') for source in self.sources):
+            logger.info("届いたフレーム数を数えられないソースのため、2トラックの開始を揃えずに録音します")
+            return True
+
+        # 届いたフレーム数を何度も測って平均する。測るたびに溜まった分を読み捨て、
+        # パイプが詰まってソースが止まらないようにする（待たずに読める分だけなのでブロックしない）
+        totals = [0] * self.channels
+        samples = 0
+        deadline = time.monotonic() + DUAL_ALIGN_MEASURE_SECONDS
+        while time.monotonic() < deadline:
+            pending = [source.pending_frames() for source in self.sources]
+            for channel, source in enumerate(self.sources):
+                totals[channel] += source.frames_read + pending[channel]
+            samples += 1
+            for source, frames in zip(self.sources, pending):
+                if not self._skip(source, frames):
+                    return False
+            time.sleep(DUAL_ALIGN_MEASURE_INTERVAL)
+        # 読み出しを進めても届いたフレーム数は変わらないため、平均の差がそのまま開始のずれになる。
+        # 読み出した位置の差がこのずれと等しくなるよう、遅れている側を読み捨てる
+        leads = [(total - min(totals)) / samples for total in totals]
+        if max(leads) > DUAL_ALIGN_MAX_SECONDS * self.rate:
+            logger.warning(f"2トラックの開始のずれが大きすぎるため、揃えずに録音します: {max(leads) / self.rate:.2f}秒")
+            return True
+        positions = [source.frames_read - lead for source, lead in zip(self.sources, leads)]
+        for source, position in zip(self.sources, positions):
+            if not self._skip(source, round(max(positions) - position)):
+                return False
+        logger.info(f"2トラックの開始のずれを揃えました: {max(leads) / self.rate * 1000:.0f}ms")
+        return True
+
+    def _skip(self, source, frames):
+        """ソースからフレームを読み捨てる（ソースが終了したらFalse）"""
+        while frames:
+            size = min(frames, self._frames) * SAMPLE_WIDTH
+            if _read_full(source, self._scratch_view[:size]) < size:
+                return False
+            frames -= size // SAMPLE_WIDTH
+        return True
+
+    def interrupt(self):
+        """別スレッドからすべてのソースの読み出しを終わらせる"""
+        for source in self.sources:
+            source.interrupt()
+
+    def close(self):
+        """すべてのソースを閉じる"""
+        for source in self.sources:
+            source.close()
+
+
+def _read_full(source, buffer):
+    """bufferが埋まるまでソースから読む（ソースが終了したら読めた分だけ）"""
+    view = memoryview(buffer)
+    filled = 0
+    while filled < len(buffer):
+        size = source.read_into(view[filled:])
+        if not size:
+            break
+        filled += size
+    return filled
+
+
+def dual_source_factory(source_factory):
+    """(ソース名の組, rate, channels) から DualSource を作る source_factory を返す"""
+    def factory(source_names, rate, channels):
+        sources = []
+        try:
+            for name in source_names:
+                sources.append(source_factory(name, rate, 1))
+        except Exception:
+            for source in sources:
+                source.close()
+            raise
+        return DualSource(sources)
+    factory.source_factory = source_factory
+    return factory
+
+
+class PipeEncoder:
+    """標準入力から受け取ったPCMをffmpegでエンコードしてファイルに書き出す"""
+
+    def __init__(self, filename, rate, channels, codec_args):
+        cmd = [
+            'ffmpeg',
+            '-f', 's16le',
+            '-ar', str(rate),
+            '-ac', str(channels),
+            '-i', 'pipe:0',
+            *codec_args,
+            # Oggページができるたびに書き出す（ライブ配信が録音中のファイルを追従できるように）
+            '-flush_packets', '1',
+            '-y',
+            filename
+        ]
+        logger.info(f"エンコーダー起動: {' '.join(cmd)}")
+        self.started = time.monotonic()
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def write(self, data):
+        """PCMを書き込む"""
+        self.process.stdin.write(data)
+
+    def poll(self):
+        """プロセスの終了コード（実行中はNone）"""
+        return self.process.poll()
+
+    def close(self, timeout=10):
+        """入力を閉じ、ファイルが確定するまで待つ"""
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.process.terminate()
+            self.process.wait(timeout=5)
+        finally:
+            if self.process.returncode is not None:
+                observe_command('ffmpeg', time.monotonic() - self.started, self.process.returncode)
+
+
+class SoundFileEncoder:
+    """libsndfileでOGG（既定はVorbis）にプロセス内でエンコードする"""
+
+    def __init__(self, filename, rate, channels, subtype='VORBIS'):
+        if soundfile is None:
+            raise RuntimeError("soundfileがインストールされていません")
+        self.channels = channels
+        self._file = soundfile.SoundFile(filename, 'w', samplerate=rate, channels=channels,
+                                         format='OGG', subtype=subtype)
+        self._error = None
+
+    def write(self, data):
+        """PCMを書き込む"""
+        try:
+            self._file.buffer_write(data, dtype='int16')
+        except Exception as e:
+            self._error = e
+            raise OSError(f"エンコードに失敗しました: {e}") from e
+
+    def poll(self):
+        """エラーで停止していれば1、動作中はNone"""
+        return 1 if self._error else None
+
+    def close(self, timeout=None):
+        """ファイルを確定する"""
+        self._file.close()
+
+
+class SegmentedEncoder:
+    """一定時間・一定サイズごとに新しいファイルへ切り替えるエンコーダー
+
+    open_encoder(ファイル名) でセグメントごとのエンコーダーを開く。切り替えは
+    チャンクの境目で行い、次のエンコーダーを開いてから書き込み先を移すため、
+    セグメント間で音声が欠けない。古いエンコーダーの終了は別スレッドで待つ。
+    """
+
+    def __init__(self, open_encoder, path_for, rate, channels, segment_seconds=0, segment_bytes=0):
+        self.open_encoder = open_encoder
+        self.path_for = path_for
+        self.segment_pcm_bytes = int(segment_seconds * rate) * SAMPLE_WIDTH * channels
+        self.segment_bytes = segment_bytes
+        # ファイルサイズの確認間隔（PCMで約1秒分）
+        self._size_check_bytes = rate * SAMPLE_WIDTH * channels
+        self._closers = []
+        self.number = 0
+        self._open_next()
+
+    def _open_next(self):
+        self.number += 1
+        self.path = self.path_for(self.number)
+        self._encoder = self.open_encoder(self.path)
+        self._pcm_written = 0
+        self._since_size_check = 0
+
+    def _should_roll(self):
+        if self.segment_pcm_bytes and self._pcm_written >= self.segment_pcm_bytes:
+            return True
+        if self.segment_bytes and self._since_size_check >= self._size_check_bytes:
+            self._since_size_check = 0
+            try:
+                return os.path.getsize(self.path) >= self.segment_bytes
+            except OSError:
+                return False
+        return False
+
+    def write(self, data):
+        """PCMを書き込む（必要なら先に次のセグメントへ切り替える）"""
+        if self._pcm_written and self._should_roll():
+            previous = self._encoder
+            self._open_next()
+            closer = threading.Thread(target=previous.close, daemon=True)
+            closer.start()
+            self._closers = [t for t in self._closers if t.is_alive()] + [closer]
+            logger.info(f"次のセグメントに切り替え: {os.path.basename(self.path)}")
+        self._encoder.write(data)
+        self._pcm_written += len(data)
+        self._since_size_check += len(data)
+
+    def poll(self):
+        """現在のエンコーダーの終了コード（実行中はNone）"""
+        return self._encoder.poll()
+
+    def close(self, timeout=10):
+        """現在のセグメントを閉じ、切り替え済みのセグメントが確定するまで待つ"""
+        self._encoder.close(timeout)
+        for closer in self._closers:
+            closer.join(timeout)
+
+
+class BufferPool:
+    """事前に確保した同じサイズのバッファを使い回すプール"""
+
+    def __init__(self, count, size):
+        self.size = size
+        self._free = collections.deque(bytearray(size) for _ in range(count))
+
+    def acquire(self):
+        """空きバッファを返す（使い切っていればNone）"""
+        try:
+            return self._free.pop()
+        except IndexError:
+            return None
+
+    def release(self, buffer):
+        """バッファをプールに戻す"""
+        self._free.append(buffer)
+
+
+class CapturePipeline:
+    """ソース→バッファプール→上限付きキュー→エンコーダーのキャプチャパイプライン
+
+    キャプチャスレッドはソースから固定サイズのチャンクをプールのバッファに
+    読み込んでキューに積むだけで、エンコードは別スレッドが行う。エンコーダーが
+    遅れてプールを使い切った場合、そのチャンクは破棄して dropped に数える。
+    エンコーダーを接続していない間は、直近 preroll_seconds 秒をリングバッファに
+    保持する（0なら破棄）。
+
+    resolve_source はPulseAudioのソース名を返す関数で、ソースが見つからない
+    間（Bluetooth未接続など）は一定間隔で再試行する。
+    source_factory は (ソース名, rate, channels) からソースを作る。
+    ソースを閉じるのはキャプチャスレッドだけで、stop() はソースの interrupt() で読み出しを終わらせる。
+    """
+
+    def __init__(self, resolve_source, rate, channels, preroll_seconds=0,
+                 source_factory=PulseSource, pool_chunks=POOL_CHUNKS):
+        self.resolve_source = resolve_source
+        self.source_factory = source_factory
+        self.seconds = preroll_seconds
+        self.rate = rate
+        self.channels = channels
+        self.frame_size = SAMPLE_WIDTH * channels
+        self.chunk_size = CHUNK_FRAMES * self.frame_size
+        self._pool = BufferPool(pool_chunks, self.chunk_size)
+        self._queue = queue.Queue(maxsize=pool_chunks)
+        self._ring = RingBuffer(int(preroll_seconds * rate) * self.frame_size, align=self.frame_size)
+        self._lock = threading.Lock()
+        self._encoder = None
+        self._running = False
+        self._capturing = False
+        self._source = None
+        self._overruns_closed = 0
+        self.dropped = 0
+        self.max_queue_depth = 0
+
+    def start(self):
+        """キャプチャスレッドとエンコードスレッドを開始"""
+        self._running = True
+        threading.Thread(target=self._capture_loop, daemon=True).start()
+        threading.Thread(target=self._dispatch_loop, daemon=True).start()
+
+    def stop(self):
+        """キャプチャを停止"""
+        self._running = False
+        source = self._source
+        if source:
+            # 閉じるのはキャプチャスレッド。ここでは読み出しを終わらせるだけ
+            source.interrupt()
+        self._queue.put(None)
+
+    def is_capturing(self):
+        """ソースから音声を受信中か"""
+        return self._capturing
+
+    def is_attached(self, encoder):
+        """エンコーダーが接続されたままか（書き込みエラーで外れていないか）"""
+        return self._encoder is encoder
+
+    def buffered_seconds(self):
+        """リングバッファに保持している音声の長さ（秒）"""
+        with self._lock:
+            return len(self._ring) / (self.rate * self.frame_size)
+
+    def stats(self):
+        """バッファあふれの統計"""
+        source = self._source
+        return {
+            'overruns': self._overruns_closed + (source.overruns if source else 0),
+            'dropped_chunks': self.dropped,
+            'max_queue_depth': self.max_queue_depth
+        }
+
+    def attach(self, encoder):
+        """バッファの音声をエンコーダーに渡し、以降のライブの音声も続けて渡す
+
+        バッファの吐き出しとライブへの切り替えは同じロック内で行うため、
+        境目で音声が欠けたり重複したりしない。渡したプリロールの秒数を返す。
+        """
+        with self._lock:
+            data = self._ring.snapshot()
+            self._ring.clear()
+            if data:
+                encoder.write(data)
+            self._encoder = encoder
+        return len(data) / (self.rate * self.frame_size)
+
+    def detach(self):
+        """エンコーダーへの受け渡しを止め、バッファリングのみに戻る
+
+        キューに残っている音声を書き終えてから外す。
+        """
+        deadline = time.time() + 5
+        while self._queue.qsize() and time.time() < deadline:
+            time.sleep(0.01)
+        with self._lock:
+            self._encoder = None
+
+    def _capture_loop(self):
+        scratch = bytearray(self.chunk_size)
+        while self._running:
+            source_name = self.resolve_source()
+            if not source_name:
+                time.sleep(2)
+                continue
+
+            logger.info(f"キャプチャを開始: {source_name} (プリロール {self.seconds}秒)")
+            try:
+                self._source = self.source_factory(source_name, self.rate, self.channels)
+            except Exception as e:
+                logger.error(f"ソースを開けません: {e}")
+                time.sleep(2)
+                continue
+            self._capturing = True
+            try:
+                while self._running:
+                    buffer = self._pool.acquire()
+                    if buffer is None:
+                        # エンコーダーが追いついていない。ソースは止めずに読み捨てる
+                        if not self._source.read_into(scratch):
+                            break
+                        self.dropped += 1
+                        continue
+                    size = self._source.read_into(buffer)
+                    if not size:
+                        self._pool.release(buffer)
+                        if self._running:
+                            logger.warning("キャプチャが終了しました。再接続します")
+                        break
+                    self._queue.put((buffer, size))
+                    self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+            finally:
+                self._capturing = False
+                self._overruns_closed += self._source.overruns
+                self._source.close()
+                self._source = None
+            time.sleep(1)
+
+    def _dispatch_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            buffer, size = item
+            chunk = memoryview(buffer)[:size]
+            with self._lock:
+                if self._encoder is None:
+                    self._ring.write(chunk)
+                else:
+                    try:
+                        self._encoder.write(chunk)
+                    except (OSError, ValueError) as e:
+                        logger.error(f"エンコーダーへの書き込みに失敗: {e}")
+                        self._encoder = None
+            chunk.release()
+            self._pool.release(buffer)
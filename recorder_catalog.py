@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+録音ファイルのカタログ（SQLite）
+ファイル名・サイズ・長さ・デバイス・開始時刻・コーデックを記録し、
+一覧APIはディレクトリを走査せずにページ単位で問い合わせる。
+
+ワーカーは録音を終えるたびに add() で登録し、Webサーバーは起動時に
+sync() でディレクトリとの差分（追加・変更・削除されたファイル）だけを反映する。
+長さとコーデックはOGGのヘッダーと最後のページのgranule位置から求めるため、
+ffprobeなどの外部コマンドは使わない。
+"""
+
+import logging
+import os
+import re
+import sqlite3
+import struct
+import threading
+from datetime import datetime
+
+# カタログに載せる拡張子
+RECORDING_EXTENSIONS = ('.ogg',)
+# 書き込みが競合したときに待つ時間（秒）。ワーカーとWebサーバーが同じDBを使う
+BUSY_TIMEOUT = 10
+# 長さを求めるときにファイル末尾から読む量
+OGG_TAIL_SIZE = 64 * 1024
+
+OGG_HEADER = struct.Struct('<4sBBqIIIB')
+FILENAME_TIME = re.compile(r'recording_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})')
+SEGMENT_SUFFIX = re.compile(r'_\d{3,}\.ogg$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (
+    filename TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    duration REAL,
+    started_at REAL,
+    device_mac TEXT,
+    device_name TEXT,
+    codec TEXT
+);
+CREATE INDEX IF NOT EXISTS recordings_started_at ON recordings (started_at DESC);
+CREATE INDEX IF NOT EXISTS recordings_device ON recordings (device_mac, started_at DESC);
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def ogg_info(path):
+    """OGGファイルの (コーデック, 長さ秒) を返す（判別できなければ None）"""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(4096)
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - OGG_TAIL_SIZE))
+            tail = f.read()
+    except OSError:
+        return None, None
+    if len(head) < OGG_HEADER.size or not head.startswith(b'OggS'):
+        return None, None
+
+    segments = head[OGG_HEADER.size - 1]
+    packet = head[OGG_HEADER.size + segments:]
+    if packet.startswith(b'\x01vorbis') and len(packet) >= 16:
+        codec, rate = 'vorbis', struct.unpack_from('<I', packet, 12)[0]
+        pre_skip = 0
+    elif packet.startswith(b'OpusHead') and len(packet) >= 12:
+        # Opusのgranule位置は常に48kHz。先頭のpre-skip分は再生されない
+        codec, rate = 'opus', 48000
+        pre_skip = struct.unpack_from('<H', packet, 10)[0]
+    elif packet.startswith(b'\x7fFLAC') and len(packet) >= 30:
+        # Ogg FLAC: 先頭パケットのSTREAMINFOの20ビットがサンプリングレート
+        codec, rate = 'flac', (packet[27] << 12) | (packet[28] << 4) | (packet[29] >> 4)
+        pre_skip = 0
+    else:
+        return None, None
+
+    # 最後のページから順にさかのぼり、granule位置が入っているページを探す
+    position = len(tail)
+    while True:
+        position = tail.rfind(b'OggS', 0, position)
+        if position < 0:
+            return codec, None
+        if len(tail) - position < OGG_HEADER.size:
+            continue
+        _, version, _, granule, _, _, _, _ = OGG_HEADER.unpack_from(tail, position)
+        # 音声データ中に偶然現れた 'OggS' はバージョンで除外する
+        if version == 0 and granule >= 0:
+            return codec, max(0.0, (granule - pre_skip) / rate) if rate else None
+
+
+def started_at_from_file(filename, mtime, duration):
+    """開始時刻を推定する（ファイル名の日時、なければ更新時刻から長さを引く）"""
+    match = FILENAME_TIME.search(filename)
+    if match and not SEGMENT_SUFFIX.search(filename):
+        return datetime.strptime(match.group(1), '%Y-%m-%d_%H-%M-%S').timestamp()
+    # 分割録音のセグメントは閉じた時刻から長さをさかのぼる
+    return mtime - (duration or 0)
+
+
+class RecordingCatalog:
+    """録音ファイルのカタログ（スレッドごとに接続を持つ）"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._sync_lock = threading.Lock()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+            conn.row_factory = sqlite3.Row
+            # ワーカーの書き込み中もWebサーバーの読み出しを止めない
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def add(self, path, device=None, started_at=None, duration=None, codec=None):
+        """録音ファイルを登録（更新）する。長さとコーデックは省略時にファイルから求める"""
+        stat = os.stat(path)
+        filename = os.path.basename(path)
+        if duration is None or codec is None:
+            probed_codec, probed_duration = ogg_info(path)
+            codec = codec or probed_codec
+            duration = duration if duration is not None else probed_duration
+        estimated_start = started_at_from_file(filename, stat.st_mtime, duration)
+        device = device or {}
+        conn = self._connect()
+        with conn:
+            # デバイスと開始時刻は、渡されなかった場合（ディレクトリ走査での更新）は既存の値を残す
+            conn.execute("""
+                INSERT INTO recordings (filename, size, mtime, duration, started_at, device_mac, device_name, codec)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (filename) DO UPDATE SET
+                    size = excluded.size,
+                    mtime = excluded.mtime,
+                    duration = excluded.duration,
+                    codec = excluded.codec,
+                    started_at = COALESCE(?, recordings.started_at, excluded.started_at),
+                    device_mac = COALESCE(excluded.device_mac, recordings.device_mac),
+                    device_name = COALESCE(excluded.device_name, recordings.device_name)
+            """, (filename, stat.st_size, stat.st_mtime, duration, started_at or estimated_start,
+                  device.get('mac'), device.get('name'), codec, started_at))
+
+    def remove(self, filename):
+        """録音ファイルの登録を削除する"""
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM recordings WHERE filename = ?', (filename,))
+
+    def sync(self, recordings_dir):
+        """ディレクトリとの差分を反映し、(追加・更新数, 削除数) を返す"""
+        with self._sync_lock:
+            conn = self._connect()
+            known = {row['filename']: (row['size'], row['mtime'])
+                     for row in conn.execute('SELECT filename, size, mtime FROM recordings')}
+            changed = 0
+            present = set()
+            try:
+                entries = list(os.scandir(recordings_dir))
+            except FileNotFoundError:
+                entries = []
+            for entry in entries:
+                if not entry.name.endswith(RECORDING_EXTENSIONS) or not entry.is_file():
+                    continue
+                present.add(entry.name)
+                stat = entry.stat()
+                if known.get(entry.name) != (stat.st_size, stat.st_mtime):
+                    try:
+                        self.add(entry.path)
+                        changed += 1
+                    except OSError as e:
+                        logger.warning(f"カタログに登録できません: {entry.name} {e}")
+            removed = [name for name in known if name not in present]
+            with conn:
+                conn.executemany('DELETE FROM recordings WHERE filename = ?', [(name,) for name in removed])
+            if changed or removed:
+                logger.info(f"録音カタログを更新しました: 追加・更新 {changed}件, 削除 {len(removed)}件")
+            return changed, len(removed)
+
+    def query(self, limit=10, offset=0, device=None, since=None, until=None):
+        """新しい順に1ページ分を返す: (項目のリスト, 条件に合う総数)
+
+        device はMACアドレスまたはデバイス名、since/until は開始時刻（UNIX時間）の範囲。
+        """
+        conditions = []
+        params = []
+        if device:
+            conditions.append('(device_mac = ? OR device_name = ?)')
+            params += [device, device]
+        if since is not None:
+            conditions.append('started_at >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('started_at < ?')
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        conn = self._connect()
+        total = conn.execute(f'SELECT COUNT(*) FROM recordings {where}', params).fetchone()[0]
+        rows = conn.execute(
+            f'SELECT filename, size, duration, started_at, device_mac, device_name, codec '
+            f'FROM recordings {where} ORDER BY started_at DESC, filename DESC LIMIT ? OFFSET ?',
+            params + [limit, offset])
+        return [dict(row) for row in rows], total
+
+    def close(self):
+        """このスレッドの接続を閉じる"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
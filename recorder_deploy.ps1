@@ -21,6 +21,21 @@ switch ($Action) {
         Write-Host "Downloading Python files..." -ForegroundColor Yellow
         scp ${User}@${RaspberryPiIP}:~/recorder_web.py ./
         scp ${User}@${RaspberryPiIP}:~/recorder_worker.py ./
+        scp ${User}@${RaspberryPiIP}:~/recorder_ipc.py ./
+        scp ${User}@${RaspberryPiIP}:~/recorder_bluez.py ./
+        scp ${User}@${RaspberryPiIP}:~/recorder_capture.py ./
+        scp ${User}@${RaspberryPiIP}:~/recorder_segments.py ./
+        scp ${User}@${RaspberryPiIP}:~/recorder_live.py ./
+        scp ${User}@${RaspberryPiIP}:~/recorder_catalog.py ./
+        scp ${User}@${RaspberryPiIP}:~/recorder_jobs.py ./
+        scp ${User}@${RaspberryPiIP}:~/recorder_waveform.py ./
+        scp ${User}@${RaspberryPiIP}:~/recorder_silence.py ./
+        scp ${User}@${RaspberryPiIP}:~/recorder_schedule.py ./
+        scp ${User}@${RaspberryPiIP}:~/recorder_metrics.py ./
+        scp ${User}@${RaspberryPiIP}:~/recorder_executor.py ./
+        scp ${User}@${RaspberryPiIP}:~/recorder_supervisor.py ./
+        scp ${User}@${RaspberryPiIP}:~/recorder_sessions.py ./
+        scp ${User}@${RaspberryPiIP}:~/recorder_presets.py ./
         
         Write-Host "Download completed!" -ForegroundColor Green
     }
@@ -29,7 +44,7 @@ switch ($Action) {
         Write-Host "Uploading files to Raspberry Pi..." -ForegroundColor Green
         
         # Pythonファイルとテンプレートをアップロード
-        scp -r templates recorder_web.py recorder_worker.py ${User}@${RaspberryPiIP}:~/
+        scp -r templates recorder_web.py recorder_worker.py recorder_ipc.py recorder_bluez.py recorder_capture.py recorder_segments.py recorder_live.py recorder_catalog.py recorder_jobs.py recorder_waveform.py recorder_silence.py recorder_schedule.py recorder_metrics.py recorder_executor.py recorder_supervisor.py recorder_sessions.py recorder_presets.py ${User}@${RaspberryPiIP}:~/
         
         # サービスファイルがあればアップロード
         if (Test-Path "./recorder.service") {
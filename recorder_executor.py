@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+遅い処理（外部コマンド）をリクエストのスレッドから切り離して実行する
+Wi-Fiのスキャンやbluetoothctlでのデバイス一覧の取得は数秒かかるため、
+上限付きのスレッドで実行し、リクエスト側は決まった時間だけ結果を待つ。
+
+同じキーの処理が実行中なら新しく始めずにその結果を共有する（同時に来た
+/get_devices は1回のスキャンで済む）。待ちきれなかった処理もそのまま続き、
+次のリクエストはその結果を待つ。待ちが max_pending を超えたら ExecutorBusy。
+"""
+
+import concurrent.futures
+import logging
+import threading
+
+from recorder_metrics import SLOW_CALLS
+
+# 遅い処理を同時に実行するスレッド数（Pi Zeroは1コアのため少なくする）
+SLOW_CALL_WORKERS = 2
+# 実行中・待ちの処理の上限（種類ごとに1つなので、これを超えるのは異常な場合のみ）
+SLOW_CALL_MAX_PENDING = 8
+
+# 結果を待ちきれなかったときの例外（Python 3.11より前は組み込みのTimeoutErrorと別）
+CallTimeout = concurrent.futures.TimeoutError
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutorBusy(Exception):
+    """待ちの処理が多すぎて受け付けられない"""
+
+
+class CoalescingExecutor:
+    """同じキーの処理をまとめる、上限付きのスレッドプール"""
+
+    def __init__(self, max_workers=SLOW_CALL_WORKERS, max_pending=SLOW_CALL_MAX_PENDING):
+        self.max_pending = max_pending
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='slow-call')
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def submit(self, key, fn, *args, **kwargs):
+        """処理を始め（同じキーが実行中ならそれを使い）、Futureを返す"""
+        name = key[0] if isinstance(key, tuple) else key
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                SLOW_CALLS.inc(call=name, result='coalesced')
+                return future
+            if len(self._futures) >= self.max_pending:
+                SLOW_CALLS.inc(call=name, result='rejected')
+                raise ExecutorBusy(f"処理が混み合っています: {name}")
+            future = self._pool.submit(fn, *args, **kwargs)
+            self._futures[key] = future
+            SLOW_CALLS.inc(call=name, result='started')
+        future.add_done_callback(lambda done: self._forget(key, done))
+        return future
+
+    def run(self, key, fn, *args, timeout=None, **kwargs):
+        """処理の結果を timeout 秒まで待って返す（間に合わなければ CallTimeout、処理は続く）"""
+        future = self.submit(key, fn, *args, **kwargs)
+        try:
+            return future.result(timeout)
+        except CallTimeout:
+            name = key[0] if isinstance(key, tuple) else key
+            SLOW_CALLS.inc(call=name, result='timeout')
+            logger.warning(f"処理が{timeout}秒以内に終わりませんでした（バックグラウンドで続行）: {name}")
+            raise
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._futures.get(key) is future:
+                del self._futures[key]
+
+    def shutdown(self):
+        """待ちの処理を取り消して終了する（実行中のものは待たない）"""
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+"""
+Webサーバーと録音ワーカー間の通信
+コマンドバス: Unixドメインソケット上で改行区切りのJSONをやり取りする。
+コマンドにはシーケンス番号を付け、ワーカーは受信時にack、処理後にreplyを返す。
+subscribeしたクライアントには、ワーカーの状態が変わるたびにステータスを配信する。
+ステータス領域: tmpfs上の共有メモリに最新のステータスとハートビートを置く。
+"""
+
+import itertools
+import json
+import logging
+import mmap
+import os
+import queue
+import socket
+import struct
+import tempfile
+import threading
+import time
+import uuid
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# コマンド受付用のソケット
+COMMAND_SOCKET = os.path.join(APP_ROOT, "recorder_command.sock")
+
+# 1メッセージの最大サイズ（バイト）
+MAX_MESSAGE_SIZE = 64 * 1024
+
+# 状態に変化がなくてもステータスを再送する間隔（秒）
+STATUS_KEEPALIVE_INTERVAL = 5.0
+
+
+def _default_runtime_dir():
+    """永続ストレージに書き込まないtmpfsのディレクトリを返す"""
+    for path in ('/dev/shm', os.environ.get('XDG_RUNTIME_DIR')):
+        if path and os.path.isdir(path) and os.access(path, os.W_OK):
+            return path
+    return tempfile.gettempdir()
+
+
+# ステータス共有領域（SDカードを消耗しないようtmpfs上に置く）
+# RECORDER_STATUS_SEGMENT で別の場所を指定すると、同じユーザーで別の環境（ベンチマークなど）を並行して動かせる
+STATUS_SEGMENT = (os.environ.get('RECORDER_STATUS_SEGMENT')
+                  or os.path.join(_default_runtime_dir(), f"recorder_status_{os.getuid()}"))
+STATUS_SEGMENT_SIZE = 64 * 1024
+# ワーカーのメトリクス（recorder_metrics）を公開する領域
+METRICS_SEGMENT = STATUS_SEGMENT + '_metrics'
+METRICS_SEGMENT_SIZE = 256 * 1024
+
+# ヘッダー: マジック, バージョン(奇数は書き込み中), ハートビート, PID, ペイロード長
+_SEGMENT_HEADER = struct.Struct('<4sIdII')
+_SEGMENT_MAGIC = b'RSTS'
+_VERSION_OFFSET = 4
+_HEARTBEAT_OFFSET = 8
+
+logger = logging.getLogger(__name__)
+
+
+class CommandBusError(Exception):
+    """コマンドバスの通信エラー"""
+
+
+def _send_message(sock, message):
+    """1件のメッセージを送信"""
+    sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+
+class CommandServer:
+    """ワーカー側のコマンド受付サーバー
+
+    接続ごとのスレッドがコマンドを受信してackを返し、キューに積む。
+    キューは dispatch() を呼ぶスレッドで1件ずつ順番に処理されるため、
+    開始→停止のような連続したコマンドも順序通りに実行される。
+    """
+
+    def __init__(self, handler, path=COMMAND_SOCKET):
+        self.handler = handler
+        self.path = path
+        self._queue = queue.Queue()
+        self._sock = None
+        self._running = False
+        # クライアントごとの最新のreply（再送時の二重実行防止）
+        self._last_replies = {}
+        # キューに積んだ・実行中のコマンドの (client, seq) → replyの送り先の一覧
+        self._pending = {}
+        self._replies_lock = threading.Lock()
+        # 配信中の最新ステータス
+        self._status = None
+        self._status_version = 0
+        self._status_cond = threading.Condition()
+
+    def start(self):
+        """ソケットを作成して受付スレッドを開始"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self._sock.listen(8)
+        self._running = True
+        thread = threading.Thread(target=self._accept_loop, daemon=True)
+        thread.start()
+        logger.info(f"コマンドソケットを開きました: {self.path}")
+
+    def close(self):
+        """ソケットを閉じる"""
+        self._running = False
+        if self._sock:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                break
+            thread = threading.Thread(target=self._serve_connection, args=(conn,), daemon=True)
+            thread.start()
+
+    def _serve_connection(self, conn):
+        """1接続分のコマンドを受信する"""
+        send_lock = threading.Lock()
+
+        def reply(message):
+            with send_lock:
+                try:
+                    _send_message(conn, message)
+                except OSError:
+                    pass
+
+        try:
+            with conn, conn.makefile('rb') as reader:
+                for line in reader:
+                    if len(line) > MAX_MESSAGE_SIZE:
+                        reply({'type': 'error', 'message': 'メッセージが大きすぎます'})
+                        continue
+                    try:
+                        command = json.loads(line)
+                    except json.JSONDecodeError:
+                        reply({'type': 'error', 'message': '不正なメッセージです'})
+                        continue
+
+                    if command.get('action') == 'subscribe':
+                        # 以降この接続はステータス配信専用になる
+                        self._stream_status(conn)
+                        return
+
+                    seq = command.get('seq')
+                    client = command.get('client')
+                    state, cached = self._register(client, seq, reply)
+                    if state == 'done':
+                        # 再送されたコマンドは実行せず、前回のreplyを返す
+                        reply({'seq': seq, 'type': 'ack'})
+                        reply(cached)
+                        continue
+                    if state == 'pending':
+                        # 元のコマンドがまだキューにある・実行中なので、その完了時にreplyを返す
+                        reply({'seq': seq, 'type': 'ack'})
+                        continue
+
+                    reply({'seq': seq, 'type': 'ack', 'received_at': time.time()})
+                    self._queue.put((command, reply))
+        except OSError:
+            pass
+
+    def publish_status(self, status):
+        """購読中のクライアントに最新のステータスを配信する"""
+        with self._status_cond:
+            self._status = dict(status)
+            self._status_version += 1
+            self._status_cond.notify_all()
+
+    def _stream_status(self, conn):
+        """購読クライアントに、ステータスが更新されるたびに最新版を送る
+
+        送信が詰まっても古い版は捨てて最新版だけを送るため、
+        購読者ごとのメモリは一定に保たれる。
+        """
+        # 受信側が応答しなくなった場合にスレッドが止まり続けないようにする
+        conn.settimeout(STATUS_KEEPALIVE_INTERVAL)
+        sent_version = 0
+        while self._running:
+            with self._status_cond:
+                if self._status_version == sent_version:
+                    self._status_cond.wait(STATUS_KEEPALIVE_INTERVAL)
+                version = self._status_version
+                status = self._status
+            if status is None:
+                continue
+            try:
+                # 変化がなければ同じ版をキープアライブとして再送する
+                _send_message(conn, {'type': 'status', 'version': version, 'status': status})
+            except OSError:
+                return
+            sent_version = version
+
+    def _register(self, client, seq, reply):
+        """受信したコマンドを記録し、(状態, 前回のreply) を返す
+
+        状態は 'done'（処理済みの再送）, 'pending'（キューにある・実行中のコマンドの再送）,
+        'new'（新しいコマンド）。再送は元のコマンドのreplyを受け取るよう送り先に加える。
+        """
+        if client is None:
+            return 'new', None
+        with self._replies_lock:
+            cached = self._last_replies.get(client)
+            if cached and cached.get('seq') == seq:
+                return 'done', cached
+            waiting = self._pending.get((client, seq))
+            if waiting is not None:
+                waiting.append(reply)
+                return 'pending', None
+            self._pending[(client, seq)] = [reply]
+        return 'new', None
+
+    def dispatch(self, timeout=None):
+        """キューに溜まったコマンドを処理する。timeoutまでコマンドを待つ"""
+        try:
+            command, reply = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while True:
+            self._execute(command, reply)
+            try:
+                command, reply = self._queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def _execute(self, command, reply):
+        seq = command.get('seq')
+        try:
+            success, message = self.handler(command)
+        except Exception as e:
+            logger.error(f"コマンド処理エラー: {e}")
+            success, message = False, str(e)
+        result = {'seq': seq, 'type': 'reply', 'success': success, 'message': message}
+        client = command.get('client')
+        replies = [reply]
+        if client is not None:
+            with self._replies_lock:
+                self._last_replies[client] = result
+                replies = self._pending.pop((client, seq), replies)
+        # 実行中に再送された接続にも同じreplyを返す（切断済みの接続への送信は無視される）
+        for send in replies:
+            send(result)
+
+
+class CommandClient:
+    """Webサーバー側のコマンド送信クライアント"""
+
+    def __init__(self, path=COMMAND_SOCKET):
+        self.path = path
+        self.client_id = uuid.uuid4().hex
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+        self._sock = None
+        self._reader = None
+
+    def _connect(self, timeout):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(self.path)
+        self._sock = sock
+        self._reader = sock.makefile('rb')
+
+    def close(self):
+        """接続を閉じる"""
+        if self._reader:
+            self._reader.close()
+            self._reader = None
+        if self._sock:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+    def _read_message(self, seq):
+        """指定したシーケンス番号のメッセージを1件読む"""
+        while True:
+            line = self._reader.readline()
+            if not line:
+                raise CommandBusError("ワーカーとの接続が切断されました")
+            message = json.loads(line)
+            if message.get('seq') == seq:
+                return message
+            if message.get('type') == 'error':
+                raise CommandBusError(message.get('message'))
+
+    def send(self, command, timeout=5.0):
+        """コマンドを送信し、ワーカーのreplyを返す
+
+        ackが返った時点でワーカーが受信したことが保証され、
+        replyはコマンドの処理結果（success, message）を含む。
+        """
+        with self._lock:
+            message = dict(command, seq=next(self._seq), client=self.client_id)
+            # 切断されていた場合は1回だけ再接続して同じseqで再送する
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect(timeout)
+                    self._sock.settimeout(timeout)
+                    sent_at = time.monotonic()
+                    _send_message(self._sock, message)
+                    ack = self._read_message(message['seq'])
+                    acked_at = time.monotonic()
+                    if ack.get('type') == 'ack':
+                        reply = self._read_message(message['seq'])
+                    else:
+                        reply = ack
+                    reply['ack_latency'] = acked_at - sent_at
+                    reply['reply_latency'] = time.monotonic() - sent_at
+                    return reply
+                except (OSError, ValueError, CommandBusError) as e:
+                    self.close()
+                    if attempt == 1:
+                        raise CommandBusError(f"コマンド送信に失敗しました: {e}") from e
+
+
+class StatusSubscriber:
+    """ワーカーのステータス配信を購読し、受信のたびにコールバックを呼ぶ
+
+    ワーカーが停止している間は接続を再試行し、切断時は None を通知する。
+    """
+
+    def __init__(self, callback, path=COMMAND_SOCKET, retry_interval=1.0):
+        self.callback = callback
+        self.path = path
+        self.retry_interval = retry_interval
+        self._running = False
+
+    def start(self):
+        """購読スレッドを開始"""
+        self._running = True
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def stop(self):
+        """購読を停止"""
+        self._running = False
+
+    def _run(self):
+        while self._running:
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    # キープアライブが途絶えたら切断とみなす
+                    sock.settimeout(STATUS_KEEPALIVE_INTERVAL * 2)
+                    sock.connect(self.path)
+                    _send_message(sock, {'action': 'subscribe'})
+                    with sock.makefile('rb') as reader:
+                        for line in reader:
+                            if not self._running:
+                                return
+                            message = json.loads(line)
+                            if message.get('type') == 'status':
+                                self.callback(message['status'])
+            except (OSError, ValueError):
+                pass
+            self.callback(None)
+            time.sleep(self.retry_interval)
+
+
+class StatusSegment:
+    """共有メモリ上のステータス領域
+
+    書き込みはワーカーのみが行う。バージョンカウンターを奇数にしてから
+    ペイロードを書き、偶数に戻すことで公開する（seqlock）。読み出し側は
+    前後でバージョンが一致し、かつ偶数の場合だけ内容を採用するため、
+    書き込み途中の不完全なステータスを読むことはない。
+    ハートビートはペイロードとは独立して更新される。
+    """
+
+    def __init__(self, path=STATUS_SEGMENT, size=STATUS_SEGMENT_SIZE):
+        self.path = path
+        self.size = size
+        self._mm = None
+        self._cached_version = None
+        self._cached_status = None
+        self._read_lock = threading.Lock()
+
+    # --- 書き込み側（ワーカー） ---
+
+    def create(self):
+        """領域を作成（既存の場合は再利用）して書き込み用に開く"""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size != self.size:
+                os.ftruncate(fd, self.size)
+            self._mm = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        magic, version, _, _, _ = _SEGMENT_HEADER.unpack_from(self._mm, 0)
+        if magic != _SEGMENT_MAGIC or version % 2:
+            # 新規作成、または書き込み途中でワーカーが落ちた領域
+            _SEGMENT_HEADER.pack_into(self._mm, 0, _SEGMENT_MAGIC, version + (version % 2), 0.0, 0, 0)
+        return self
+
+    def publish(self, status):
+        """ステータスを公開する"""
+        payload = json.dumps(status).encode('utf-8')
+        if len(payload) > self.size - _SEGMENT_HEADER.size:
+            raise ValueError(f"ステータスが大きすぎます: {len(payload)} bytes")
+        _, version, heartbeat, _, _ = _SEGMENT_HEADER.unpack_from(self._mm, 0)
+        struct.pack_into('<I', self._mm, _VERSION_OFFSET, version + 1)
+        self._mm[_SEGMENT_HEADER.size:_SEGMENT_HEADER.size + len(payload)] = payload
+        _SEGMENT_HEADER.pack_into(self._mm, 0, _SEGMENT_MAGIC, version + 1, time.time(), os.getpid(), len(payload))
+        struct.pack_into('<I', self._mm, _VERSION_OFFSET, version + 2)
+
+    def heartbeat(self):
+        """生存を知らせるタイムスタンプだけを更新する"""
+        struct.pack_into('<d', self._mm, _HEARTBEAT_OFFSET, time.time())
+
+    # --- 読み出し側（Webサーバー） ---
+
+    def _open_reader(self):
+        if not os.path.exists(self.path):
+            return False
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            if os.fstat(fd).st_size < self.size:
+                return False
+            self._mm = mmap.mmap(fd, self.size, prot=mmap.PROT_READ)
+        finally:
+            os.close(fd)
+        return True
+
+    def read(self, retries=100):
+        """(status, heartbeat, pid) を返す。領域がなければ None
+
+        バージョンが前回と同じならペイロードの解析を省略する。
+        """
+        with self._read_lock:
+            if self._mm is None and not self._open_reader():
+                return None
+            return self._read_locked(retries)
+
+    def _read_locked(self, retries):
+        for _ in range(retries):
+            magic, version, heartbeat, pid, length = _SEGMENT_HEADER.unpack_from(self._mm, 0)
+            if magic != _SEGMENT_MAGIC:
+                return None
+            if version % 2:
+                time.sleep(0)
+                continue
+            if version == self._cached_version:
+                return dict(self._cached_status), heartbeat, pid
+            payload = self._mm[_SEGMENT_HEADER.size:_SEGMENT_HEADER.size + length]
+            if struct.unpack_from('<I', self._mm, _VERSION_OFFSET)[0] != version:
+                continue
+            if not length:
+                return None
+            self._cached_version = version
+            self._cached_status = json.loads(payload)
+            return dict(self._cached_status), heartbeat, pid
+        return None
+
+    def close(self):
+        """領域を閉じる（ファイルは次のワーカーが再利用するため残す）"""
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
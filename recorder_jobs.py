@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+録音後の後処理ジョブキュー
+録音が終わったファイルに対して、ラウドネスの正規化・無音区間の削除・
+音声向けの小さなコピー（Opus）の作成などをffmpegで行う。
+
+ジョブはSQLiteに保存するため、再起動しても実行中だったジョブは最初から
+やり直される。ffmpegは nice/ionice で最低優先度にして実行し、録音中は
+set_paused() で実行中のプロセスを一時停止（SIGSTOP）して新しいジョブも始めない。
+"""
+
+import logging
+import os
+import shutil
+import signal
+import sqlite3
+import subprocess
+import threading
+import time
+
+from recorder_metrics import observe_command
+
+# 書き込みが競合したときに待つ時間（秒）。ワーカーとWebサーバーが同じDBを使う
+BUSY_TIMEOUT = 10
+# 1ジョブの最大実行時間（秒、一時停止中は数えない）
+JOB_TIMEOUT = 3 * 60 * 60
+# 失敗時に残すffmpegのエラー出力の長さ
+ERROR_TAIL = 500
+
+# 後処理の種類: (出力ファイルの接尾辞, ffmpegの出力オプション)
+JOB_TYPES = {
+    # EBU R128 に沿ったラウドネスの正規化（loudnormは内部で192kHzになるため48kHzに戻す）
+    'loudnorm': ('.norm.ogg', ['-af', 'loudnorm=I=-16:TP=-1.5:LRA=11', '-ar', '48000',
+                               '-c:a', 'libvorbis', '-q:a', '4']),
+    # 2秒以上続く無音（-50dB以下）を取り除く
+    'trim_silence': ('.trim.ogg', ['-af', 'silenceremove=start_periods=1:start_threshold=-50dB:'
+                                          'stop_periods=-1:stop_duration=2:stop_threshold=-50dB',
+                                   '-c:a', 'libvorbis', '-q:a', '4']),
+    # 会話向けの小さなコピー（モノラル Opus 24kbps）
+    'speech': ('.speech.ogg', ['-ac', '1', '-c:a', 'libopus', '-b:a', '24k', '-application', 'voip']),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    source TEXT NOT NULL,
+    output TEXT NOT NULL,
+    state TEXT NOT NULL,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    run_seconds REAL,
+    paused_seconds REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def low_priority_prefix():
+    """子プロセスを最低優先度（CPU: nice 19, I/O: idleクラス）で起動するためのコマンド"""
+    prefix = []
+    if shutil.which('nice'):
+        prefix += ['nice', '-n', '19']
+    if shutil.which('ionice'):
+        prefix += ['ionice', '-c', '3']
+    return prefix
+
+
+class JobQueue:
+    """永続化された後処理ジョブのキューと、上限付きの実行スレッド群
+
+    Webサーバーからは一覧の参照（jobs()）にだけ使う。
+    on_done(出力ファイルのパス) はジョブが成功したときに呼ばれる。
+    """
+
+    def __init__(self, path, recordings_dir, on_done=None):
+        self.path = path
+        self.recordings_dir = recordings_dir
+        self.on_done = on_done
+        self._local = threading.local()
+        self._cond = threading.Condition()
+        self._paused = False
+        self._running = False
+        self._processes = {}
+        self._threads = []
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, source, kinds):
+        """録音ファイルに後処理ジョブを追加する"""
+        base, _ = os.path.splitext(os.path.basename(source))
+        conn = self._connect()
+        with conn:
+            for kind in kinds:
+                if kind not in JOB_TYPES:
+                    logger.warning(f"不明な後処理です: {kind}")
+                    continue
+                conn.execute('INSERT INTO jobs (kind, source, output, state, created_at) VALUES (?, ?, ?, ?, ?)',
+                             (kind, os.path.basename(source), base + JOB_TYPES[kind][0], 'queued', time.time()))
+        with self._cond:
+            self._cond.notify_all()
+
+    def jobs(self, state=None, limit=50, offset=0):
+        """ジョブの一覧を新しい順に返す: (ジョブのリスト, 総数)"""
+        where, params = ('WHERE state = ?', [state]) if state else ('', [])
+        conn = self._connect()
+        total = conn.execute(f'SELECT COUNT(*) FROM jobs {where}', params).fetchone()[0]
+        rows = conn.execute(f'SELECT * FROM jobs {where} ORDER BY id DESC LIMIT ? OFFSET ?',
+                            params + [limit, offset])
+        jobs = []
+        for row in rows:
+            job = dict(row)
+            # 待ち時間（登録から開始まで）
+            job['wait_seconds'] = (job['started_at'] or time.time()) - job['created_at']
+            jobs.append(job)
+        return jobs, total
+
+    def start(self, workers=1):
+        """実行スレッドを開始する（前回実行中だったジョブは待ちに戻す）"""
+        conn = self._connect()
+        with conn:
+            restarted = conn.execute("UPDATE jobs SET state = 'queued' WHERE state = 'running'").rowcount
+        if restarted:
+            logger.info(f"中断された後処理ジョブを再開します: {restarted}件")
+        self._running = True
+        for _ in range(max(1, workers)):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """実行中のジョブを中断する（次回起動時にやり直す）"""
+        with self._cond:
+            self._running = False
+            for process in self._processes.values():
+                # 出力は一時ファイルで、次回起動時に最初からやり直すため待たずに止める
+                # （ffmpegはフィルター処理中だとSIGTERMになかなか応じない）
+                process.kill()
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(5)
+
+    def set_paused(self, paused):
+        """録音中は実行中のffmpegを一時停止し、新しいジョブも始めない"""
+        with self._cond:
+            if paused == self._paused:
+                return
+            self._paused = paused
+            for process in self._processes.values():
+                self._signal(process, signal.SIGSTOP if paused else signal.SIGCONT)
+            if self._processes:
+                logger.info(f"後処理ジョブを{'一時停止' if paused else '再開'}しました")
+            self._cond.notify_all()
+
+    def _signal(self, process, sig):
+        try:
+            os.kill(process.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def _claim(self):
+        """待ちのジョブを1つ取り出して実行中にする"""
+        conn = self._connect()
+        with conn:
+            row = conn.execute("SELECT * FROM jobs WHERE state = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE jobs SET state = 'running', started_at = ?, attempts = attempts + 1, "
+                         "error = NULL WHERE id = ?", (time.time(), row['id']))
+        return dict(row)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: not self._running or not self._paused, 30)
+                if not self._running:
+                    return
+                if self._paused:
+                    # 一時停止中に待ち時間が切れただけなら、ジョブを取り出さずに待ち直す
+                    continue
+            job = self._claim()
+            if job is None:
+                with self._cond:
+                    self._cond.wait(30)
+                continue
+            self._run(job)
+
+    def _run(self, job):
+        source = os.path.join(self.recordings_dir, job['source'])
+        output = os.path.join(self.recordings_dir, job['output'])
+        tmp_path = output + '.part'
+        _, codec_args = JOB_TYPES[job['kind']]
+        cmd = low_priority_prefix() + ['ffmpeg', '-nostdin', '-v', 'error', '-i', source,
+                                       *codec_args, '-f', 'ogg', '-y', tmp_path]
+        logger.info(f"後処理を開始: {job['kind']} {job['source']}")
+        started = time.time()
+        paused_seconds = 0.0
+        error = None
+        try:
+            process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.PIPE)
+        except OSError as e:
+            process = None
+            error = str(e)
+        if process:
+            with self._cond:
+                self._processes[job['id']] = process
+                if self._paused:
+                    self._signal(process, signal.SIGSTOP)
+            # stderrはパイプが詰まらないよう別スレッドで読む
+            stderr = []
+            reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+            reader.start()
+            while process.poll() is None:
+                time.sleep(0.5)
+                if self._paused:
+                    paused_seconds += 0.5
+                elif time.time() - started - paused_seconds > JOB_TIMEOUT:
+                    process.kill()
+                    error = 'タイムアウトしました'
+            reader.join(5)
+            observe_command('ffmpeg', time.time() - started, 'timeout' if error else process.returncode)
+            with self._cond:
+                self._processes.pop(job['id'], None)
+                interrupted = not self._running
+            if interrupted:
+                # 終了時の中断は失敗にせず、次回起動時にやり直す
+                self._remove(tmp_path)
+                return
+            if process.returncode and not error:
+                error = (b''.join(stderr).decode(errors='replace').strip()[-ERROR_TAIL:]
+                         or f'終了コード {process.returncode}')
+
+        finished = time.time()
+        if not error and os.path.exists(tmp_path):
+            os.replace(tmp_path, output)
+            state = 'done'
+            logger.info(f"後処理が完了: {job['output']} ({finished - started - paused_seconds:.1f}秒)")
+        else:
+            self._remove(tmp_path)
+            state = 'failed'
+            logger.error(f"後処理に失敗: {job['kind']} {job['source']}: {error}")
+        conn = self._connect()
+        with conn:
+            conn.execute('UPDATE jobs SET state = ?, error = ?, finished_at = ?, run_seconds = ?, '
+                         'paused_seconds = ? WHERE id = ?',
+                         (state, error, finished, finished - started - paused_seconds, paused_seconds, job['id']))
+        if state == 'done' and self.on_done:
+            self.on_done(output)
+
+    def _remove(self, path):
+        if os.path.exists(path):
+            os.remove(path)
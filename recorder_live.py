@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+録音中のファイルのライブ配信（/live）
+1つの追従スレッドが録音中のOGGファイルの末尾を読み、Oggページ単位で
+共有のリングバッファに積む。各リスナーはバッファ上の自分の読み出し位置だけを
+持つため、リスナーが増えてもファイルの読み直しやリスナーごとのバッファは発生しない。
+
+途中から聞き始めるリスナーには、ストリームの先頭にあるヘッダーページ
+（Vorbisの識別・コメント・セットアップ）を先に送り、以降はページの境目から送る。
+追従を始めたときにファイルが長くなっていれば、ヘッダーページだけを先頭から読み、
+残りは末尾付近（共有バッファの容量分）から読む。途中から読んだデータは、
+CRCの合うOggページの先頭を探して同期し直してから積む。
+分割録音でファイルが切り替わった場合は、新しいファイルを先頭（ヘッダー）から
+続けて送る（連結されたOggストリームになる）。
+"""
+
+import collections
+import logging
+import os
+import struct
+import threading
+import time
+
+# 共有バッファの容量（128kbpsで約30秒分）
+LIVE_BUFFER_SIZE = 512 * 1024
+# ファイルを読みに行く間隔（秒）
+LIVE_POLL_INTERVAL = 0.25
+# 1回に送る最大バイト数
+LIVE_SEND_SIZE = 64 * 1024
+# リスナーがいなくなってから追従スレッドを止めるまでの時間（秒）
+LIVE_IDLE_TIMEOUT = 5
+# ヘッダーが届くまでリスナーを待たせる最大時間（秒）
+LIVE_HEADER_TIMEOUT = 10
+
+OGG_CAPTURE = b'OggS'
+OGG_HEADER = struct.Struct('<4sBBqIIIB')
+# ページヘッダー内のCRCの位置
+OGG_CRC_OFFSET = 22
+
+
+def _make_crc_table():
+    table = []
+    for index in range(256):
+        crc = index << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04c11db7) if crc & 0x80000000 else (crc << 1)
+        table.append(crc & 0xffffffff)
+    return table
+
+
+_CRC_TABLE = _make_crc_table()
+
+
+def ogg_page_crc(page):
+    """OggページのCRC（ヘッダーのCRC欄を0として計算する）"""
+    crc = 0
+    for index, byte in enumerate(page):
+        if OGG_CRC_OFFSET <= index < OGG_CRC_OFFSET + 4:
+            byte = 0
+        crc = ((crc << 8) & 0xffffffff) ^ _CRC_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+logger = logging.getLogger(__name__)
+
+
+class OggPageReader:
+    """バイト列をOggページ単位に切り出す
+
+    resync=True はファイルの途中から読む場合で、最初のページだけCRCを確かめ、
+    音声データの中の 'OggS' をページの先頭と取り違えないようにする。
+    """
+
+    def __init__(self, resync=False):
+        self._pending = bytearray()
+        self.resync = resync
+
+    def feed(self, data):
+        """データを追加し、完成したページのリスト [(ページ, granule位置)] を返す"""
+        self._pending += data
+        pages = []
+        while True:
+            start = self._pending.find(OGG_CAPTURE)
+            if start < 0:
+                # 次のページの先頭がまたがっている可能性があるので末尾だけ残す
+                del self._pending[:max(0, len(self._pending) - len(OGG_CAPTURE) + 1)]
+                return pages
+            if start:
+                del self._pending[:start]
+            if len(self._pending) < OGG_HEADER.size:
+                return pages
+            _, version, _, granule, _, _, crc, segments = OGG_HEADER.unpack_from(self._pending)
+            if self.resync and version != 0:
+                del self._pending[:1]
+                continue
+            header_size = OGG_HEADER.size + segments
+            if len(self._pending) < header_size:
+                return pages
+            page_size = header_size + sum(self._pending[OGG_HEADER.size:header_size])
+            if len(self._pending) < page_size:
+                return pages
+            if self.resync:
+                if ogg_page_crc(memoryview(self._pending)[:page_size]) != crc:
+                    # ページの先頭ではなかった。次の 'OggS' を探す
+                    del self._pending[:1]
+                    continue
+                self.resync = False
+            pages.append((bytes(self._pending[:page_size]), granule))
+            del self._pending[:page_size]
+
+
+class _FollowedFile:
+    """追従中のファイルの状態"""
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.reader = OggPageReader()
+        self.header_pages = []
+        self.in_headers = True
+
+
+class LiveTail:
+    """録音中のファイルを追従し、複数のリスナーに同じデータを配る
+
+    current_file は録音中のファイル名（録音していなければNone）を返す関数。
+    """
+
+    def __init__(self, recordings_dir, current_file, capacity=LIVE_BUFFER_SIZE):
+        self.recordings_dir = recordings_dir
+        self.current_file = current_file
+        self.capacity = capacity
+        self._cond = threading.Condition()
+        self._buffer = bytearray(capacity)
+        # バッファに書き込んだ総バイト数（リスナーの位置はこの絶対位置で持つ）
+        self._end = 0
+        # バッファ内にあるページの開始位置
+        self._page_starts = collections.deque()
+        # 現在のファイルのヘッダーページと、最初の音声ページの位置
+        self._headers = None
+        self._audio_start = 0
+        self._active = False
+        self._listeners = 0
+        self._thread = None
+
+    def listener_count(self):
+        """接続中のリスナー数"""
+        with self._cond:
+            return self._listeners
+
+    def listen(self):
+        """リスナー1人分のストリーム（OGGのバイト列を順に返すジェネレーター）"""
+        with self._cond:
+            self._listeners += 1
+            if not self._thread:
+                self._thread = threading.Thread(target=self._follow, daemon=True)
+                self._thread.start()
+            self._cond.wait_for(lambda: self._headers is not None or not self._thread,
+                                LIVE_HEADER_TIMEOUT)
+            headers = self._headers
+            # ライブの先端（最新のページの先頭）から聞き始める
+            position = max(self._page_starts[-1] if self._page_starts else self._end, self._audio_start)
+        try:
+            if headers is None:
+                return
+            yield headers
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._end > position or not self._active, 1.0)
+                    if self._end == position:
+                        if not self._active:
+                            return
+                        continue
+                    if position < self._end - self.capacity:
+                        # 送信が追いつかずバッファが一周した。最新のページまで飛ばす
+                        logger.warning("ライブ配信が遅れたため、最新の位置まで飛ばします")
+                        position = self._page_starts[-1]
+                    data = self._read(position, min(self._end - position, LIVE_SEND_SIZE))
+                position += len(data)
+                yield data
+        finally:
+            with self._cond:
+                self._listeners -= 1
+
+    def _read(self, position, size):
+        start = position % self.capacity
+        end = start + size
+        if end <= self.capacity:
+            return bytes(self._buffer[start:end])
+        return bytes(self._buffer[start:]) + bytes(self._buffer[:end - self.capacity])
+
+    def _append(self, page):
+        """ページを共有バッファに書き込む（ロック内で呼ぶ）"""
+        start = self._end % self.capacity
+        end = start + len(page)
+        if end <= self.capacity:
+            self._buffer[start:end] = page
+        else:
+            first = self.capacity - start
+            self._buffer[start:] = page[:first]
+            self._buffer[:end - self.capacity] = page[first:]
+        self._page_starts.append(self._end)
+        self._end += len(page)
+        while self._page_starts and self._page_starts[0] < self._end - self.capacity:
+            self._page_starts.popleft()
+
+    def _follow(self):
+        """追従スレッド: 録音中のファイルの増えた分を読み、ページ単位でバッファに積む"""
+        current = None
+        followed = None
+        idle_since = None
+        try:
+            while True:
+                with self._cond:
+                    if self._listeners:
+                        idle_since = None
+                    elif idle_since is None:
+                        idle_since = time.time()
+                    elif time.time() - idle_since > LIVE_IDLE_TIMEOUT:
+                        # 判定と同じロック内で外し、次のリスナーが新しいスレッドを起動できるようにする
+                        self._thread = None
+                        return
+
+                filename = self.current_file()
+                if filename != current and followed:
+                    # 切り替え前のファイルの残りを読み切ってから次へ進む
+                    self._consume(followed, followed.handle.read())
+                    followed.handle.close()
+                    followed = None
+                if filename != current:
+                    current = filename
+                    if filename:
+                        try:
+                            followed = _FollowedFile(open(os.path.join(self.recordings_dir, filename), 'rb'))
+                        except OSError:
+                            # エンコーダーがまだファイルを作っていない
+                            current = None
+                        else:
+                            logger.info(f"ライブ配信の対象: {filename}")
+                    with self._cond:
+                        # 新しく聞き始めるリスナーには新しいファイルのヘッダーを送る
+                        self._headers = None
+                        self._active = followed is not None
+                        self._cond.notify_all()
+                    if followed:
+                        self._skip_to_tail(followed)
+
+                if followed:
+                    data = followed.handle.read(LIVE_SEND_SIZE)
+                    if data:
+                        self._consume(followed, data)
+                        continue
+                time.sleep(LIVE_POLL_INTERVAL)
+        except Exception as e:
+            logger.error(f"ライブ配信の追従エラー: {e}")
+        finally:
+            if followed:
+                followed.handle.close()
+            with self._cond:
+                if self._thread is threading.current_thread():
+                    self._thread = None
+                if not self._thread:
+                    self._active = False
+                    self._headers = None
+                self._cond.notify_all()
+
+    def _skip_to_tail(self, followed):
+        """長くなっているファイルは、先頭のヘッダーページだけを読んで末尾付近に移る"""
+        size = os.fstat(followed.handle.fileno()).st_size
+        if size <= self.capacity:
+            return
+        header_pages = []
+        for page, granule in OggPageReader().feed(followed.handle.read(LIVE_SEND_SIZE)):
+            if granule != 0:
+                break
+            header_pages.append(page)
+        else:
+            # ヘッダーの終わりが見つからない。これまでどおり先頭から読む
+            followed.handle.seek(0)
+            return
+        followed.header_pages = header_pages
+        followed.in_headers = False
+        audio_start = self._end
+        followed.handle.seek(size - self.capacity)
+        followed.reader = OggPageReader(resync=True)
+        # 末尾まで読んでからヘッダーを公開し、待っているリスナーをライブの先端から始めさせる
+        self._consume(followed, followed.handle.read())
+        with self._cond:
+            self._headers = b''.join(header_pages)
+            self._audio_start = audio_start
+            self._cond.notify_all()
+
+    def _consume(self, followed, data):
+        with self._cond:
+            for page, granule in followed.reader.feed(data):
+                if followed.in_headers:
+                    if granule == 0:
+                        # ストリーム先頭のヘッダーページ（granule位置0）
+                        followed.header_pages.append(page)
+                    else:
+                        followed.in_headers = False
+                        self._headers = b''.join(followed.header_pages)
+                        self._audio_start = self._end
+                self._append(page)
+            self._cond.notify_all()
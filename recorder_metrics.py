@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+運用監視用のメトリクス（Prometheusのテキスト形式）
+カウンター・ゲージ・ヒストグラムをプロセスごとのレジストリ（REGISTRY）に記録する。
+記録はロック1つと加算だけで、Pi Zeroでも無視できる費用に収まるようにしている。
+
+ワーカーは snapshot() をステータスとは別の共有メモリ領域に数秒ごとに書き出し、
+Webサーバーが自分のスナップショットと合わせて /metrics で render() する
+（サンプルには process ラベル（web/worker）が付く）。
+"""
+
+import bisect
+import os
+import subprocess
+import threading
+import time
+
+# 外部コマンド（録音中のffmpegのように数時間動くものを含む）の実行時間のバケット（秒）
+COMMAND_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, 7200)
+# ステータスの書き込みやコマンドの受理など、ミリ秒未満から数ミリ秒の処理のバケット（秒）
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+# HTTPリクエストの処理時間のバケット（秒）
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# コマンド名から読み飛ばす前置きのコマンド
+COMMAND_PREFIXES = ('sudo', 'nice', 'ionice')
+
+
+class Metric:
+    """ラベルの値の組ごとに値を持つメトリクス"""
+
+    kind = None
+
+    def __init__(self, registry, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = registry.lock
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def snapshot(self):
+        """JSONにできる形の値"""
+        with self._lock:
+            samples = [[list(key), value] for key, value in self._values.items()]
+        return {'type': self.kind, 'help': self.help, 'labels': list(self.labels), 'samples': samples}
+
+
+class Counter(Metric):
+    """増えるだけの値"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """現在の値"""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def clear(self):
+        """すべての値を消す（終了した子プロセスの分など）"""
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram(Metric):
+    """値の分布（バケットごとの件数・合計・件数）"""
+
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help_text, labels=(), buckets=COMMAND_BUCKETS):
+        super().__init__(registry, name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [各バケットの件数（累積ではない）, 合計, 件数]
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            samples = [[list(key), [list(counts), total, count]] for key, (counts, total, count) in self._values.items()]
+        return {'type': self.kind, 'help': self.help, 'labels': list(self.labels),
+                'buckets': list(self.buckets), 'samples': samples}
+
+
+class Registry:
+    """プロセスのメトリクスの一覧"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._metrics = {}
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(self, name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self._add(Gauge(self, name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=COMMAND_BUCKETS):
+        return self._add(Histogram(self, name, help_text, labels, buckets))
+
+    def snapshot(self):
+        """すべてのメトリクスのJSONにできる形の値"""
+        return {name: metric.snapshot() for name, metric in list(self._metrics.items())}
+
+
+REGISTRY = Registry()
+
+EXTERNAL_COMMAND_SECONDS = REGISTRY.histogram(
+    'recorder_external_command_seconds', '外部コマンドの実行時間（秒）', ['command'])
+EXTERNAL_COMMAND_EXITS = REGISTRY.counter(
+    'recorder_external_command_exits_total', '外部コマンドの終了（status: 終了コード、timeout、error）',
+    ['command', 'status'])
+STATUS_WRITE_SECONDS = REGISTRY.histogram(
+    'recorder_status_write_seconds', 'ステータスを共有メモリに書き込む時間（秒）', buckets=FAST_BUCKETS)
+COMMAND_ACK_SECONDS = REGISTRY.histogram(
+    'recorder_command_ack_seconds', 'コマンドの送信からワーカーの受理（ack）までの時間（秒）',
+    ['action'], buckets=FAST_BUCKETS)
+COMMAND_REPLY_SECONDS = REGISTRY.histogram(
+    'recorder_command_reply_seconds', 'コマンドの送信からワーカーの応答までの時間（秒）',
+    ['action'], buckets=FAST_BUCKETS)
+RECORDING_BYTES = REGISTRY.counter(
+    'recorder_recording_bytes_total', '録音ファイルに書き込まれたバイト数')
+RECORDING_BYTES_PER_SECOND = REGISTRY.gauge(
+    'recorder_recording_bytes_per_second', '録音ファイルに書き込まれている速さ（バイト/秒、録音中以外は0）')
+CHILD_CPU_SECONDS = REGISTRY.gauge(
+    'recorder_child_cpu_seconds', '実行中の子プロセス（ffmpegなど）のCPU時間（秒）', ['name', 'pid'])
+CHILD_RSS_BYTES = REGISTRY.gauge(
+    'recorder_child_rss_bytes', '実行中の子プロセス（ffmpegなど）の常駐メモリ（バイト）', ['name', 'pid'])
+SLOW_CALLS = REGISTRY.counter(
+    'recorder_slow_calls_total', '遅い処理の実行（result: started、coalesced（実行中の結果を共有）、rejected、timeout）',
+    ['call', 'result'])
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'recorder_http_request_seconds', 'HTTPリクエストの処理時間（秒、ストリームは応答開始まで）',
+    ['route', 'method', 'status'], buckets=HTTP_BUCKETS)
+
+
+def command_name(cmd):
+    """コマンドラインからコマンド名を取り出す（sudo などの前置きは読み飛ばす）"""
+    words = cmd.split() if isinstance(cmd, str) else list(cmd)
+    for index, word in enumerate(words):
+        name = os.path.basename(word)
+        if name not in COMMAND_PREFIXES and not word.startswith('-') and not (
+                index and words[index - 1] in ('-n', '-c')):
+            return name
+    return 'unknown'
+
+
+def observe_command(name, seconds, status):
+    """外部コマンドの実行時間と終了を記録する"""
+    EXTERNAL_COMMAND_SECONDS.observe(seconds, command=name)
+    EXTERNAL_COMMAND_EXITS.inc(command=name, status=status)
+
+
+def run_command(cmd, name=None, **kwargs):
+    """subprocess.run と同じ。実行時間と終了コード（タイムアウト・起動失敗も）を記録する"""
+    name = name or command_name(cmd)
+    started = time.monotonic()
+    try:
+        result = subprocess.run(cmd, **kwargs)
+    except subprocess.TimeoutExpired:
+        observe_command(name, time.monotonic() - started, 'timeout')
+        raise
+    except subprocess.CalledProcessError as e:
+        observe_command(name, time.monotonic() - started, e.returncode)
+        raise
+    except OSError:
+        observe_command(name, time.monotonic() - started, 'error')
+        raise
+    observe_command(name, time.monotonic() - started, result.returncode)
+    return result
+
+
+def sample_children(psutil):
+    """子プロセスのCPU時間と常駐メモリを記録する（終了したプロセスの分は消す）"""
+    CHILD_CPU_SECONDS.clear()
+    CHILD_RSS_BYTES.clear()
+    for child in psutil.Process().children(recursive=True):
+        try:
+            with child.oneshot():
+                name = child.name()
+                cpu = child.cpu_times()
+                rss = child.memory_info().rss
+        except psutil.Error:
+            continue
+        CHILD_CPU_SECONDS.set(round(cpu.user + cpu.system, 2), name=name, pid=child.pid)
+        CHILD_RSS_BYTES.set(rss, name=name, pid=child.pid)
+
+
+def _labels(names, values, extra):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snapshots):
+    """{プロセス名: snapshot()} をPrometheusのテキスト形式にする"""
+    families = {}
+    for process, snapshot in snapshots.items():
+        for name, metric in snapshot.items():
+            family = families.setdefault(name, {'metric': metric, 'samples': []})
+            family['samples'] += [(process, sample) for sample in metric['samples']]
+
+    lines = []
+    for name, family in sorted(families.items()):
+        metric = family['metric']
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for process, (values, value) in family['samples']:
+            extra = [('process', process)]
+            if metric['type'] != 'histogram':
+                lines.append(f"{name}{_labels(metric['labels'], values, extra)} {_number(value)}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(list(metric['buckets']) + [float('inf')], counts):
+                cumulative += bucket_count
+                labels = _labels(metric['labels'], values, extra + [('le', _number(bound))])
+                lines.append(f"{name}_bucket{labels} {cumulative}")
+            labels = _labels(metric['labels'], values, extra)
+            lines.append(f"{name}_sum{labels} {_number(total)}")
+            lines.append(f"{name}_count{labels} {count}")
+    return '\n'.join(lines) + '\n'
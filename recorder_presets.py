@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+録音のエンコード設定（プリセット）
+プリセットごとにffmpegのコーデックのオプションと、recording_info.format に載せる
+形式の説明、segment_mb を時間に換算するためのおおよそのビットレートを持つ。
+どのプリセットもOggに書き出すため、ファイル名（.ogg）・ライブ配信・分割録音は共通。
+
+既定のプリセットは recorder_config.json の encoder_preset で、/start_recording の
+preset で録音ごとに選べる。CPUとファイルサイズの比較は bench/bench_presets.py。
+"""
+
+# 既定のプリセット（従来の録音と同じ形式）
+DEFAULT_PRESET = 'vorbis128'
+
+# codec_args: ffmpegの出力オプション, bitrate: おおよそのビットレート（bps、Noneは入力で決まる）,
+# soundfile: プロセス内（libsndfile）でエンコードする場合のsubtype（Noneはffmpegのみ）,
+# low_rate: サンプリングレートが LOW_RATE 未満のソース（HFPなど）で置き換える設定
+ENCODER_PRESETS = {
+    'vorbis128': {
+        'label': 'Vorbis 128kbps',
+        'format': 'OGG Vorbis 128kbps',
+        'codec_args': ['-acodec', 'libvorbis', '-ab', '128k'],
+        'bitrate': 128000,
+        'soundfile': 'VORBIS',
+        # libvorbisは16kHz以下では128kbpsを受け付けないため、品質指定にする
+        'low_rate': {
+            'format': 'OGG Vorbis q4',
+            'codec_args': ['-acodec', 'libvorbis', '-q:a', '4'],
+            'bitrate': 40000
+        }
+    },
+    # 会話向け。HFPの音声（8/16kHzモノラル）にはこれで足りる
+    'opus32': {
+        'label': 'Opus 32kbps（会話）',
+        'format': 'OGG Opus 32kbps',
+        'codec_args': ['-acodec', 'libopus', '-b:a', '32k', '-application', 'voip'],
+        'bitrate': 32000,
+        'soundfile': None
+    },
+    'opus24': {
+        'label': 'Opus 24kbps（会話・小さいファイル）',
+        'format': 'OGG Opus 24kbps',
+        'codec_args': ['-acodec', 'libopus', '-b:a', '24k', '-application', 'voip'],
+        'bitrate': 24000,
+        'soundfile': None
+    },
+    # 保存用の可逆圧縮（Ogg FLAC）
+    'flac': {
+        'label': 'FLAC（可逆圧縮）',
+        'format': 'OGG FLAC',
+        # 入力（PulseAudio・パイプライン）は16bitなので、それ以上のビット深度にしない
+        'codec_args': ['-acodec', 'flac', '-sample_fmt', 's16'],
+        'bitrate': None,
+        'soundfile': None
+    }
+}
+
+# FLACの圧縮後のおおよその大きさ（PCMに対する割合）
+FLAC_RATIO = 0.6
+# これ未満のサンプリングレートでは low_rate の設定を使う（Hz）
+LOW_RATE = 32000
+
+
+def get_preset(name):
+    """プリセット名の設定（不明な名前はNone）"""
+    return ENCODER_PRESETS.get(name)
+
+
+def preset_for_rate(preset, rate):
+    """サンプリングレートに合わせたプリセットの設定（low_rate があれば置き換える）"""
+    if rate < LOW_RATE and preset.get('low_rate'):
+        return dict(preset, **preset['low_rate'])
+    return preset
+
+
+def preset_choices():
+    """画面に表示する [(プリセット名, 表示名)] の一覧"""
+    return [(name, preset['label']) for name, preset in ENCODER_PRESETS.items()]
+
+
+def bytes_per_second(preset, rate, channels):
+    """プリセットで録音したときの1秒あたりのおおよそのファイルサイズ"""
+    if preset['bitrate']:
+        return preset['bitrate'] // 8
+    return int(rate * channels * 2 * FLAC_RATIO)
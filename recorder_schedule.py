@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+予約録音（一回だけ・毎週）
+予約はJSONファイルに保存し、Webサーバーの再起動後もそのまま引き継ぐ。
+
+RecordingScheduler は次の開始時刻までイベントで待ち（ポーリングしない）、
+開始の PREWARM_SECONDS 秒前に prewarm(予約) でBluetoothの接続とPulseAudioの
+ソースを準備させてから、開始時刻ちょうどに start(予約) を呼ぶ。
+時刻はPiのローカル時刻で、毎週の予約の曜日は月曜=0〜日曜=6。
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+# 開始の何秒前に接続とソースを準備するか
+PREWARM_SECONDS = 30
+# 開始時刻を過ぎていてもこの秒数以内なら録音する（再起動の直後など）
+MISSED_GRACE = 60
+# 録音時間（分）の既定値
+DEFAULT_DURATION = 60
+
+logger = logging.getLogger(__name__)
+
+
+def parse_clock(value):
+    """'HH:MM' または 'HH:MM:SS' を (時, 分, 秒) にする"""
+    parts = str(value).split(':')
+    if len(parts) not in (2, 3):
+        raise ValueError(f"時刻の形式が正しくありません: {value}")
+    hour, minute, second = (int(part) for part in parts + ['0'] * (3 - len(parts)))
+    if not (0 <= hour < 24 and 0 <= minute < 60 and 0 <= second < 60):
+        raise ValueError(f"時刻の形式が正しくありません: {value}")
+    return hour, minute, second
+
+
+def next_start(entry, after):
+    """予約の、after（UNIX時間）より後の最初の開始時刻（なければNone）"""
+    hour, minute, second = parse_clock(entry['time'])
+    if entry['repeat'] == 'once':
+        day = datetime.strptime(entry['date'], '%Y-%m-%d')
+        when = day.replace(hour=hour, minute=minute, second=second).timestamp()
+        return when if when > after else None
+    day = datetime.fromtimestamp(after).replace(hour=hour, minute=minute, second=second, microsecond=0)
+    for offset in range(8):
+        candidate = day + timedelta(days=offset)
+        if candidate.weekday() in entry['weekdays'] and candidate.timestamp() > after:
+            return candidate.timestamp()
+    return None
+
+
+def validate(data):
+    """APIから受け取った予約を検証し、保存する形にする（不正ならValueError）"""
+    device = data.get('device')
+    if not isinstance(device, dict) or not device.get('mac'):
+        raise ValueError('デバイスが選択されていません')
+    try:
+        duration = float(data.get('duration') or DEFAULT_DURATION)
+    except (TypeError, ValueError):
+        raise ValueError('録音時間が正しくありません')
+    if duration <= 0:
+        raise ValueError('録音時間が正しくありません')
+    if duration.is_integer():
+        duration = int(duration)
+    entry = {
+        'name': str(data.get('name') or '予約録音'),
+        'device': {'mac': device['mac'], 'name': device.get('name') or device['mac']},
+        'duration': duration,
+        'time': data.get('time'),
+        'repeat': data.get('repeat', 'once'),
+    }
+    parse_clock(entry['time'])
+    if entry['repeat'] == 'once':
+        try:
+            datetime.strptime(str(data.get('date')), '%Y-%m-%d')
+        except ValueError:
+            raise ValueError('日付の形式が正しくありません（YYYY-MM-DD）')
+        entry['date'] = data['date']
+        if next_start(entry, time.time()) is None:
+            raise ValueError('開始時刻が過ぎています')
+    elif entry['repeat'] == 'weekly':
+        try:
+            weekdays = sorted({int(day) for day in data.get('weekdays') or []})
+        except (TypeError, ValueError):
+            weekdays = []
+        if not weekdays or not all(0 <= day <= 6 for day in weekdays):
+            raise ValueError('曜日を選択してください')
+        entry['weekdays'] = weekdays
+    else:
+        raise ValueError(f"不明な繰り返しです: {entry['repeat']}")
+    return entry
+
+
+class ScheduleStore:
+    """予約の一覧（JSONファイル、書き込みは一時ファイル経由の置き換えで行う）"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return []
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f).get('schedules', [])
+        except (OSError, ValueError) as e:
+            logger.error(f"予約ファイルを読み込めません: {e}")
+            return []
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'schedules': self._entries}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def entries(self):
+        """予約の一覧（コピー）"""
+        with self._lock:
+            return [dict(entry) for entry in self._entries]
+
+    def add(self, data):
+        """予約を検証して追加し、保存した予約を返す"""
+        entry = validate(data)
+        entry.update({'id': uuid.uuid4().hex[:8], 'created_at': time.time(), 'last_run': None})
+        with self._lock:
+            self._entries.append(entry)
+            self._save()
+        return dict(entry)
+
+    def remove(self, schedule_id):
+        """予約を削除する（見つからなければFalse）"""
+        with self._lock:
+            remaining = [entry for entry in self._entries if entry['id'] != schedule_id]
+            if len(remaining) == len(self._entries):
+                return False
+            self._entries = remaining
+            self._save()
+        return True
+
+    def mark_run(self, schedule_id, when):
+        """開始した予約を記録する（一回だけの予約は削除する）"""
+        with self._lock:
+            for entry in self._entries:
+                if entry['id'] == schedule_id:
+                    entry['last_run'] = when
+            self._entries = [entry for entry in self._entries
+                             if not (entry['id'] == schedule_id and entry['repeat'] == 'once')]
+            self._save()
+
+
+class RecordingScheduler:
+    """予約の開始時刻に録音を開始させるスレッド
+
+    prewarm(予約) と start(予約) はこのスレッドから呼ばれる。
+    予約を追加・削除したときは wake() で待ち時間を計算し直させる。
+    """
+
+    def __init__(self, store, prewarm, start, prewarm_seconds=PREWARM_SECONDS):
+        self.store = store
+        self.prewarm = prewarm
+        self.start_recording = start
+        self.prewarm_seconds = prewarm_seconds
+        self._wake = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def upcoming(self):
+        """予約の一覧に次の開始時刻（next_start）を付けて、近い順に返す"""
+        now = time.time()
+        entries = []
+        for entry in self.store.entries():
+            entry['next_start'] = self._next_start(entry, now)
+            entries.append(entry)
+        return sorted(entries, key=lambda entry: entry['next_start'] or float('inf'))
+
+    def _next_start(self, entry, now):
+        # 前回の開始より後で、過ぎてから MISSED_GRACE 秒以内のものまでを対象にする
+        after = max(entry.get('last_run') or 0, now - MISSED_GRACE)
+        try:
+            return next_start(entry, after)
+        except (KeyError, ValueError) as e:
+            logger.error(f"予約を解釈できません: {entry.get('id')} {e}")
+            return None
+
+    def start(self):
+        """スケジューラーを開始する"""
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """スケジューラーを停止する"""
+        self._running = False
+        self._wake.set()
+        if self._thread:
+            self._thread.join(5)
+
+    def wake(self):
+        """予約が変わったので次の開始時刻を計算し直させる"""
+        self._wake.set()
+
+    def _wait(self, seconds):
+        """指定秒数待つ（予約の変更・停止で中断される）"""
+        self._wake.wait(max(0, seconds))
+        self._wake.clear()
+
+    def _run(self):
+        prewarmed = None
+        while self._running:
+            upcoming = [entry for entry in self.upcoming() if entry['next_start'] is not None]
+            if not upcoming:
+                # 予約がなければ追加されるまで待つ（日付をまたぐ計算のため1時間ごとに見直す）
+                self._wait(3600)
+                continue
+            entry = upcoming[0]
+            when = entry['next_start']
+            key = (entry['id'], when)
+            now = time.time()
+            if now < when - self.prewarm_seconds:
+                self._wait(when - self.prewarm_seconds - now)
+                continue
+            if prewarmed != key:
+                prewarmed = key
+                logger.info(f"予約録音の準備をします: {entry['name']} "
+                            f"({datetime.fromtimestamp(when):%Y-%m-%d %H:%M:%S} 開始)")
+                try:
+                    self.prewarm(entry)
+                except Exception as e:
+                    logger.error(f"予約録音の準備に失敗しました: {e}")
+                continue
+            if now < when:
+                self._wait(when - now)
+                continue
+            self.store.mark_run(entry['id'], when)
+            logger.info(f"予約録音を開始します: {entry['name']} (予定より{(now - when) * 1000:.0f}ms後)")
+            try:
+                self.start_recording(entry)
+            except Exception as e:
+                logger.error(f"予約録音を開始できませんでした: {e}")
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+分割録音（セグメント）の管理
+録音を一定時間・一定サイズごとに <録音名>_001.ogg, _002.ogg ... に分けて書き出し、
+セグメントの一覧を <録音名>.segments.json（マニフェスト）に記録する。
+
+録音中にワーカーが落ちたり電源が切れたりした場合、マニフェストは
+state=recording のまま残る。次回起動時に recover_sessions() が書きかけの
+最後のセグメントを再多重化（-c copy）して確定させる。
+停止時には、設定に応じてconcatデマルチプレクサで無劣化に1ファイルへ結合する。
+"""
+
+import glob
+import json
+import logging
+import os
+import re
+import subprocess
+import time
+
+from recorder_metrics import run_command
+from recorder_waveform import concat_peaks, peaks_path
+
+MANIFEST_SUFFIX = '.segments.json'
+# セグメント番号の桁数（ffmpegのsegmentマルチプレクサの %03d と揃える）
+SEGMENT_NUMBER_FORMAT = '_%03d'
+# 再多重化・結合のタイムアウト（秒）
+REMUX_TIMEOUT = 600
+
+logger = logging.getLogger(__name__)
+
+
+def segment_pattern(base_path):
+    """ffmpegのsegmentマルチプレクサに渡すファイル名のパターン"""
+    return f"{base_path}{SEGMENT_NUMBER_FORMAT}.ogg"
+
+
+def segment_path(base_path, number):
+    """number番目のセグメントのパス"""
+    return segment_pattern(base_path) % number
+
+
+def list_segments(base_path):
+    """ディスク上のセグメントを番号順に返す"""
+    prefix = os.path.basename(base_path)
+    matcher = re.compile(re.escape(prefix) + r'_(\d{3,})\.ogg$')
+    found = []
+    for path in glob.glob(f"{glob.escape(base_path)}_*.ogg"):
+        match = matcher.match(os.path.basename(path))
+        if match:
+            found.append((int(match.group(1)), path))
+    return [path for _, path in sorted(found)]
+
+
+class SegmentManifest:
+    """分割録音のマニフェスト（書き込みは一時ファイル経由の置き換えで行う）"""
+
+    def __init__(self, base_path, data=None):
+        self.base_path = base_path
+        self.path = base_path + MANIFEST_SUFFIX
+        self.data = data or {
+            'recording': os.path.basename(base_path),
+            'state': 'recording',
+            'started_at': time.time(),
+            'ended_at': None,
+            'segments': [],
+            'output': None
+        }
+
+    @classmethod
+    def create(cls, base_path, **settings):
+        """新しい録音のマニフェストを作成する"""
+        manifest = cls(base_path)
+        manifest.data.update(settings)
+        manifest.save()
+        return manifest
+
+    @classmethod
+    def load(cls, path):
+        """既存のマニフェストを読み込む"""
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return cls(path[:-len(MANIFEST_SUFFIX)], data)
+
+    @property
+    def state(self):
+        return self.data['state']
+
+    def save(self):
+        """マニフェストを書き込む"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def refresh(self):
+        """ディスク上のセグメントを反映する。一覧が変わっていればTrueを返す"""
+        segments = [{'file': os.path.basename(path), 'size': os.path.getsize(path)}
+                    for path in list_segments(self.base_path)]
+        files = [s['file'] for s in segments]
+        changed = files != [s['file'] for s in self.data['segments']]
+        self.data['segments'] = segments
+        if changed:
+            self.save()
+        return changed
+
+    def total_size(self):
+        """セグメントの合計サイズ（バイト）"""
+        return sum(os.path.getsize(path) for path in list_segments(self.base_path)
+                   if os.path.exists(path))
+
+    def finish(self, state='complete', concat=False, finalize_last=False):
+        """録音を締めくくる
+
+        finalize_last: 最後のセグメントが正しく閉じられていない可能性がある場合に再多重化する
+        concat: セグメントを1ファイルに結合し、成功したらセグメントを削除する
+        """
+        segments = list_segments(self.base_path)
+        # 書き込まれる前に中断された空のセグメントは捨てる
+        for path in [p for p in segments if os.path.getsize(p) == 0]:
+            os.remove(path)
+            remove_if_exists(peaks_path(path))
+            segments.remove(path)
+        if finalize_last and segments:
+            finalize_segment(segments[-1])
+
+        self.data['state'] = state
+        self.data['ended_at'] = time.time()
+        self.refresh()
+
+        if concat and segments:
+            output = self.base_path + '.ogg'
+            if concat_segments(segments, output):
+                # 波形ファイルも同じ順につなげる
+                concat_peaks([peaks_path(path) for path in segments], peaks_path(output))
+                for path in segments:
+                    os.remove(path)
+                    remove_if_exists(peaks_path(path))
+                self.data['output'] = os.path.basename(output)
+                self.data['segments'] = []
+        self.save()
+        return self.data['output']
+
+
+def remove_if_exists(path):
+    """ファイルがあれば削除する"""
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def finalize_segment(path):
+    """書きかけのOGGを -c copy で再多重化し、ストリームの終端を正しく書き込む"""
+    tmp_path = path + '.remux.part'
+    cmd = ['ffmpeg', '-v', 'error', '-i', path, '-c', 'copy', '-f', 'ogg', '-y', tmp_path]
+    try:
+        result = run_command(cmd, stdin=subprocess.DEVNULL, capture_output=True,
+                             text=True, timeout=REMUX_TIMEOUT)
+        if result.returncode == 0 and os.path.exists(tmp_path) and os.path.getsize(tmp_path) > 0:
+            os.replace(tmp_path, path)
+            logger.info(f"セグメントを確定しました: {os.path.basename(path)}")
+            return True
+        logger.warning(f"セグメントを確定できません（元のファイルを残します）: {path} {result.stderr.strip()}")
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"セグメントの再多重化に失敗: {path} {e}")
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    return False
+
+
+def concat_segments(segments, output):
+    """concatデマルチプレクサでセグメントを再エンコードせずに結合する"""
+    list_path = output + '.concat.txt'
+    tmp_path = output + '.concat.part'
+    with open(list_path, 'w') as f:
+        for path in segments:
+            name = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{name}'\n")
+    cmd = ['ffmpeg', '-v', 'error', '-f', 'concat', '-safe', '0', '-i', list_path,
+           '-c', 'copy', '-f', 'ogg', '-y', tmp_path]
+    try:
+        result = run_command(cmd, stdin=subprocess.DEVNULL, capture_output=True,
+                             text=True, timeout=REMUX_TIMEOUT)
+        if result.returncode == 0 and os.path.exists(tmp_path) and os.path.getsize(tmp_path) > 0:
+            os.replace(tmp_path, output)
+            logger.info(f"{len(segments)}個のセグメントを結合しました: {os.path.basename(output)}")
+            return True
+        logger.error(f"セグメントの結合に失敗しました: {result.stderr.strip()}")
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.error(f"セグメントの結合に失敗しました: {e}")
+    finally:
+        os.remove(list_path)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return False
+
+
+def recover_sessions(recordings_dir, concat=False, started_before=None):
+    """前回のセッションで書きかけのまま残った録音を確定させる
+
+    started_before より後に始まった録音（復旧中に開始された新しい録音）は対象外。
+    """
+    started_before = started_before or time.time()
+    recovered = []
+    for path in sorted(glob.glob(os.path.join(glob.escape(recordings_dir), '*' + MANIFEST_SUFFIX))):
+        try:
+            manifest = SegmentManifest.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"マニフェストを読み込めません: {path} {e}")
+            continue
+        if manifest.state != 'recording' or manifest.data.get('started_at', 0) >= started_before:
+            continue
+        logger.info(f"中断された録音を復旧します: {manifest.data['recording']}")
+        manifest.finish(state='recovered', concat=concat, finalize_last=True)
+        recovered.append(manifest.data['recording'])
+    return recovered
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+同時に録音するセッション（ワーカー側）
+セッションは1台のデバイスの録音で、ステータス・停止フラグ・録音スレッドをそれぞれ持つ。
+複数のBluetoothアダプタ（hci0, hci1...）につないだデバイスを同時に録音できる。
+
+ワーカー全体のステータスには、最後に開始したセッションの内容を従来どおりの
+キー（recording, filename, recording_info など）で載せ、すべてのセッションを
+sessions（セッションID→ステータス）に載せる。
+"""
+
+import threading
+import time
+import uuid
+
+# 同時に録音できるセッション数の既定値。Pi Zero 2で bench/bench_sessions.py の計測が
+# 裏付けるまでは1台とし、複数台の同時録音は recorder_config.json の max_sessions で有効にする
+DEFAULT_MAX_SESSIONS = 1
+
+# セッションのステータスの初期値
+IDLE_SESSION_STATUS = {
+    'recording': False,
+    'status': 'starting',  # starting, recording, stopping, error
+    'start_time': None,
+    'filename': None,
+    'device': None,
+    'error_message': None,
+    'recording_info': None,
+    'level': None
+}
+
+
+class SessionError(Exception):
+    """セッションを開始できない（同じデバイスで録音中・上限に達したなど）"""
+
+
+class RecordingSession:
+    """1台のデバイスの録音"""
+
+    def __init__(self, session_id, device, on_change):
+        self.id = session_id
+        self.device = device
+        self.stop_flag = threading.Event()
+        self.created_at = time.time()
+        self.thread = None
+        # 書き込み速度（バイト/秒、全セッションの合計をメトリクスにする）
+        self.bytes_per_second = 0
+        self._on_change = on_change
+        self._lock = threading.Lock()
+        self._status = dict(IDLE_SESSION_STATUS, session=session_id, device=device)
+
+    @property
+    def device_mac(self):
+        return self.device.get('mac')
+
+    def update(self, new_status):
+        """セッションのステータスを更新し、ワーカーのステータスとして公開させる"""
+        with self._lock:
+            self._status.update(new_status)
+        self._on_change()
+
+    def status(self):
+        """ステータス（コピー）"""
+        with self._lock:
+            return dict(self._status)
+
+    def stop(self):
+        """録音を停止させる"""
+        self.update({'status': 'stopping'})
+        self.stop_flag.set()
+
+
+class SessionManager:
+    """録音中のセッションの一覧"""
+
+    def __init__(self, on_change, max_sessions=DEFAULT_MAX_SESSIONS):
+        self.on_change = on_change
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def create(self, device, session_id=None):
+        """デバイスのセッションを作る（同じデバイスで録音中・上限に達した場合はSessionError）"""
+        with self._lock:
+            if any(session.device_mac == device.get('mac') for session in self._sessions.values()):
+                raise SessionError('このデバイスは既に録音中です')
+            if len(self._sessions) >= self.max_sessions:
+                raise SessionError(f'同時に録音できるのは{self.max_sessions}台までです')
+            session_id = session_id or uuid.uuid4().hex[:8]
+            if session_id in self._sessions:
+                raise SessionError(f'セッションIDが重複しています: {session_id}')
+            session = RecordingSession(session_id, device, self.on_change)
+            self._sessions[session_id] = session
+        return session
+
+    def remove(self, session):
+        """終了したセッションを一覧から外す"""
+        with self._lock:
+            if self._sessions.get(session.id) is session:
+                del self._sessions[session.id]
+        self.on_change()
+
+    def get(self, session_id):
+        """セッションIDのセッション（なければNone）"""
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def find(self, device_mac):
+        """デバイスのセッション（なければNone）"""
+        with self._lock:
+            for session in self._sessions.values():
+                if session.device_mac == device_mac:
+                    return session
+        return None
+
+    def sessions(self):
+        """セッションの一覧（開始順）"""
+        with self._lock:
+            return sorted(self._sessions.values(), key=lambda session: session.created_at)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def summary(self):
+        """ワーカーのステータスに載せる内容
+
+        最後に開始したセッションのステータスを従来のキーで、すべてのセッションを sessions で返す。
+        セッションがなければ recording と sessions だけを返す（他のキーはワーカーの値のまま）。
+        """
+        statuses = [session.status() for session in self.sessions()]
+        # 録音を始めたセッションを、ソースを待っているセッションより優先する
+        primary = [status for status in statuses if status['recording']] or statuses
+        summary = dict(primary[-1]) if primary else {}
+        summary['recording'] = any(status['recording'] for status in statuses)
+        summary['sessions'] = {status['session']: status for status in statuses}
+        return summary
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+録音中の無音区間の検出（エネルギーゲート）
+会議の待ち時間や休憩のような長い無音を、エンコーダーの手前で判定する。
+
+  skip: silence_seconds を超えて続いた無音はエンコーダーに渡さない。
+        エンコードとファイルサイズが無音の分だけ減る。音が戻ったときは
+        直前の RESUME_PADDING 秒を付けてから再開するため、話し始めは欠けない。
+  mark: エンコードはそのままで、無音区間をインデックスに記録するだけ。
+
+どちらも無音区間を <録音名>.silence.json に記録する。start/end は録音開始からの
+秒（実時間）、output_at は出力ファイル上の位置（skipで詰めた後の秒）。
+"""
+
+import json
+import logging
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from recorder_capture import SAMPLE_WIDTH, RingBuffer
+from recorder_waveform import to_dbfs
+
+SILENCE_SUFFIX = '.silence.json'
+# 判定の窓の長さ（秒）
+SILENCE_WINDOW = 0.05
+# skipで再開するときに付ける、音が戻る直前の長さ（秒）
+RESUME_PADDING = 0.3
+
+logger = logging.getLogger(__name__)
+
+
+def silence_index_path(base_path):
+    """録音（拡張子なしのパス）の無音区間インデックスのパス"""
+    return base_path + SILENCE_SUFFIX
+
+
+class SilenceIndex:
+    """無音区間のインデックス（書き込みは一時ファイル経由の置き換えで行う）"""
+
+    def __init__(self, path, mode, threshold_db, min_silence):
+        self.path = path
+        self.data = {
+            'mode': mode,
+            'threshold_db': threshold_db,
+            'min_silence_seconds': min_silence,
+            'skipped_seconds': 0.0,
+            'regions': []
+        }
+
+    def add(self, start, end, output_at, skipped):
+        """無音区間を追加して保存する"""
+        self.data['regions'].append({'start': round(start, 2), 'end': round(end, 2),
+                                     'output_at': round(output_at, 2)})
+        self.data['skipped_seconds'] = round(self.data['skipped_seconds'] + skipped, 2)
+        self.save()
+
+    def save(self):
+        """インデックスを書き込む"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class SilenceGate:
+    """無音区間を検出し、skipでは長い無音をエンコーダーに渡さない（エンコーダーと同じインターフェース）
+
+    判定は SILENCE_WINDOW ごとのRMS（dBFS）が threshold_db を下回るかどうかで、
+    受け取ったPCMの窓をまとめてnumpyで計算する。
+    """
+
+    def __init__(self, encoder, index, rate, channels, mode='skip', threshold_db=-50, min_silence=5):
+        if numpy is None:
+            raise RuntimeError("numpyがインストールされていません")
+        self.encoder = encoder
+        self.index = index
+        self.rate = rate
+        self.mode = mode
+        self.threshold_db = threshold_db
+        self.min_silence_frames = int(min_silence * rate)
+        self.frame_size = SAMPLE_WIDTH * channels
+        self.window_frames = max(1, int(rate * SILENCE_WINDOW))
+        self.window_bytes = self.window_frames * self.frame_size
+        self._pending = bytearray()
+        self._padding = RingBuffer(int(RESUME_PADDING * rate) * self.frame_size, align=self.frame_size)
+        # 受け取ったフレーム数と、エンコーダーに渡したフレーム数
+        self._input_frames = 0
+        self._output_frames = 0
+        # 無音が始まった位置（入力のフレーム数）と、skip中の区間の開始位置
+        self._silence_start = None
+        self._gate_start = None
+        self._gate_output_at = 0
+        self.skipped_frames = 0
+
+    def skipped_seconds(self):
+        """skipで詰めた長さ（秒）"""
+        return self.skipped_frames / self.rate
+
+    def write(self, data):
+        """PCMを書き込む"""
+        self._pending += data
+        size = len(self._pending) - len(self._pending) % self.window_bytes
+        if not size:
+            return
+        chunk = bytes(self._pending[:size])
+        del self._pending[:size]
+        windows = numpy.frombuffer(chunk, dtype='<i2').reshape(-1, self.window_bytes // SAMPLE_WIDTH)
+        windows = windows.astype(numpy.float32)
+        loud = to_dbfs(numpy.sqrt(numpy.mean(windows * windows, axis=1))) >= self.threshold_db
+
+        output = bytearray()
+        for number, is_loud in enumerate(loud):
+            window = chunk[number * self.window_bytes:(number + 1) * self.window_bytes]
+            output += self._window(window, is_loud)
+        if output:
+            self.encoder.write(output)
+
+    def _window(self, window, loud):
+        """1つの窓を判定し、エンコーダーに渡すPCMを返す"""
+        output = b''
+        if loud:
+            if self._gate_start is not None:
+                # 音が戻った。直前の余白を付けて再開する
+                padding = self._padding.snapshot()
+                self._padding.clear()
+                resume = self._input_frames - len(padding) // self.frame_size
+                self._close_region(self._gate_start, resume)
+                self._gate_start = None
+                output += padding
+            elif self._silence_start is not None:
+                self._close_region(self._silence_start, self._input_frames)
+            self._silence_start = None
+            output += window
+        else:
+            if self._silence_start is None:
+                self._silence_start = self._input_frames
+            if (self.mode == 'skip' and self._gate_start is None
+                    and self._input_frames + self.window_frames - self._silence_start > self.min_silence_frames):
+                # 無音が長く続いたので、ここからエンコーダーに渡さない
+                self._gate_start = self._input_frames
+                self._gate_output_at = self._output_frames
+                logger.info(f"無音が続いているため録音を詰めます（{self._input_frames / self.rate:.1f}秒から）")
+            if self._gate_start is not None:
+                self._padding.write(window)
+            else:
+                output += window
+        self._input_frames += self.window_frames
+        self._output_frames += len(output) // self.frame_size
+        return output
+
+    def _close_region(self, start, end):
+        """無音区間を記録する（markでは min_silence 未満の区間は記録しない）"""
+        if self._gate_start is not None:
+            skipped = end - start
+            output_at = self._gate_output_at
+            self.skipped_frames += skipped
+        elif end - start >= self.min_silence_frames:
+            skipped = 0
+            output_at = self._output_frames - (self._input_frames - start)
+        else:
+            return
+        try:
+            self.index.add(start / self.rate, end / self.rate, output_at / self.rate, skipped / self.rate)
+        except OSError as e:
+            logger.error(f"無音区間のインデックスを書き込めません: {e}")
+
+    def poll(self):
+        """エンコーダーの終了コード（実行中はNone）"""
+        return self.encoder.poll()
+
+    def close(self, timeout=10):
+        """残りを書き込み、続いている無音区間を記録してからエンコーダーを閉じる"""
+        try:
+            if self._gate_start is None and self._pending:
+                self.encoder.write(bytes(self._pending))
+            self._pending.clear()
+            if self._gate_start is not None:
+                self._close_region(self._gate_start, self._input_frames)
+            elif self._silence_start is not None:
+                self._close_region(self._silence_start, self._input_frames)
+        finally:
+            self.encoder.close(timeout)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+録音ワーカーの監視（Webサーバー側）と起動完了の通知（ワーカー側）
+Webサーバーはワーカーを起動するときにパイプの書き込み側を渡し（RECORDER_READY_FD）、
+ワーカーはコマンドを受け付けられるようになった時点で 'READY=1' を書き込む。
+起動確認のためにステータスをポーリングすることはない。
+
+起動後は監視スレッドがプロセスの終了を待ち（終了は数ミリ秒で検知できる）、
+あわせて共有メモリのハートビートで応答のないワーカー（ハング）を検出する。
+停止を依頼していないのに終了したワーカーは、間隔を延ばしながら再起動する。
+"""
+
+import logging
+import os
+import select
+import signal
+import subprocess
+import threading
+import time
+
+# 起動完了の通知に使うファイル記述子を渡す環境変数
+READY_FD_ENV = 'RECORDER_READY_FD'
+READY_MESSAGE = b'READY=1\n'
+# 起動完了を待つ最大秒数（Piの起動直後などは時間がかかる）
+READY_TIMEOUT = 15
+# ハートビートがこの秒数より古ければハングとみなして再起動する
+HANG_TIMEOUT = 10
+# ハートビートを確認する間隔（秒、プロセスの終了はこれを待たずに検知する）
+LIVENESS_CHECK_INTERVAL = 1.0
+# 再起動までの待ち時間（秒、失敗が続くたびに倍にする）
+RESTART_BACKOFF_MIN = 0.5
+RESTART_BACKOFF_MAX = 30
+# この秒数動き続けたら待ち時間を最小に戻す
+STABLE_SECONDS = 60
+
+logger = logging.getLogger(__name__)
+
+
+def notify_ready():
+    """起動完了をWebサーバーに知らせる（監視なしで起動された場合は何もしない）"""
+    fd = os.environ.pop(READY_FD_ENV, None)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), READY_MESSAGE)
+        os.close(int(fd))
+    except (OSError, ValueError) as e:
+        logger.warning(f"起動完了を通知できません: {e}")
+
+
+class WorkerSupervisor:
+    """ワーカープロセスを起動・監視し、異常終了したら再起動する
+
+    status_segment はワーカーのステータス領域（ハートビートと、異常終了の直前の
+    ステータスの読み出しに使う）。on_ready(状態) は異常終了からの再起動が完了する
+    たびに監視スレッドから呼ばれ、状態は終了直前のワーカーのステータス（録音の再開に使う）。
+    """
+
+    def __init__(self, psutil, status_segment, command, on_ready=None,
+                 ready_timeout=READY_TIMEOUT, hang_timeout=HANG_TIMEOUT):
+        self.psutil = psutil
+        self.status_segment = status_segment
+        self.command = command
+        self.on_ready = on_ready
+        self.ready_timeout = ready_timeout
+        self.hang_timeout = hang_timeout
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._process = None
+        self._started_at = None
+        self._stopping = False
+        self._thread = None
+
+    @property
+    def pid(self):
+        """監視中のワーカーのPID（いなければNone）"""
+        process = self._process
+        return process.pid if process else None
+
+    def is_running(self):
+        """ワーカーが動いているか"""
+        process = self._process
+        return process is not None and process.is_running()
+
+    def ensure_running(self):
+        """ワーカーが動いていなければ起動し、起動完了まで待つ（成否を返す）"""
+        with self._lock:
+            self._stopping = False
+            if self.is_running():
+                return True
+            if not self._adopt() and not self._spawn():
+                return False
+            self._start_watch()
+        return True
+
+    def stop(self):
+        """監視を止める（以降の終了では再起動しない）"""
+        self._stopping = True
+
+    def terminate(self):
+        """ワーカーに終了シグナルを送る（終了コマンドを送れなかった場合）"""
+        process = self._process
+        if process is None:
+            return
+        try:
+            process.terminate()
+        except self.psutil.Error:
+            pass
+
+    def _adopt(self):
+        """前回のWebサーバーが起動したワーカーが動いていれば、それを監視する"""
+        result = self.status_segment.read()
+        if not result:
+            return False
+        _, heartbeat, pid = result
+        if not pid or time.time() - heartbeat > self.hang_timeout:
+            return False
+        script = os.path.basename(self.command[-1])
+        try:
+            process = self.psutil.Process(pid)
+            # PIDが別のプロセスに再利用されていないか
+            if not any(os.path.basename(arg) == script for arg in process.cmdline()):
+                return False
+        except self.psutil.Error:
+            return False
+        logger.info(f"ワーカープロセスは既に起動中: PID {pid}")
+        self._process = process
+        self._started_at = time.monotonic()
+        return True
+
+    def _spawn(self):
+        """ワーカーを起動し、起動完了の通知を待つ"""
+        read_fd, write_fd = os.pipe()
+        try:
+            try:
+                popen = subprocess.Popen(
+                    self.command,
+                    pass_fds=(write_fd,),
+                    env=dict(os.environ, **{READY_FD_ENV: str(write_fd)}),
+                    start_new_session=True  # 親プロセスから独立
+                )
+            finally:
+                os.close(write_fd)
+            logger.info(f"ワーカープロセスを起動: PID {popen.pid}")
+            started = time.monotonic()
+            message = b''
+            # ワーカーが通知前に終了した場合はパイプが閉じられ、すぐに失敗がわかる
+            while READY_MESSAGE not in message and time.monotonic() - started < self.ready_timeout:
+                readable, _, _ = select.select([read_fd], [], [], self.ready_timeout - (time.monotonic() - started))
+                if not readable:
+                    continue
+                chunk = os.read(read_fd, 64)
+                if not chunk:
+                    break
+                message += chunk
+        finally:
+            os.close(read_fd)
+
+        if READY_MESSAGE not in message:
+            if popen.poll() is None:
+                logger.error(f"ワーカープロセスの起動確認がタイムアウトしました（{self.ready_timeout}秒）")
+                popen.kill()
+            else:
+                logger.error(f"ワーカープロセスが起動中に終了しました（終了コード {popen.returncode}）")
+            popen.wait()
+            return False
+        logger.info(f"ワーカープロセスの起動完了: {(time.monotonic() - started) * 1000:.0f}ms")
+        self._process = self.psutil.Process(popen.pid)
+        self._started_at = time.monotonic()
+        return True
+
+    def _start_watch(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._watch, daemon=True)
+            self._thread.start()
+
+    def _wait_exit(self, process):
+        """ワーカーが終了するまで待ち、終了理由を返す（ハングを検出したら強制終了する）"""
+        while True:
+            try:
+                code = process.wait(LIVENESS_CHECK_INTERVAL)
+                return f"終了コード {code}"
+            except self.psutil.TimeoutExpired:
+                pass
+            except self.psutil.Error:
+                return "プロセスが見つかりません"
+            if self._stopping:
+                continue
+            result = self.status_segment.read()
+            heartbeat = result[1] if result else 0
+            if time.time() - heartbeat > self.hang_timeout:
+                logger.error(f"ワーカーのハートビートが{self.hang_timeout}秒以上途絶えたため、強制終了します")
+                try:
+                    process.kill()
+                    process.wait(5)
+                except self.psutil.Error:
+                    pass
+                return "ハング"
+
+    def _stop_orphans(self, pid):
+        """終了したワーカーの子プロセス（ffmpegなど）を止める
+
+        ワーカーは新しいセッションで起動するため、子プロセスは同じプロセスグループに残る。
+        SIGTERMならffmpegは書きかけのファイルを閉じてから終了し、ソースも解放される。
+        """
+        try:
+            os.killpg(pid, signal.SIGTERM)
+            logger.info(f"終了したワーカーの子プロセスを停止しました（プロセスグループ {pid}）")
+        except ProcessLookupError:
+            pass
+        except OSError as e:
+            logger.warning(f"終了したワーカーの子プロセスを停止できません: {e}")
+
+    def _watch(self):
+        backoff = RESTART_BACKOFF_MIN
+        while True:
+            process = self._process
+            if process is None:
+                return
+            reason = self._wait_exit(process)
+            uptime = time.monotonic() - self._started_at
+            if self._stopping:
+                logger.info(f"ワーカープロセスが終了しました（{reason}）")
+                self._process = None
+                return
+
+            # 異常終了の直前のステータス（録音中だったか）は共有メモリに残っている
+            result = self.status_segment.read()
+            last_status = result[0] if result else None
+            logger.error(f"ワーカープロセスが異常終了しました（{reason}, 稼働 {uptime:.0f}秒）")
+            self._stop_orphans(process.pid)
+            if uptime >= STABLE_SECONDS:
+                backoff = RESTART_BACKOFF_MIN
+            while not self._stopping:
+                logger.info(f"{backoff:.1f}秒後にワーカープロセスを再起動します")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, RESTART_BACKOFF_MAX)
+                with self._lock:
+                    if self._stopping:
+                        break
+                    if self.is_running() and self._process is not process:
+                        # 待っている間に ensure_running() で起動された
+                        break
+                    self._process = None
+                    if self._spawn():
+                        self.restarts += 1
+                        break
+            if self._stopping:
+                self._process = None
+                return
+            if self.on_ready:
+                try:
+                    self.on_ready(last_status)
+                except Exception as e:
+                    logger.error(f"ワーカー再起動後の処理に失敗: {e}")
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+録音中のPCMの解析（波形のサイドカーファイルと入力レベル）
+録音中のPCMから一定間隔ごとの最小値・最大値を求め、録音ファイルの隣に
+<録音名>.peaks として追記していく。ブラウザはこのファイルだけで波形を描けるため、
+長い録音でも音声をダウンロードしたりPi上でデコードしたりせずに目的の箇所を探せる。
+同じPCMから入力レベル（RMS・ピーク）と無音の継続時間も求める（LevelMeter）。
+
+ファイル形式（リトルエンディアン）:
+  ヘッダー 8バイト: 'PEAK', バージョン(1), ビット数(8), 1秒あたりのピーク数(uint16)
+  以降、ピークごとに 最小値・最大値 の int8 の組（16bitのサンプルの上位8ビット）
+
+ピークができるたびに書き出すため、録音中のファイルの波形もそのまま表示できる。
+"""
+
+import logging
+import os
+import struct
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PEAKS_SUFFIX = '.peaks'
+PEAKS_MAGIC = b'PEAK'
+PEAKS_VERSION = 1
+PEAKS_HEADER = struct.Struct('<4sBBH')
+# 1秒あたりのピーク数（2時間の録音で約140KB）
+PEAKS_PER_SECOND = 10
+# ffmpegから波形用に受け取るPCMのサンプリングレート（モノラル）
+PEAKS_PCM_RATE = 8000
+# s16leの1サンプルのバイト数
+SAMPLE_WIDTH = 2
+# パイプから1回に読む量
+PIPE_READ_SIZE = 8192
+# 入力レベルを求める間隔（秒）
+LEVEL_INTERVAL = 0.25
+# 入力レベルの下限（dBFS、完全な無音もこの値にする）
+LEVEL_FLOOR_DB = -90.0
+# この値（RMS、dBFS）を下回る区間を無音とみなす
+SILENCE_DB = -60.0
+
+logger = logging.getLogger(__name__)
+
+
+def peaks_path(audio_path):
+    """録音ファイルに対応する波形ファイルのパス"""
+    return os.path.splitext(audio_path)[0] + PEAKS_SUFFIX
+
+
+def compute_peaks(data, bucket_bytes):
+    """PCM（s16le）をbucket_bytesごとに区切り、(最小値, 最大値) のint8の組のバイト列を返す"""
+    samples = numpy.frombuffer(data, dtype='<i2').reshape(-1, bucket_bytes // SAMPLE_WIDTH)
+    peaks = numpy.empty((len(samples), 2), dtype=numpy.int8)
+    peaks[:, 0] = samples.min(axis=1) >> 8
+    peaks[:, 1] = samples.max(axis=1) >> 8
+    return peaks.tobytes()
+
+
+def to_dbfs(values):
+    """16bitのサンプル値の大きさをdBFSに変換する"""
+    return numpy.maximum(20 * numpy.log10(numpy.maximum(values, 1e-9) / 32768), LEVEL_FLOOR_DB)
+
+
+def concat_peaks(paths, output):
+    """分割録音の波形ファイルをつなげる（ヘッダーは先頭のファイルのものを使う）"""
+    existing = [path for path in paths if os.path.exists(path)]
+    if len(existing) != len(paths) or not existing:
+        # 欠けたセグメントがあると時間がずれるため作らない
+        return False
+    tmp_path = output + '.part'
+    with open(tmp_path, 'wb') as out:
+        for index, path in enumerate(existing):
+            with open(path, 'rb') as f:
+                header = f.read(PEAKS_HEADER.size)
+                if index == 0:
+                    out.write(header)
+                out.write(f.read())
+    os.replace(tmp_path, output)
+    return True
+
+
+class PeaksWriter:
+    """PCMを受け取り、ピークを波形ファイルに追記する"""
+
+    def __init__(self, path, rate, channels, peaks_per_second=PEAKS_PER_SECOND):
+        if numpy is None:
+            raise RuntimeError("numpyがインストールされていません")
+        self.path = path
+        self.frame_size = SAMPLE_WIDTH * channels
+        self.bucket_bytes = max(1, rate // peaks_per_second) * self.frame_size
+        self._pending = bytearray()
+        self._file = open(path, 'wb')
+        self._file.write(PEAKS_HEADER.pack(PEAKS_MAGIC, PEAKS_VERSION, 8, peaks_per_second))
+        self._file.flush()
+
+    def write(self, data):
+        """PCMを追加する（波形の書き込みに失敗しても録音は止めない）"""
+        if self._file is None:
+            return
+        self._pending += data
+        size = len(self._pending) - len(self._pending) % self.bucket_bytes
+        if not size:
+            return
+        try:
+            self._file.write(compute_peaks(bytes(self._pending[:size]), self.bucket_bytes))
+            self._file.flush()
+        except OSError as e:
+            logger.error(f"波形ファイルに書き込めません: {self.path} {e}")
+            self._file.close()
+            self._file = None
+        del self._pending[:size]
+
+    def close(self):
+        """端数のPCMもピークにして閉じる"""
+        if self._file is None:
+            return
+        tail = bytes(self._pending[:len(self._pending) - len(self._pending) % self.frame_size])
+        try:
+            if tail:
+                self._file.write(compute_peaks(tail, len(tail)))
+        except OSError as e:
+            logger.error(f"波形ファイルに書き込めません: {self.path} {e}")
+        finally:
+            self._file.close()
+        self._file = None
+
+
+class LevelMeter:
+    """PCMの入力レベル（RMS・ピーク、dBFS）と無音の継続時間を求める
+
+    LEVEL_INTERVAL ごとの窓でまとめて計算し、最新の窓の値だけを持つ（メモリは一定）。
+    無音の継続時間は受け取ったサンプル数から数えるため、プリロールの分もそのまま反映される。
+    """
+
+    def __init__(self, rate, channels, interval=LEVEL_INTERVAL, silence_db=SILENCE_DB):
+        if numpy is None:
+            raise RuntimeError("numpyがインストールされていません")
+        self.rate = rate
+        self.frame_size = SAMPLE_WIDTH * channels
+        self.window_frames = max(1, int(rate * interval))
+        self.window_bytes = self.window_frames * self.frame_size
+        self.silence_db = silence_db
+        self._pending = bytearray()
+        self._rms_db = LEVEL_FLOOR_DB
+        self._peak_db = LEVEL_FLOOR_DB
+        self._silent_frames = 0
+
+    def write(self, data):
+        """PCMを追加する"""
+        self._pending += data
+        size = len(self._pending) - len(self._pending) % self.window_bytes
+        if not size:
+            return
+        samples = numpy.frombuffer(bytes(self._pending[:size]), dtype='<i2')
+        del self._pending[:size]
+        windows = samples.reshape(-1, self.window_bytes // SAMPLE_WIDTH).astype(numpy.float32)
+        rms_db = to_dbfs(numpy.sqrt(numpy.mean(windows * windows, axis=1)))
+        peak_db = to_dbfs(numpy.abs(windows).max(axis=1))
+        # 最後に音があった窓より後ろを無音として数える
+        loud = numpy.flatnonzero(rms_db >= self.silence_db)
+        if len(loud):
+            self._silent_frames = (len(rms_db) - 1 - loud[-1]) * self.window_frames
+        else:
+            self._silent_frames += len(rms_db) * self.window_frames
+        self._rms_db = float(rms_db[-1])
+        self._peak_db = float(peak_db.max())
+
+    def snapshot(self):
+        """最新の入力レベル"""
+        return {
+            'rms_db': round(self._rms_db, 1),
+            'peak_db': round(self._peak_db, 1),
+            'silent_seconds': round(self._silent_frames / self.rate, 1)
+        }
+
+    def close(self):
+        """PcmTapから呼ばれる（何もしない）"""
+
+
+class PcmTap:
+    """エンコーダーに渡すPCMを、波形ファイルや入力レベルの計算にも渡す（エンコーダーと同じインターフェース）"""
+
+    def __init__(self, encoder, *consumers):
+        self.encoder = encoder
+        self.consumers = consumers
+
+    def write(self, data):
+        """PCMを書き込む"""
+        self.encoder.write(data)
+        for consumer in self.consumers:
+            consumer.write(data)
+
+    def poll(self):
+        """エンコーダーの終了コード（実行中はNone）"""
+        return self.encoder.poll()
+
+    def close(self, timeout=10):
+        """エンコーダーと波形ファイルを閉じる"""
+        try:
+            self.encoder.close(timeout)
+        finally:
+            for consumer in self.consumers:
+                consumer.close()
+
+
+class PipePeaks:
+    """ffmpegが標準出力に出すPCM（s16le）を読み、波形ファイルに書き出す
+
+    分割録音では segment_seconds ごとに path_for(番号) の波形ファイルへ切り替える
+    （path_for がNoneなら波形ファイルは作らない）。meter があれば入力レベルも求める。
+    読み出しが止まるとffmpegの録音も止まるため、書き込みに失敗しても読み続ける。
+    """
+
+    def __init__(self, stream, path_for, rate=PEAKS_PCM_RATE, channels=1, segment_seconds=0, meter=None):
+        self.stream = stream
+        self.path_for = path_for
+        self.meter = meter
+        self.rate = rate
+        self.channels = channels
+        self.segment_bytes = int(segment_seconds * rate) * SAMPLE_WIDTH * channels
+        self._thread = threading.Thread(target=self._read_loop, daemon=True)
+        self._thread.start()
+
+    def _open(self, number):
+        if self.path_for is None:
+            return None
+        try:
+            return PeaksWriter(self.path_for(number), self.rate, self.channels)
+        except (OSError, RuntimeError) as e:
+            logger.error(f"波形ファイルを作成できません: {e}")
+            return None
+
+    def _read_loop(self):
+        number = 0
+        writer = None
+        # 現在のセグメントに書いたPCMのバイト数（Noneは次のデータで新しいファイルを開く）
+        written = None
+        try:
+            while True:
+                data = self.stream.read1(PIPE_READ_SIZE)
+                if not data:
+                    break
+                if self.meter:
+                    self.meter.write(data)
+                while data:
+                    if written is None:
+                        if writer:
+                            writer.close()
+                        number += 1
+                        writer = self._open(number)
+                        written = 0
+                    part = data[:self.segment_bytes - written] if self.segment_bytes else data
+                    if writer:
+                        writer.write(part)
+                    written += len(part)
+                    data = data[len(part):]
+                    if self.segment_bytes and written >= self.segment_bytes:
+                        # 次のデータから次のセグメントの波形ファイルに切り替える
+                        written = None
+        except Exception as e:
+            logger.error(f"波形用のPCMを処理できません: {e}")
+            # 読み出しを止めるとffmpegが詰まるため、終了まで読み捨てる
+            try:
+                while self.stream.read(PIPE_READ_SIZE):
+                    pass
+            except (OSError, ValueError):
+                pass
+        finally:
+            if writer:
+                writer.close()
+
+    def join(self, timeout=5):
+        """ffmpegの終了後、残りを書き終えるまで待つ"""
+        self._thread.join(timeout)
@@ -4,7 +4,8 @@ Raspberry Pi Web録音コントローラー（デバイス選択・ネットワ
 iPhoneからアクセスできるWebインターフェース付き録音アプリ
 """
 
-from flask import Flask, render_template, jsonify, request, send_file, redirect, url_for
+from flask import Flask, Response, g, render_template, jsonify, request, send_file, redirect, url_for
+from werkzeug.serving import WSGIRequestHandler
 import os
 import subprocess
 import threading
@@ -14,8 +15,30 @@ import time
 import logging
 import json
 import socket
+import uuid
 import psutil
 import argparse
+from datetime import datetime, timedelta
+
+try:
+    import waitress
+except ImportError:
+    waitress = None
+
+from recorder_bluez import ConnectionManager, DeviceInventory
+from recorder_catalog import RecordingCatalog
+from recorder_executor import CallTimeout, CoalescingExecutor, ExecutorBusy
+from recorder_ipc import (METRICS_SEGMENT, METRICS_SEGMENT_SIZE, CommandClient, CommandBusError,
+                          StatusSegment, StatusSubscriber)
+from recorder_jobs import JobQueue
+from recorder_live import LiveTail
+import recorder_metrics
+from recorder_metrics import COMMAND_ACK_SECONDS, COMMAND_REPLY_SECONDS, HTTP_REQUEST_SECONDS, run_command
+from recorder_presets import DEFAULT_PRESET, get_preset, preset_choices
+from recorder_schedule import MISSED_GRACE, PREWARM_SECONDS, RecordingScheduler, ScheduleStore
+from recorder_silence import silence_index_path
+from recorder_supervisor import WorkerSupervisor
+from recorder_waveform import peaks_path
 
 # Flaskアプリの設定
 app = Flask(__name__)
@@ -29,10 +52,34 @@ APP_ROOT = os.path.dirname(os.path.abspath(__file__))
 
 # 設定ファイルを、絶対パスを使って指定します
 CONFIG_FILE = os.path.join(APP_ROOT, "recorder_config.json")
-STATUS_FILE = os.path.join(APP_ROOT, "recorder_status.json")
-COMMAND_FILE = os.path.join(APP_ROOT, "recorder_command.json")
 WORKER_SCRIPT = os.path.join(APP_ROOT, "recorder_worker.py")
 RECORDINGS_DIR = os.path.join(APP_ROOT, "recordings")
+CATALOG_FILE = os.path.join(APP_ROOT, "recorder_catalog.db")
+JOBS_FILE = os.path.join(APP_ROOT, "recorder_jobs.db")
+SCHEDULE_FILE = os.path.join(APP_ROOT, "recorder_schedule.json")
+
+# ハートビートがこの秒数より古ければワーカーは停止しているとみなす
+WORKER_HEARTBEAT_TIMEOUT = 10
+# 終了コマンドの応答を待つ秒数（ワーカーは録音中のファイルを確定させてから応答する）
+WORKER_SHUTDOWN_TIMEOUT = 15
+
+# IPアドレスのキャッシュ有効期間（秒）
+IP_ADDRESS_CACHE_TTL = 30
+# SSEでステータスに変化がない場合のキープアライブ間隔（秒）
+SSE_KEEPALIVE_INTERVAL = 15
+# ワーカーのメトリクスがこの秒数より古ければ /metrics に含めない
+WORKER_METRICS_TIMEOUT = 15
+# 録音ファイル一覧の1ページの件数（既定値と上限）
+FILES_PER_PAGE = 10
+FILES_PER_PAGE_MAX = 100
+# 遅い処理（外部コマンド）の結果をリクエストで待つ最大秒数
+DEVICE_SCAN_TIMEOUT = 15
+WIFI_CONNECT_TIMEOUT = 60
+DEBUG_COMMAND_TIMEOUT = 35
+# Wi-Fiのスキャン結果のキャッシュ有効期間（秒、過ぎたら表示のついでにバックグラウンドで取り直す）
+WIFI_SCAN_CACHE_TTL = 60
+# waitressのワーカースレッド数（/events と /live のストリームは接続中ずっと1スレッドを使う）
+SERVER_THREADS = 16
 
 # --- ここから大幅な変更・追加 ---
 
@@ -48,26 +95,36 @@ def get_ip_address():
     except Exception:
         # APモードの場合などはこちら
         try:
-            result = subprocess.check_output("hostname -I", shell=True).decode().strip()
+            result = run_command("hostname -I", shell=True, check=True, stdout=subprocess.PIPE).stdout.decode().strip()
             return result.split()[0]
         except Exception:
             return "127.0.0.1"
 
+_ip_address_cache = {'value': None, 'expires': 0}
+
+def get_cached_ip_address():
+    """IPアドレスを一定時間キャッシュして返す"""
+    now = time.time()
+    if now >= _ip_address_cache['expires']:
+        _ip_address_cache['value'] = get_ip_address()
+        _ip_address_cache['expires'] = now + IP_ADDRESS_CACHE_TTL
+    return _ip_address_cache['value']
+
 def is_wifi_connected():
     """Wi-Fiに接続されているか確認"""
     try:
         # `iwgetid` は接続中のWi-Fi名(SSID)を返す。接続してなければ空。
-        result = subprocess.check_output("iwgetid -r", shell=True).decode().strip()
+        result = run_command("iwgetid -r", shell=True, check=True, stdout=subprocess.PIPE).stdout.decode().strip()
         return bool(result)
     except subprocess.CalledProcessError:
         return False
 
-def scan_wifi_networks():
-    """利用可能なWi-Fiネットワークをスキャン"""
+def scan_wifi_networks(rescan=False):
+    """利用可能なWi-Fiネットワークをスキャン（rescan=Trueならnmcliのキャッシュを使わず取り直す）"""
     networks = []
     try:
         # `nmcli` を使ってデバイス一覧を取得し、Wi-Fiデバイス名を探す
-        result = subprocess.check_output("nmcli -t -f DEVICE,TYPE device", shell=True).decode()
+        result = run_command("nmcli -t -f DEVICE,TYPE device", shell=True, check=True, stdout=subprocess.PIPE).stdout.decode()
         wifi_device = None
         for line in result.strip().split('\n'):
             dev, dev_type = line.split(':')
@@ -81,7 +138,9 @@ def scan_wifi_networks():
 
         # Wi-Fiネットワークをスキャン
         scan_cmd = f"sudo nmcli --get-values SSID,SIGNAL,SECURITY device wifi list ifname {wifi_device}"
-        result = subprocess.check_output(scan_cmd, shell=True).decode()
+        if rescan:
+            scan_cmd += " --rescan yes"
+        result = run_command(scan_cmd, shell=True, check=True, stdout=subprocess.PIPE).stdout.decode()
         
         seen_ssids = set()
         for line in result.strip().split('\n\n'):
@@ -102,88 +161,192 @@ def connect_to_wifi(ssid, password):
     """指定されたWi-Fiに接続"""
     try:
         connect_cmd = f'sudo nmcli device wifi connect "{ssid}" password "{password}"' if password else f'sudo nmcli device wifi connect "{ssid}"'
-        subprocess.check_output(connect_cmd, shell=True, stderr=subprocess.STDOUT)
+        run_command(connect_cmd, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
         return True, f"{ssid}への接続に成功しました。システムを再起動します。"
     except subprocess.CalledProcessError as e:
         return False, f"Wi-Fiへの接続に失敗しました: {e.output.decode()}"
 # グローバル変数
 selected_device = None
 selected_adapter = None
-worker_process = None
+command_client = CommandClient()
+status_segment = StatusSegment()
+metrics_segment = StatusSegment(METRICS_SEGMENT, METRICS_SEGMENT_SIZE)
+device_inventory = DeviceInventory()
+# Wi-Fiのスキャンやbluetoothctlなど、数秒かかる処理はリクエストのスレッドから切り離して実行する
+slow_calls = CoalescingExecutor()
+
+class WifiScanCache:
+    """Wi-Fiのスキャン結果を保持し、古くなったらバックグラウンドで取り直す
+
+    スキャンは slow_calls で実行するため、同時の再スキャン要求は1回にまとまる。
+    明示的な再スキャン（rescan=True）は取り直しとは別にまとめ、実行中の取り直しに合流させない。
+    """
+
+    def __init__(self, scan, ttl=WIFI_SCAN_CACHE_TTL):
+        self.scan = scan
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._networks = []
+        self._scanned_at = None
+        self._started_at = None
+        self._scanning = None
+
+    def refresh(self, rescan=False):
+        """スキャンをバックグラウンドで始める（同じ種類のスキャンが実行中ならそれにまとめる）"""
+        try:
+            future = slow_calls.submit('wifi_rescan' if rescan else 'wifi_scan', self._scan, rescan)
+        except ExecutorBusy as e:
+            logging.warning(f"Wi-Fiのスキャンを開始できません: {e}")
+            return
+        with self._lock:
+            self._scanning = future
+
+    def _scan(self, rescan):
+        started_at = time.time()
+        networks = self.scan(rescan=rescan)
+        with self._lock:
+            # 後から始めたスキャンの結果が先に届いていれば、古い結果で上書きしない
+            if self._started_at is not None and started_at < self._started_at:
+                return
+            self._networks = networks
+            self._started_at = started_at
+            self._scanned_at = time.time()
+
+    def snapshot(self):
+        """キャッシュしたネットワーク一覧（古ければ取り直しを始める）"""
+        with self._lock:
+            stale = self._scanned_at is None or time.time() - self._scanned_at >= self.ttl
+            scanning = self._scanning is not None and not self._scanning.done()
+        if stale and not scanning:
+            self.refresh()
+            scanning = True
+        with self._lock:
+            return {'networks': list(self._networks), 'scanned_at': self._scanned_at, 'scanning': scanning}
+
+wifi_scan_cache = WifiScanCache(scan_wifi_networks)
+
+class StatusHub:
+    """ワーカーから配信されたステータスを保持し、SSEクライアントに変化を知らせる
+
+    Webサーバー側の状態（Bluetooth接続状態など）も extras として同じ配信に載せる。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._status = {'recording': False, 'status': 'offline'}
+        self._extras = {}
+        self._version = 0
+
+    def update(self, status):
+        """StatusSubscriberからのコールバック（Noneはワーカー停止）"""
+        if status is None:
+            status = {'recording': False, 'status': 'offline'}
+        with self._cond:
+            if status == self._status:
+                return
+            self._status = status
+            self._version += 1
+            self._cond.notify_all()
+
+    def update_extra(self, key, value):
+        """Webサーバー側の状態を更新する"""
+        with self._cond:
+            if self._extras.get(key) == value:
+                return
+            self._extras[key] = value
+            self._version += 1
+            self._cond.notify_all()
+
+    def snapshot(self):
+        """最新のワーカーのステータス"""
+        with self._cond:
+            return dict(self._status)
 
-def send_command(command):
-    """ワーカープロセスにコマンドを送信"""
+    def wait(self, version, timeout):
+        """versionより新しいステータスが届くまで待ち、(version, status)を返す"""
+        with self._cond:
+            if self._version == version:
+                self._cond.wait(timeout)
+            return self._version, dict(self._status, **self._extras)
+
+status_hub = StatusHub()
+
+def on_worker_status(status):
+    """ワーカーのステータスを配信し、録音中のセッションのデバイスを接続済みに保たせる"""
+    status_hub.update(status)
+    sessions = (status or {}).get('sessions') or {}
+    connection_manager.set_session_devices(
+        [session['device'] for session in sessions.values() if session.get('device')])
+
+status_subscriber = StatusSubscriber(on_worker_status)
+
+def current_recording_file():
+    """録音中のファイル名（分割録音では書き込み中のセグメント）。録音していなければNone"""
+    status = status_hub.snapshot()
+    return status.get('filename') if status.get('recording') else None
+
+# 録音中のファイルを1つのスレッドで追従し、/live の全リスナーに配る
+live_tail = LiveTail(RECORDINGS_DIR, current_recording_file)
+
+# 録音ファイルのカタログ（ワーカーが録音終了時に登録し、起動時に差分を反映する）
+recording_catalog = RecordingCatalog(CATALOG_FILE)
+
+# 後処理ジョブ（実行はワーカー。Webサーバーは一覧の参照のみ）
+job_queue = JobQueue(JOBS_FILE, RECORDINGS_DIR)
+
+def sync_recording_catalog():
+    """録音ディレクトリとカタログの差分を反映する"""
     try:
-        with open(COMMAND_FILE, 'w') as f:
-            json.dump(command, f)
-        return True
+        recording_catalog.sync(RECORDINGS_DIR)
     except Exception as e:
+        logging.error(f"録音カタログの更新に失敗: {e}")
+
+def parse_date(value, days=0):
+    """YYYY-MM-DD をその日（+days日）の0時のUNIX時間に変換する"""
+    if not value:
+        return None
+    return (datetime.strptime(value, '%Y-%m-%d') + timedelta(days=days)).timestamp()
+
+def send_command(command, timeout=5.0):
+    """ワーカープロセスにコマンドを送信し、ワーカーの応答を返す（失敗時はNone）"""
+    try:
+        reply = command_client.send(command, timeout=timeout)
+        COMMAND_ACK_SECONDS.observe(reply['ack_latency'], action=command.get('action'))
+        COMMAND_REPLY_SECONDS.observe(reply['reply_latency'], action=command.get('action'))
+        logging.info(f"コマンド応答: {command.get('action')} seq={reply.get('seq')} "
+                     f"ack={reply['ack_latency'] * 1000:.1f}ms reply={reply['reply_latency'] * 1000:.1f}ms")
+        return reply
+    except CommandBusError as e:
         logging.error(f"コマンド送信エラー: {e}")
-        return False
+        return None
 
 def get_worker_status():
-    """ワーカープロセスのステータスを取得"""
+    """ワーカープロセスのステータスを共有メモリから取得"""
     try:
-        if not os.path.exists(STATUS_FILE):
-            return None
-        
-        # ファイルが空の場合にJSONDecodeErrorが発生するのを防ぐ
-        if os.path.getsize(STATUS_FILE) == 0:
-            # 少し待ってからリトライするかもしれない
+        result = status_segment.read()
+        if not result:
             return None
+        status, heartbeat, pid = result
 
-        with open(STATUS_FILE, 'r') as f:
-            status = json.load(f)
-
-        # ステータスが古すぎる場合はワーカーが死んでいる可能性
-        if time.time() - status.get('updated_at', 0) > 10:
-            logging.warning("ステータスファイルが古いため、ワーカーは停止していると判断します。")
+        # 監視中のワーカーが終了していれば、ハートビートの期限を待たずに停止とみなす
+        if not worker_supervisor.is_running():
+            return None
+        # ハートビートが古すぎる場合はワーカーが死んでいる可能性
+        if time.time() - heartbeat > WORKER_HEARTBEAT_TIMEOUT:
+            logging.warning("ハートビートが古いため、ワーカーは停止していると判断します。")
             return None
 
+        status['updated_at'] = heartbeat
+        status['pid'] = pid
         return status
-    except json.JSONDecodeError:
-        # ファイルが書き込み中の場合などに発生する可能性があるため、エラーとせずNoneを返す
-        logging.warning("ステータスファイルの読み込み中にJSONDecodeErrorが発生しました。")
-        return None
     except Exception as e:
         logging.error(f"ステータス取得エラー: {e}")
         return None
 
 def start_worker_process():
-    """ワーカープロセスを起動"""
-    global worker_process
-    
+    """ワーカープロセスを起動し、起動完了の通知を待つ（起動済みなら何もしない）"""
     try:
-        # 既存のワーカーを確認
-        status = get_worker_status()
-        if status and status.get('pid'):
-            try:
-                # プロセスが生きているか確認
-                if psutil.pid_exists(status['pid']):
-                    logging.info(f"ワーカープロセスは既に起動中: PID {status['pid']}")
-                    return True
-            except:
-                pass
-        
-        # 新しいワーカーを起動
-        worker_process = subprocess.Popen(
-            [sys.executable, WORKER_SCRIPT],
-            start_new_session=True  # 親プロセスから独立
-        )
-        
-        logging.info(f"ワーカープロセスを起動: PID {worker_process.pid}")
-        
-        # ワーカーの起動を待つ
-        # Piの起動直後などは時間がかかる可能性があるため、10秒待つ
-        for i in range(100):
-            if get_worker_status():
-                return True
-            time.sleep(0.1)
-        
-        logging.error("ワーカープロセスの起動確認がタイムアウトしました。ステータスファイルが生成されていません。")
-        
-        return False
-        
+        return worker_supervisor.ensure_running()
     except Exception as e:
         logging.error(f"ワーカー起動エラー: {e}")
         return False
@@ -199,30 +362,167 @@ def load_config():
                 selected_device = config.get('selected_device')
                 selected_adapter = config.get('selected_adapter')
                 logging.info(f"設定を読み込みました: {selected_device}")
+                connection_manager.set_device(selected_device)
         except Exception as e:
             logging.error(f"設定ファイルの読み込みエラー: {e}")
 
-def save_config():
-    """設定ファイルに保存"""
+def save_config(**settings):
+    """設定ファイルに保存（ワーカー用の録音設定など、他のキーは保持する。settingsは一緒に書き込む設定）"""
     try:
-        config = {
+        config = {}
+        if os.path.exists(CONFIG_FILE):
+            try:
+                with open(CONFIG_FILE, 'r') as f:
+                    config = json.load(f)
+            except ValueError:
+                config = {}
+        config.update({
             'selected_device': selected_device,
             'selected_adapter': selected_adapter
-        }
+        }, **settings)
         with open(CONFIG_FILE, 'w') as f:
             json.dump(config, f, indent=2)
         logging.info(f"設定を保存しました: {selected_device}")
     except Exception as e:
         logging.error(f"設定ファイルの保存エラー: {e}")
 
+def configured_preset():
+    """recorder_config.json のエンコードのプリセット（録音ごとの指定がない場合に使う）"""
+    try:
+        with open(CONFIG_FILE, 'r') as f:
+            preset = json.load(f).get('encoder_preset')
+    except (OSError, ValueError):
+        preset = None
+    return preset if get_preset(preset) else DEFAULT_PRESET
+
+def start_worker_recording(device_info, duration_minutes, resumed_from=None, session_id=None, preset=None):
+    """ワーカーに録音を開始させる（録音開始APIと予約録音から呼ばれる）: (成功, メッセージ, セッションID)
+
+    デバイスごとに別のセッションとして録音するため、別のデバイスの録音中でも開始できる。
+    preset はエンコードのプリセット（省略時はワーカーが設定の encoder_preset を使う）。
+    """
+    # ワーカーが起動していない場合は起動
+    if not start_worker_process():
+        return False, 'ワーカープロセスの起動に失敗しました', None
+    
+    if not device_info:
+        return False, 'デバイスが選択されていません', None
+
+    # このデバイスで既に録音中か確認
+    status = get_worker_status()
+    for session in ((status or {}).get('sessions') or {}).values():
+        if (session.get('device') or {}).get('mac') == device_info.get('mac'):
+            return False, '既に録音中です', session['session']
+    
+    # デバイスの接続はバックグラウンドで維持しているため、ここでは待たない。
+    # 未接続なら即座に再接続を依頼し、ワーカー側でPulseAudioのソースが現れるのを待つ
+    if not connection_manager.is_connected(device_info):
+        logging.info(f"デバイス未接続のまま録音を開始します（接続を依頼）: {device_info.get('mac')}")
+        connection_manager.request_connect(device_info)
+    
+    # ワーカーにコマンドを送信（録音時間が過ぎるとワーカーが自動で停止する）
+    session_id = session_id or uuid.uuid4().hex[:8]
+    command = {
+        'action': 'start',
+        'session': session_id,
+        'duration': duration_minutes,
+        'device': device_info,
+        'resumed_from': resumed_from,
+        'preset': preset
+    }
+    
+    reply = send_command(command)
+    if not reply:
+        return False, 'コマンドの送信に失敗しました', None
+    if not reply.get('success'):
+        return False, reply.get('message'), None
+    
+    logging.info(f"録音開始コマンド送信: {duration_minutes or '停止まで'}分間, デバイス: {device_info['name']}, "
+                 f"セッション: {session_id}")
+    if not duration_minutes:
+        return True, '録音を開始しました', session_id
+    return True, f'{duration_minutes}分間の録音を開始しました', session_id
+
+def prewarm_scheduled_recording(entry):
+    """予約録音の開始前に、デバイスの接続とワーカーのソースを準備する"""
+    device_info = entry['device']
+    connection_manager.request_connect(device_info)
+    if not start_worker_process():
+        logging.error("予約録音の準備: ワーカープロセスの起動に失敗しました")
+        return
+    # プリロールが無効でもソースを開かせ、開始時にすぐ書き込めるようにする
+    send_command({'action': 'arm', 'device': device_info, 'prewarm': PREWARM_SECONDS + MISSED_GRACE})
+
+def start_scheduled_recording(entry):
+    """予約録音を開始する"""
+    success, message, _ = start_worker_recording(entry['device'], entry['duration'])
+    if not success:
+        logging.error(f"予約録音を開始できませんでした: {entry['name']} {message}")
+
+def arm_worker_preroll():
+    """選択中のデバイスでワーカーの待機録音（プリロール）を開始させる"""
+    if selected_device:
+        send_command({'action': 'arm', 'device': selected_device})
+
+def resume_after_worker_restart(last_status):
+    """異常終了したワーカーの再起動後に呼ばれる。録音中だったセッションは新しいファイルで再開する"""
+    if not last_status:
+        arm_worker_preroll()
+        return
+    sessions = list((last_status.get('sessions') or {}).values())
+    if not sessions and last_status.get('recording'):
+        sessions = [last_status]
+    # ソースを待っていたセッションも録音を始めようとしていたので再開する
+    sessions = [session for session in sessions if session.get('recording') or session.get('status') == 'starting']
+    if not sessions:
+        arm_worker_preroll()
+        return
+    for session in sessions:
+        resume_session(session)
+
+def resume_session(session):
+    """中断された録音を、同じセッションIDで残りの録音時間だけ録音し直す"""
+    info = session.get('recording_info') or {}
+    duration_minutes = None
+    if info.get('stop_at'):
+        # 録音時間の指定があれば、残りの時間だけ録音する
+        remaining = info['stop_at'] - time.time()
+        if remaining <= 0:
+            logging.info(f"中断された録音は録音時間を過ぎていたため、再開しません: {session.get('filename')}")
+            return
+        duration_minutes = round(remaining / 60, 2)
+    device_info = session.get('device') or selected_device
+    logging.warning(f"ワーカーの異常終了で中断された録音を再開します: {session.get('filename')}")
+    success, message, _ = start_worker_recording(device_info, duration_minutes,
+                                                 resumed_from=session.get('filename'),
+                                                 session_id=session.get('session'),
+                                                 preset=info.get('preset'))
+    if not success:
+        logging.error(f"中断された録音を再開できませんでした: {message}")
+
+# ワーカーの起動完了をパイプで受け取り、異常終了したら再起動する
+worker_supervisor = WorkerSupervisor(psutil, status_segment, [sys.executable, WORKER_SCRIPT],
+                                     on_ready=resume_after_worker_restart,
+                                     hang_timeout=WORKER_HEARTBEAT_TIMEOUT)
+
 def get_bluetooth_devices():
-    """すべてのBluetoothアダプタからペアリング済みデバイスを取得"""
+    """すべてのBluetoothアダプタからペアリング済みデバイスを取得
+
+    BlueZのD-Bus連携が使える場合はキャッシュから即座に返し、
+    使えない場合のみbluetoothctlで問い合わせる。
+    """
+    if device_inventory.available:
+        return device_inventory.devices()
+    return get_bluetooth_devices_cli()
+
+def get_bluetooth_devices_cli():
+    """bluetoothctlを使ってペアリング済みデバイスを取得（D-Bus非対応環境向け）"""
     devices = []
     
     try:
         # 利用可能なアダプタを取得
-        hci_result = subprocess.run(['hciconfig'], 
-                                  capture_output=True, text=True, timeout=10)
+        hci_result = run_command(['hciconfig'], 
+                               capture_output=True, text=True, timeout=10)
         
         logging.info("hciconfig output:")
         logging.info(hci_result.stdout)
@@ -250,9 +550,9 @@ def get_bluetooth_devices():
             
             # bluetoothctlで各アダプタを選択してデバイスを取得
             cmd = f'select {adapter["address"]}\ndevices\nexit\n'
-            result = subprocess.run(['bluetoothctl'], 
-                                  input=cmd,
-                                  capture_output=True, text=True, timeout=10)
+            result = run_command(['bluetoothctl'], 
+                               input=cmd,
+                               capture_output=True, text=True, timeout=10)
             
             logging.info(f"bluetoothctl devices output for {adapter['name']}:")
             logging.info(result.stdout)
@@ -272,9 +572,9 @@ def get_bluetooth_devices():
                             
                             # デバイスの詳細情報を取得
                             info_cmd = f'select {adapter["address"]}\ninfo {mac}\nexit\n'
-                            info_result = subprocess.run(['bluetoothctl'],
-                                                       input=info_cmd,
-                                                       capture_output=True, text=True, timeout=10)
+                            info_result = run_command(['bluetoothctl'],
+                                                    input=info_cmd,
+                                                    capture_output=True, text=True, timeout=10)
                             
                             info_lower = info_result.stdout.lower()
                             connected = 'connected: yes' in info_lower
@@ -298,8 +598,8 @@ def get_bluetooth_devices():
             logging.info("No devices found with adapter selection, trying default adapter...")
             
             # デフォルトアダプタでデバイスを取得
-            result = subprocess.run(['bluetoothctl', 'devices'], 
-                                  capture_output=True, text=True, timeout=10)
+            result = run_command(['bluetoothctl', 'devices'], 
+                               capture_output=True, text=True, timeout=10)
             
             logging.info("Default adapter devices:")
             logging.info(result.stdout)
@@ -313,8 +613,8 @@ def get_bluetooth_devices():
                             name = parts[2]
                             
                             # デバイスの詳細情報を取得
-                            info_result = subprocess.run(['bluetoothctl', 'info', mac],
-                                                       capture_output=True, text=True, timeout=10)
+                            info_result = run_command(['bluetoothctl', 'info', mac],
+                                                    capture_output=True, text=True, timeout=10)
                             
                             info_lower = info_result.stdout.lower()
                             connected = 'connected: yes' in info_lower
@@ -329,9 +629,9 @@ def get_bluetooth_devices():
                                 # アダプタを特定する
                                 for adapter in adapters:
                                     check_cmd = f'select {adapter["address"]}\ninfo {mac}\nexit\n'
-                                    check_result = subprocess.run(['bluetoothctl'],
-                                                                input=check_cmd,
-                                                                capture_output=True, text=True, timeout=5)
+                                    check_result = run_command(['bluetoothctl'],
+                                                             input=check_cmd,
+                                                             capture_output=True, text=True, timeout=5)
                                     if 'Device' in check_result.stdout and mac in check_result.stdout:
                                         adapter_addr = adapter['address']
                                         adapter_name = adapter['name']
@@ -361,9 +661,9 @@ def check_device_connection(device_info):
     try:
         # アダプタを選択してデバイス情報を取得
         cmd = f'select {device_info["adapter"]}\ninfo {device_info["mac"]}\nexit\n'
-        result = subprocess.run(['bluetoothctl'],
-                              input=cmd,
-                              capture_output=True, text=True, timeout=10)
+        result = run_command(['bluetoothctl'],
+                           input=cmd,
+                           capture_output=True, text=True, timeout=10)
         
         if result.returncode == 0:
             info_output = result.stdout.lower()
@@ -374,16 +674,16 @@ def check_device_connection(device_info):
             elif 'paired: yes' in info_output:
                 # 自動接続を試行
                 connect_cmd = f'select {device_info["adapter"]}\nconnect {device_info["mac"]}\nexit\n'
-                connect_result = subprocess.run(['bluetoothctl'],
-                                              input=connect_cmd,
-                                              capture_output=True, text=True, timeout=15)
+                connect_result = run_command(['bluetoothctl'],
+                                           input=connect_cmd,
+                                           capture_output=True, text=True, timeout=15)
                 
                 if connect_result.returncode == 0:
                     time.sleep(3)
                     # 再度確認
-                    verify_result = subprocess.run(['bluetoothctl'],
-                                                 input=cmd,
-                                                 capture_output=True, text=True, timeout=10)
+                    verify_result = run_command(['bluetoothctl'],
+                                              input=cmd,
+                                              capture_output=True, text=True, timeout=10)
                     if 'connected: yes' in verify_result.stdout.lower():
                         return True, "デバイスへの接続に成功しました"
                     else:
@@ -400,25 +700,65 @@ def check_device_connection(device_info):
     except Exception as e:
         return False, f"Bluetoothチェック中にエラーが発生しました: {e}"
 
+# 選択中のデバイスをバックグラウンドで接続済みに保つ
+connection_manager = ConnectionManager(
+    check_device_connection, device_inventory,
+    on_change=lambda state: status_hub.update_extra('bluetooth', state))
+
+# 予約録音（開始前にデバイスとソースを準備し、開始時刻に録音を始める）
+schedule_store = ScheduleStore(SCHEDULE_FILE)
+recording_scheduler = RecordingScheduler(schedule_store, prewarm_scheduled_recording, start_scheduled_recording)
+
+@app.before_request
+def start_request_timer():
+    """リクエストの処理時間の計測を始める"""
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    """ルートごとのリクエストの処理時間を記録する（ファイル名などでラベルが増えないようルールで集計）"""
+    started = g.pop('request_started', None)
+    if started is not None:
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                     route=request.url_rule.rule if request.url_rule else 'unmatched',
+                                     method=request.method, status=response.status_code)
+    return response
+
 @app.route('/')
 def index():
     """メインページ"""
     if is_setup_mode:
         return redirect(url_for('setup'))
-    return render_template('index.html')
+    return render_template('index.html', presets=preset_choices(), current_preset=configured_preset())
 
 @app.route('/setup', methods=['GET'])
 def setup():
     """Wi-Fi設定ページ"""
-    networks = scan_wifi_networks()
-    return render_template('setup.html', networks=networks)
+    # スキャンを待たずにキャッシュで表示する（ページ側で更新を取りに来る）
+    scan = wifi_scan_cache.snapshot()
+    return render_template('setup.html', networks=scan['networks'], scanning=scan['scanning'])
+
+@app.route('/wifi_networks')
+def wifi_networks():
+    """キャッシュしたWi-Fiネットワーク一覧"""
+    return jsonify(wifi_scan_cache.snapshot())
+
+@app.route('/wifi_networks/rescan', methods=['POST'])
+def rescan_wifi_networks():
+    """Wi-Fiを再スキャンする（結果は /wifi_networks で取得）"""
+    wifi_scan_cache.refresh(rescan=True)
+    return jsonify(dict(wifi_scan_cache.snapshot(), success=True)), 202
 
 @app.route('/connect', methods=['POST'])
 def connect():
     """Wi-Fi接続処理"""
     ssid = request.form.get('ssid')
     password = request.form.get('password')
-    success, message = connect_to_wifi(ssid, password)
+    try:
+        success, message = slow_calls.run(('wifi_connect', ssid), connect_to_wifi, ssid, password,
+                                          timeout=WIFI_CONNECT_TIMEOUT)
+    except (CallTimeout, ExecutorBusy):
+        success, message = False, "Wi-Fiへの接続に時間がかかっています。しばらくしてから再度お試しください。"
     
     if success:
         def reboot_pi():
@@ -434,7 +774,8 @@ def get_devices():
     global selected_device, selected_adapter
     logging.info("=== /get_devices API called ===")
     try:
-        devices = get_bluetooth_devices()
+        # 同時に来たリクエストは実行中の1回の取得の結果を共有する
+        devices = slow_calls.run('devices', get_bluetooth_devices, timeout=DEVICE_SCAN_TIMEOUT)
         logging.info(f"Found {len(devices)} devices")
         
         # --- iPhone自動選択ロジックを追加 ---
@@ -447,6 +788,8 @@ def get_devices():
                     selected_adapter = device.get('adapter')
                     logging.info(f"デフォルトデバイスとしてiPhoneを自動選択: {device['name']}")
                     save_config()
+                    connection_manager.set_device(selected_device)
+                    arm_worker_preroll()
                     break
         # --- ここまで ---
 
@@ -473,6 +816,13 @@ def get_devices():
         logging.info(f"Returning {len(devices)} devices to client")
         return jsonify(response_data)
         
+    except (CallTimeout, ExecutorBusy):
+        return jsonify({
+            'success': False,
+            'devices': [],
+            'error': 'デバイス一覧の取得に時間がかかっています。しばらくしてから再度お試しください。'
+        }), 503
+
     except Exception as e:
         logging.error(f"Error in /get_devices: {e}")
         import traceback
@@ -493,6 +843,8 @@ def save_device():
     selected_adapter = data.get('adapter')
     
     save_config()
+    connection_manager.set_device(selected_device)
+    arm_worker_preroll()
     
     return jsonify({
         'success': True,
@@ -510,93 +862,58 @@ def check_connection():
             'message': 'デバイスが選択されていません'
         })
     
-    connected, message = check_device_connection(data)
+    # 接続処理はバックグラウンドで行い、現在の状態を即座に返す
+    connection_manager.request_connect(data)
+    state = connection_manager.state()
     return jsonify({
-        'connected': connected,
-        'message': message
+        'connected': state['state'] == 'connected',
+        'state': state['state'],
+        'message': state['message'] or 'デバイスに接続しています'
     })
 
 @app.route('/start_recording', methods=['POST'])
 def start_recording():
-    """録音開始API"""
-    global selected_device
-    
-    # ワーカーのステータスを確認
-    status = get_worker_status()
-    if not status:
-        # ワーカーが起動していない場合は起動
-        if not start_worker_process():
-            return jsonify({
-                'success': False,
-                'message': 'ワーカープロセスの起動に失敗しました'
-            })
-    
-    # 既に録音中か確認
-    status = get_worker_status()
-    if status and status.get('recording'):
-        return jsonify({
-            'success': False,
-            'message': '既に録音中です'
-        })
-    
-    # リクエストからデバイス情報を取得
+    """録音開始API（preset でエンコードのプリセットを選ぶと、次回以降の既定値としても保存する）"""
     data = request.get_json()
-    device_info = data.get('device')
-    
-    if not device_info:
-        return jsonify({
-            'success': False,
-            'message': 'デバイスが選択されていません'
-        })
-    
-    # デバイスの接続確認
-    connected, message = check_device_connection(device_info)
-    if not connected:
-        return jsonify({
-            'success': False,
-            'message': message
-        })
-    
+    preset = data.get('preset')
+    if preset:
+        if not get_preset(preset):
+            return jsonify({'success': False, 'message': f'不明なエンコードのプリセットです: {preset}'}), 400
+        if preset != configured_preset():
+            save_config(encoder_preset=preset)
     # 録音時間を取得（デフォルト120分）
-    duration_minutes = data.get('duration', 120)
-    
-    # ワーカーにコマンドを送信
-    command = {
-        'action': 'start',
-        'duration': duration_minutes,
-        'device': device_info
-    }
-    
-    if not send_command(command):
-        return jsonify({
-            'success': False,
-            'message': 'コマンドの送信に失敗しました'
-        })
-    
-    logging.info(f"録音開始コマンド送信: {duration_minutes}分間, デバイス: {device_info['name']}")
-    
+    success, message, session_id = start_worker_recording(data.get('device'), data.get('duration', 120),
+                                                          preset=preset)
     return jsonify({
-        'success': True,
-        'message': f'{duration_minutes}分間の録音を開始しました'
+        'success': success,
+        'message': message,
+        'session': session_id
     })
 
 @app.route('/stop_recording', methods=['POST'])
 def stop_recording():
-    """録音停止API"""
-    status = get_worker_status()
-    if not status or not status.get('recording'):
-        return jsonify({
-            'success': False,
-            'message': '録音中ではありません'
-        })
-    
+    """録音停止API（session か device を指定するとその録音だけ、指定がなければすべて停止）"""
+    data = request.get_json(silent=True) or {}
+    # 開始した直後（ステータスがまだ recording でない）でも停止できるよう、
+    # 録音中かどうかはステータスではなくワーカーのセッションで判断させる
     try:
         # 停止コマンドを送信
-        if not send_command({'action': 'stop'}):
+        command = {'action': 'stop'}
+        if data.get('session'):
+            command['session'] = data['session']
+        elif data.get('device'):
+            command['device'] = data['device']
+        reply = send_command(command)
+        if not reply:
             return jsonify({
                 'success': False,
                 'message': 'コマンドの送信に失敗しました'
             })
+        if not reply.get('success'):
+            return jsonify({
+                'success': False,
+                'message': reply.get('message')
+            })
         
         logging.info("録音停止完了")
         return jsonify({
@@ -625,24 +942,76 @@ def get_status():
             'status': 'offline'
         }
     
-    response_data['ip_address'] = get_ip_address()
+    response_data['ip_address'] = get_cached_ip_address()
+    response_data['bluetooth'] = connection_manager.state()
     return jsonify(response_data)
 
+@app.route('/events')
+def events():
+    """ステータスの変化をServer-Sent Eventsで配信
+
+    接続直後に全体を snapshot イベントで送り、以降は変化したキーだけを
+    status イベントで送る。変化がない間はキープアライブのみ送る。
+    """
+    def stream():
+        last_sent = None
+        version = -1
+        while True:
+            version, current = status_hub.wait(version, SSE_KEEPALIVE_INTERVAL)
+            data = dict(current, ip_address=get_cached_ip_address())
+            if last_sent is None:
+                yield f"event: snapshot\ndata: {json.dumps(data)}\n\n"
+            else:
+                delta = {k: v for k, v in data.items() if last_sent.get(k) != v}
+                delta.update({k: None for k in last_sent if k not in data})
+                if delta:
+                    yield f"event: status\ndata: {json.dumps(delta)}\n\n"
+                else:
+                    yield ": keepalive\n\n"
+            last_sent = data
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/live')
+def live():
+    """録音中の音声をchunked転送でライブ配信
+
+    リスナーはライブの先端から聞き始める。録音が終わるとストリームも終わる。
+    """
+    if not current_recording_file():
+        return jsonify({'error': '録音中ではありません'}), 404
+    return Response(live_tail.listen(), mimetype='audio/ogg',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/get_files')
 def get_files():
-    """録音ファイル一覧取得API"""
-    logging.info("=== /get_files API called ===")
+    """録音ファイル一覧取得API（新しい順、ページ単位）
+
+    クエリ: page（1から）, per_page, device（MACアドレスまたは名前）,
+            date_from / date_to（YYYY-MM-DD、date_toの日を含む）
+    """
     try:
-        # recordingsディレクトリが存在しない場合は作成する
-        if not os.path.exists(RECORDINGS_DIR):
-            os.makedirs(RECORDINGS_DIR)
-        # 正しい録音ディレクトリを参照するように修正
-        files = [f for f in os.listdir(RECORDINGS_DIR) if f.endswith('.ogg')]
-        files.sort(reverse=True)  # 新しい順
-        logging.info(f"Found {len(files)} OGG files")
+        page = max(1, request.args.get('page', 1, type=int))
+        per_page = min(max(1, request.args.get('per_page', FILES_PER_PAGE, type=int)), FILES_PER_PAGE_MAX)
+        try:
+            since = parse_date(request.args.get('date_from'))
+            until = parse_date(request.args.get('date_to'), days=1)
+        except ValueError:
+            return jsonify({'success': False, 'files': [], 'error': '日付はYYYY-MM-DD形式で指定してください'}), 400
+
+        items, total = recording_catalog.query(limit=per_page, offset=(page - 1) * per_page,
+                                               device=request.args.get('device'), since=since, until=until)
+        for item in items:
+            # 波形ファイル（/peaks）があるか
+            item['peaks'] = os.path.exists(peaks_path(os.path.join(RECORDINGS_DIR, item['filename'])))
         return jsonify({
             'success': True,
-            'files': files[:10]  # 最新10件
+            'files': [item['filename'] for item in items],
+            'items': items,
+            'total': total,
+            'page': page,
+            'per_page': per_page
         })
     except Exception as e:
         logging.error(f"Error in /get_files: {e}")
@@ -652,9 +1021,74 @@ def get_files():
             'error': str(e)
         })
 
+@app.route('/jobs')
+def jobs():
+    """後処理ジョブの一覧API（新しい順）
+
+    各ジョブの待ち時間（wait_seconds）、実行時間（run_seconds、録音中の一時停止を除く）、
+    一時停止していた時間（paused_seconds）を返す。クエリ: state, page, per_page
+    """
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(max(1, request.args.get('per_page', FILES_PER_PAGE, type=int)), FILES_PER_PAGE_MAX)
+    try:
+        items, total = job_queue.jobs(state=request.args.get('state'), limit=per_page,
+                                      offset=(page - 1) * per_page)
+    except Exception as e:
+        logging.error(f"ジョブ一覧の取得エラー: {e}")
+        return jsonify({'success': False, 'jobs': [], 'error': str(e)}), 500
+    return jsonify({'success': True, 'jobs': items, 'total': total, 'page': page, 'per_page': per_page})
+
+@app.route('/schedules')
+def schedules():
+    """予約録音の一覧API（次の開始時刻 next_start が近い順）"""
+    return jsonify({'success': True, 'schedules': recording_scheduler.upcoming()})
+
+@app.route('/schedules', methods=['POST'])
+def add_schedule():
+    """予約録音の追加API
+
+    JSON: name, device（省略時は選択中のデバイス）, duration（分）, time（HH:MM）,
+    repeat（'once' なら date: YYYY-MM-DD、'weekly' なら weekdays: 月曜=0〜日曜=6 のリスト）
+    """
+    data = request.get_json() or {}
+    data.setdefault('device', selected_device)
+    try:
+        entry = schedule_store.add(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    recording_scheduler.wake()
+    logging.info(f"予約録音を追加しました: {entry['name']} ({entry['id']})")
+    return jsonify({'success': True, 'schedule': entry})
+
+@app.route('/schedules/<schedule_id>/delete', methods=['POST'])
+def delete_schedule(schedule_id):
+    """予約録音の削除API"""
+    if not schedule_store.remove(schedule_id):
+        return jsonify({'success': False, 'message': '予約が見つかりません'}), 404
+    recording_scheduler.wake()
+    return jsonify({'success': True})
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus形式のメトリクス（Webサーバーと、共有メモリ経由のワーカーの分）"""
+    snapshots = {'web': recorder_metrics.REGISTRY.snapshot()}
+    try:
+        result = metrics_segment.read()
+    except Exception as e:
+        logging.error(f"ワーカーのメトリクスを読めません: {e}")
+        result = None
+    if result and time.time() - result[1] <= WORKER_METRICS_TIMEOUT:
+        snapshots['worker'] = result[0]
+    return Response(recorder_metrics.render(snapshots), mimetype='text/plain; version=0.0.4')
+
 @app.route('/download/<filename>')
 def download_file(filename):
-    """ファイルダウンロードAPI"""
+    """ファイルダウンロードAPI
+
+    Range / If-Range / ETag（If-None-Match）に対応し、途中で切れたダウンロードを
+    続きから再開できる。録音中のセグメントなど内容が変わったファイルはETagが
+    変わるため、If-Rangeが一致しなければ全体を返す。
+    """
     try:
         # セキュリティ：ディレクトリトラバーサル対策
         if '..' in filename or '/' in filename:
@@ -668,12 +1102,27 @@ def download_file(filename):
         if not os.path.exists(filepath):
             return jsonify({'error': 'ファイルが見つかりません'}), 404
         
-        return send_file(filepath, as_attachment=True, attachment_filename=filename)
+        return send_file(filepath, as_attachment=True, download_name=filename,
+                         conditional=True, etag=True, max_age=0)
     
     except Exception as e:
         logging.error(f"ダウンロードエラー: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/peaks/<filename>')
+def peaks(filename):
+    """録音ファイルの波形（ピーク）API
+
+    録音中に作られた <録音名>.peaks をそのまま返す（形式は recorder_waveform を参照）。
+    音声をダウンロード・デコードせずにブラウザで波形を描くために使う。
+    """
+    if '..' in filename or '/' in filename or not filename.endswith('.ogg'):
+        return jsonify({'error': '不正なファイル名です'}), 400
+    path = peaks_path(os.path.join(RECORDINGS_DIR, filename))
+    if not os.path.exists(path):
+        return jsonify({'error': '波形がありません'}), 404
+    return send_file(path, mimetype='application/octet-stream', conditional=True, etag=True, max_age=0)
+
 @app.route('/delete/<filename>', methods=['POST'])
 def delete_file(filename):
     """ファイル削除API"""
@@ -693,11 +1142,18 @@ def delete_file(filename):
             }), 400
         
         filepath = os.path.join(RECORDINGS_DIR, filename)
+        # 波形と無音区間のインデックスも一緒に削除する
+        for sidecar in (peaks_path(filepath), silence_index_path(os.path.splitext(filepath)[0])):
+            if os.path.exists(sidecar):
+                os.remove(sidecar)
         if os.path.exists(filepath):
             os.remove(filepath)
+            recording_catalog.remove(filename)
             logging.info(f"ファイル削除: {filename}")
             return jsonify({'success': True, 'message': 'ファイルを削除しました'})
         else:
+            # ファイルだけ先に消えていた場合もカタログから外す
+            recording_catalog.remove(filename)
             return jsonify({'success': False, 'message': 'ファイルが見つかりません'}), 404
     
     except Exception as e:
@@ -707,6 +1163,14 @@ def delete_file(filename):
 @app.route('/debug_bluetooth')
 def debug_bluetooth():
     """Bluetoothのデバッグ情報を取得"""
+    try:
+        return jsonify(slow_calls.run('debug_bluetooth', collect_bluetooth_debug_info,
+                                      timeout=DEBUG_COMMAND_TIMEOUT))
+    except (CallTimeout, ExecutorBusy) as e:
+        return jsonify({'error': str(e) or 'Bluetoothのデバッグ情報の取得がタイムアウトしました'}), 503
+
+def collect_bluetooth_debug_info():
+    """hciconfigとbluetoothctlの出力を集める"""
     debug_info = {
         'hciconfig': '',
         'bluetoothctl_list': '',
@@ -716,59 +1180,85 @@ def debug_bluetooth():
     
     try:
         # hciconfig
-        result = subprocess.run(['hciconfig'], capture_output=True, text=True, timeout=10)
+        result = run_command(['hciconfig'], capture_output=True, text=True, timeout=10)
         debug_info['hciconfig'] = result.stdout
         
         # bluetoothctl list
-        result = subprocess.run(['bluetoothctl'], input='list\nexit\n', 
-                              capture_output=True, text=True, timeout=10)
+        result = run_command(['bluetoothctl'], input='list\nexit\n', 
+                           capture_output=True, text=True, timeout=10)
         debug_info['bluetoothctl_list'] = result.stdout
         
         # bluetoothctl devices
-        result = subprocess.run(['bluetoothctl'], input='devices\nexit\n',
-                              capture_output=True, text=True, timeout=10)
+        result = run_command(['bluetoothctl'], input='devices\nexit\n',
+                           capture_output=True, text=True, timeout=10)
         debug_info['bluetoothctl_devices'] = result.stdout
         
     except Exception as e:
         debug_info['error'] = str(e)
     
-    return jsonify(debug_info)
+    return debug_info
 
 def cleanup():
     """クリーンアップ処理"""
-    global worker_process
+    # ワーカープロセスに終了コマンドを送信（終了しても再起動させない）
+    worker_supervisor.stop()
+    recording_scheduler.stop()
+    status_subscriber.stop()
+    connection_manager.stop()
+    device_inventory.stop()
+    # 録音中のファイルの確定を待つため、応答までの時間を長めにとる
+    reply = send_command({'action': 'shutdown'}, timeout=WORKER_SHUTDOWN_TIMEOUT)
+    command_client.close()
+    slow_calls.shutdown()
     
-    # ワーカープロセスに終了コマンドを送信
-    send_command({'action': 'shutdown'})
-    
-    if worker_process:
-        try:
-            worker_process.terminate()
-        except:
-            pass
+    if not reply:
+        worker_supervisor.terminate()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Raspberry Pi Web Recorder")
     parser.add_argument('--setup', action='store_true', help='Run in Wi-Fi setup mode')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--threads', type=int, default=SERVER_THREADS, help='Number of server threads (waitress)')
+    parser.add_argument('--dev-server', action='store_true', help='Use the Flask development server')
     args = parser.parse_args()
     
     is_setup_mode = args.setup
 
     if not is_setup_mode:
         load_config()
+        # 録音カタログを録音ディレクトリに合わせる（増えた・消えたファイルの分だけ）
+        threading.Thread(target=sync_recording_catalog, daemon=True).start()
+        # BlueZのデバイス一覧をD-Bus経由でキャッシュする（失敗時はbluetoothctlにフォールバック）
+        device_inventory.start()
+        connection_manager.start()
         # ワーカープロセスの起動を試みる。もし失敗しても、Webサーバーは終了しない。
-        if not start_worker_process():
+        if start_worker_process():
+            arm_worker_preroll()
+        else:
             logging.warning("初回ワーカー起動に失敗しましたが、Webサーバーは起動を続けます。")
+        # ワーカーのステータス配信を購読（ワーカー再起動時は自動で再接続）
+        status_subscriber.start()
+        recording_scheduler.start()
 
     print("=" * 50)
     print("Raspberry Pi Web録音コントローラー")
     if is_setup_mode:
+        # 最初のページ表示までにスキャン結果を用意しておく
+        wifi_scan_cache.refresh()
         print("--- Wi-Fi設定モード ---")
     print("=" * 50)
     
     try:
-        # ポートを8080番に固定して、ブラウザでポート番号入力を不要にする
-        app.run(host='0.0.0.0', port=8080, debug=False)
+        # 既定は8080番（ブラウザでポート番号入力を不要にする）。ベンチマークなどでは --port で変える
+        if waitress and not args.dev_server:
+            # スレッド数は同時に開かれるストリーム（/events, /live）の数より多くする
+            waitress.serve(app, host='0.0.0.0', port=args.port, threads=args.threads, ident='recorder')
+        else:
+            if not args.dev_server:
+                logging.warning("waitressがインストールされていません。Flaskの開発サーバーで起動します。")
+            # 長さ不明のストリーム（/live, /events）をchunked転送で返すためHTTP/1.1で応答する
+            WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+            app.run(host='0.0.0.0', port=args.port, debug=False, threaded=True)
     except KeyboardInterrupt:
         print("サーバーを停止します...")
     except Exception as e:
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 """
 録音ワーカープロセス
-recorder_web.pyからの指示に基づき、実際の録音処理を担当する。
-シンプル版（録音中表示のみ）
+recorder_web.pyからコマンドソケットで指示を受け、デバイスごとのセッションで録音する。
+待機中はプリロールで直近の音声を保持し、ステータスは共有メモリで配信する。
 """
 
 import logging
@@ -15,6 +15,24 @@ import signal
 import threading
 from datetime import datetime
 
+import psutil
+
+import recorder_capture
+from recorder_capture import (CapturePipeline, PipeEncoder, PulseSource, PyAudioSource,
+                              SegmentedEncoder, SoundFileEncoder, dual_source_factory, parse_sample_spec)
+from recorder_catalog import RecordingCatalog
+from recorder_ipc import METRICS_SEGMENT, METRICS_SEGMENT_SIZE, CommandServer, StatusSegment
+from recorder_jobs import JobQueue
+import recorder_metrics
+from recorder_metrics import RECORDING_BYTES, RECORDING_BYTES_PER_SECOND, STATUS_WRITE_SECONDS, run_command
+from recorder_presets import DEFAULT_PRESET, bytes_per_second, get_preset, preset_for_rate
+from recorder_segments import SegmentManifest, list_segments, recover_sessions, segment_path, segment_pattern
+from recorder_sessions import DEFAULT_MAX_SESSIONS, SessionError, SessionManager
+from recorder_silence import SilenceGate, SilenceIndex, silence_index_path
+from recorder_supervisor import notify_ready
+import recorder_waveform
+from recorder_waveform import PEAKS_PCM_RATE, LevelMeter, PcmTap, PeaksWriter, PipePeaks, peaks_path
+
 # このスクリプトの場所にログファイルを作成
 log_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.log')
 
@@ -24,26 +42,72 @@ worker_logger.setLevel(logging.INFO)
 handler = logging.FileHandler(log_file_path)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
-worker_logger.addHandler(handler)
+# 補助モジュール（recorder_ipc, recorder_captureなど）のログも同じファイルに出力する
+logging.getLogger().addHandler(handler)
+logging.getLogger().setLevel(logging.INFO)
 
 worker_logger.info("--- ワーカーログ開始 ---")
 
 # --- 定数（絶対パスで指定） ---
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
 
-# Webアプリと状態を共有するためのファイル
-STATUS_FILE = os.path.join(APP_ROOT, "recorder_status.json")
-COMMAND_FILE = os.path.join(APP_ROOT, "recorder_command.json")
 RECORDINGS_DIR = os.path.join(APP_ROOT, "recordings")
+CONFIG_FILE = os.path.join(APP_ROOT, "recorder_config.json")
+CATALOG_FILE = os.path.join(APP_ROOT, "recorder_catalog.db")
+JOBS_FILE = os.path.join(APP_ROOT, "recorder_jobs.db")
 
 # 録音設定
 CHUNK = 1024
 FORMAT = pyaudio.paInt16
+# ソースのサンプル仕様がわからない場合のチャンネル数・サンプリングレート
+# （わかる場合はソースのままで録音し、リサンプリングしない）
 CHANNELS = 1
 RATE = 44100
 
 # ステータス更新間隔（秒）
 STATUS_UPDATE_INTERVAL = 1.0
+# 入力レベルの更新間隔（秒）
+LEVEL_UPDATE_INTERVAL = 0.25
+# メトリクス（子プロセスのCPU・メモリを含む）を共有メモリに書き出す間隔（秒）
+METRICS_PUBLISH_INTERVAL = 5.0
+
+# Bluetooth接続中にPulseAudioのソースが現れるのを待つ最大時間（秒）
+SOURCE_WAIT_TIMEOUT = 20
+# 終了コマンドで録音中のファイルの確定を待つ最大時間（秒）
+SHUTDOWN_WAIT_TIMEOUT = 10
+
+# recorder_config.json の録音設定の既定値
+RECORDING_DEFAULTS = {
+    # 待機中に保持しておく録音開始前の音声（秒）。0で無効
+    'preroll_seconds': 0,
+    # キャプチャ方式: ffmpeg（ffmpegがPulseAudioから直接録音）
+    #                 pyaudio（PyAudioでPCMを読み、プロセス内でエンコード）
+    'capture_engine': 'ffmpeg',
+    # 分割録音: 指定した分数・サイズ（MB）ごとに新しいファイルに切り替える。どちらも0で分割しない
+    'segment_minutes': 0,
+    'segment_mb': 0,
+    # 分割録音の停止時にセグメントを1ファイルへ結合する（再エンコードなし）
+    'concat_segments': False,
+    # 録音後の後処理（loudnorm, trim_silence, speech）と、同時に実行するジョブ数
+    'postprocess': [],
+    'postprocess_workers': 1,
+    # 録音中に波形（ピーク）のファイル <録音名>.peaks を作る
+    'waveform_peaks': True,
+    # 無音がこの秒数続いたら警告する（0で警告しない）
+    'no_signal_seconds': 10,
+    # 長い無音の扱い: off, skip（エンコードせずに詰める）, mark（区間を記録するだけ）
+    # silence_db 未満が silence_seconds 秒を超えて続いた区間が対象
+    'silence_gate': 'off',
+    'silence_db': -50,
+    'silence_seconds': 5,
+    # source: Bluetoothのソース（またはモニター）の1トラック,
+    # dual: ソース（相手の声）とシンクのモニター（こちらから送る音声）をL/Rの2トラックで1ファイルに
+    'capture_tracks': 'source',
+    # エンコードのプリセット（recorder_presets.py、/start_recording の preset で録音ごとに変えられる）
+    'encoder_preset': DEFAULT_PRESET,
+    # 同時に録音できるデバイスの数（複数のBluetoothアダプタを使う場合）
+    'max_sessions': DEFAULT_MAX_SESSIONS
+}
 
 # --- グローバル変数 ---
 status = {
@@ -53,111 +117,355 @@ status = {
     'filename': None,
     'device': None,
     'error_message': None,
-    'recording_info': None
+    'recording_info': None,
+    'level': None,  # 録音中の入力レベル（rms_db, peak_db, silent_seconds, no_signal）
+    'armed': None  # 待機録音（プリロール）中のデバイス
 }
-stop_recording_flag = threading.Event()
 main_loop_running = True
+command_server = None
+status_segment = None
+metrics_segment = None
+last_published_status = None
+status_lock = threading.Lock()
+preroll_capture = None
+preroll_device_mac = None
+# 待機録音が2トラック（ソースとシンクのモニター）か
+preroll_is_dual = False
+# 待機録音のソースのサンプル仕様（ソースがまだなく既定値で開いた場合はNone）
+preroll_source_spec = None
+# 現れたソースの仕様が待機録音と違い、メインループで作り直す必要があるか
+preroll_rearm_pending = False
+# 予約録音の準備として開いたソースを止める時刻（プリロールが無効な場合のみ）
+prewarm_until = None
+recording_catalog = RecordingCatalog(CATALOG_FILE)
+job_queue = None
+
+def load_recording_config():
+    """recorder_config.json から録音設定を読み込む"""
+    config = dict(RECORDING_DEFAULTS)
+    try:
+        with open(CONFIG_FILE, 'r') as f:
+            saved = json.load(f)
+        config.update({k: saved[k] for k in RECORDING_DEFAULTS if k in saved})
+    except (OSError, ValueError):
+        pass
+    return config
 
 # --- 関数 ---
 
 def update_status(new_status=None):
-    """現在の状態をJSONファイルに書き出す"""
-    global status
-    if new_status:
-        status.update(new_status)
-    
-    # 常に最新のタイムスタンプを追加する
-    status['updated_at'] = time.time()
-    try:
-        with open(STATUS_FILE, 'w') as f:
-            json.dump(status, f)
-    except Exception as e:
-        worker_logger.error(f"ステータスファイルの書き込みに失敗: {e}")
+    """現在の状態を共有メモリに公開する（変化がなければハートビートのみ）"""
+    global status, last_published_status
+    with status_lock:
+        if new_status:
+            status.update(new_status)
 
-def find_pulse_audio_device(device_mac):
-    """PulseAudioから適切なデバイス（sourceまたはsink.monitor）を検索"""
+        # 状態が変わった場合のみ公開し、購読中のWebサーバーに配信する
+        snapshot = dict(status)
+        # 録音中のセッションを載せる（最後に開始したものは従来のキーでも）
+        snapshot.update(session_manager.summary())
+        try:
+            if snapshot != last_published_status:
+                last_published_status = snapshot
+                # 録音中は後処理ジョブを一時停止する
+                if job_queue:
+                    job_queue.set_paused(snapshot['recording'])
+                if status_segment:
+                    started = time.perf_counter()
+                    status_segment.publish(snapshot)
+                    STATUS_WRITE_SECONDS.observe(time.perf_counter() - started)
+                if command_server:
+                    command_server.publish_status(snapshot)
+            elif status_segment:
+                status_segment.heartbeat()
+        except Exception as e:
+            worker_logger.error(f"ステータスの公開に失敗: {e}")
+
+# 同時に録音するセッション（デバイスごと）
+session_manager = SessionManager(update_status)
+
+# PulseAudioのソース名→サンプル仕様（pactl list sources short の値）
+pulse_source_specs = {}
+
+def list_pulse_audio_devices(device_mac):
+    """PulseAudioのソースのうち、MACアドレスを含むもの（sourceとsink.monitor）の名前の一覧
+
+    同じ一覧にあるサンプル仕様を pulse_source_specs に記録する（問い合わせは1回で済む）。
+    """
     try:
         # MACアドレスを正規化（:を_に変換） 
         normalized_mac = device_mac.replace(':', '_')
         
         # pactl list sourcesでソース一覧を取得
-        result = subprocess.run(['pactl', 'list', 'sources', 'short'], 
-                              capture_output=True, text=True, timeout=10)
+        result = run_command(['pactl', 'list', 'sources', 'short'],
+                             capture_output=True, text=True, timeout=10)
         
+        names = []
         if result.returncode == 0:
             for line in result.stdout.strip().split('\n'):
                 parts = line.split('\t')
-                if len(parts) >= 2:
-                    source_name = parts[1]
-                    # sourceまたはsink.monitorでMACアドレスが含まれているものを探す
-                    if normalized_mac in source_name:
-                        worker_logger.info(f"PulseAudioデバイスを発見: {source_name}")
-                        return source_name
-        
-        worker_logger.warning(f"MACアドレス {device_mac} に対応するPulseAudioデバイスが見つかりません")
-        return None
+                # sourceまたはsink.monitorでMACアドレスが含まれているものを探す
+                if len(parts) >= 2 and normalized_mac in parts[1]:
+                    names.append(parts[1])
+                    if len(parts) >= 4:
+                        pulse_source_specs[parts[1]] = parse_sample_spec(parts[3])
+        return names
         
     except Exception as e:
         worker_logger.error(f"PulseAudioデバイス検索エラー: {e}")
-        return None
+        return []
+
+def find_pulse_audio_device(device_mac, log_missing=True):
+    """PulseAudioから適切なデバイス（sourceまたはsink.monitor）を検索"""
+    names = list_pulse_audio_devices(device_mac)
+    if names:
+        worker_logger.info(f"PulseAudioデバイスを発見: {names[0]}")
+        return names[0]
+    if log_missing:
+        worker_logger.warning(f"MACアドレス {device_mac} に対応するPulseAudioデバイスが見つかりません")
+    return None
+
+def find_dual_track_devices(device_mac):
+    """2トラック録音用の (Bluetoothのソース, シンクのモニター) を検索（どちらかがなければNone）"""
+    names = list_pulse_audio_devices(device_mac)
+    source = next((name for name in names if not name.endswith('.monitor')), None)
+    monitor = next((name for name in names if name.endswith('.monitor')), None)
+    if source and monitor:
+        worker_logger.info(f"2トラック録音のデバイスを発見: {source}, {monitor}")
+        return source, monitor
+    return None
 
-def record_audio_thread(device_mac, filename_base):
-    """ffmpegを使用した録音スレッド（シンプル版）"""
-    global status
-    
-    final_ogg_filename = os.path.join(RECORDINGS_DIR, f"{filename_base}.ogg")
+def native_sample_spec(source_name, dual=False):
+    """ソースのサンプル仕様に合わせた録音の (サンプリングレート, チャンネル数)
+
+    2トラック録音はソースとモニターを1チャンネルずつにする。仕様がわからなければ RATE, CHANNELS。
+    """
+    spec = pulse_source_specs.get(source_name)
+    rate = spec['rate'] if spec else RATE
+    if dual:
+        return rate, 2
+    return rate, spec['channels'] if spec else CHANNELS
+
+def wait_for_pulse_audio_device(device_mac, stop_flag, timeout=SOURCE_WAIT_TIMEOUT):
+    """Bluetoothの接続完了を待ちながらPulseAudioデバイスを検索（stop_flagで中断）"""
+    deadline = time.time() + timeout
+    while True:
+        source_name = find_pulse_audio_device(device_mac)
+        if source_name or time.time() >= deadline or stop_flag.is_set():
+            return source_name
+        time.sleep(0.5)
+
+def record_audio_thread(session, filename_base, duration_seconds=None, resumed_from=None, preset_name=None):
+    """録音スレッド（セッションごとに1つ）
+
+    通常はffmpegがPulseAudioから直接録音し、PyAudio・プリロール・無音詰め・2トラックを
+    使う場合はキャプチャパイプラインからエンコーダーにPCMを流し込む（分割録音にも対応）。
+    ソースのサンプリングレート・チャンネル数のまま録音し、duration_seconds を過ぎたら自動停止する。
+    resumed_from は中断から再開した元の録音のファイル名、preset_name はエンコードのプリセット。
+    """
+    device_mac = session.device_mac
+    stop_flag = session.stop_flag
+    base_path = os.path.join(RECORDINGS_DIR, filename_base)
+    final_ogg_filename = base_path + '.ogg'
+    config = load_recording_config()
+    preset_name = preset_name or config['encoder_preset']
+    preset = get_preset(preset_name)
+    if not preset:
+        worker_logger.warning(f"不明なエンコードのプリセットのため既定値で録音します: {preset_name}")
+        preset_name, preset = DEFAULT_PRESET, get_preset(DEFAULT_PRESET)
     process = None
+    encoder = None
+    pipeline = None
+    owns_pipeline = False
+    manifest = None
+    peaks_reader = None
+    meter = None
+    gate = None
+    stop_timer = None
+    process_started = None
+    start_time = None
+    source_spec = None
+    dual = False
 
     try:
-        # PulseAudioデバイスを検索
-        source_name = find_pulse_audio_device(device_mac)
-        if not source_name:
-            raise Exception(f"Bluetoothデバイス {device_mac} が見つかりません")
-
-        # ffmpegで直接OGG録音
-        cmd = [
-            'ffmpeg',
-            '-f', 'pulse',
-            '-i', source_name,
-            '-acodec', 'libvorbis',
-            '-ab', '128k',  # ビットレート
-            '-y',  # 上書き許可
-            final_ogg_filename
-        ]
-
-        worker_logger.info(f"録音開始: {' '.join(cmd)}")
+        preroll_seconds = 0
+        if (preroll_capture and preroll_device_mac == device_mac and preroll_capture.is_capturing()
+                and preroll_is_dual == (config['capture_tracks'] == 'dual')):
+            # 待機中に録っていた音声をそのまま先頭に使う（待機録音を始めたときのサンプル仕様のまま）
+            pipeline = preroll_capture
+            rate, channels = pipeline.rate, pipeline.channels
+            source_spec = preroll_source_spec
+            dual = preroll_is_dual
+        else:
+            # PulseAudioデバイスを検索（Bluetoothが接続中であれば現れるまで待つ）
+            source_name = wait_for_pulse_audio_device(device_mac, stop_flag)
+            if stop_flag.is_set():
+                # ソースを待っている間に停止された（開始中のセッションへの停止。録音は始めない）
+                worker_logger.info(f"録音を開始する前に停止しました (セッション {session.id})")
+                return
+            if not source_name:
+                raise Exception(f"Bluetoothデバイス {device_mac} が見つかりません")
+
+            source_factory = capture_source_factory(config)
+            dual_names = None
+            if config['capture_tracks'] == 'dual':
+                dual_names = find_dual_track_devices(device_mac)
+                if not dual_names:
+                    worker_logger.warning(f"シンクのモニターが見つからないため、1トラックで録音します: {source_name}")
+            # 検索したときのソースのサンプル仕様で録音する（モニターもソースのレートに揃える）
+            source_spec = pulse_source_specs.get(dual_names[0] if dual_names else source_name)
+            rate, channels = native_sample_spec(dual_names[0] if dual_names else source_name, dual=bool(dual_names))
+            dual = bool(dual_names)
+            if dual:
+                source_name, source_factory = dual_names, dual_source_factory(source_factory)
+
+            # 無音の判定・2トラックへのまとめはPCMで行うため、パイプラインで録音する
+            if (config['capture_engine'] == 'pyaudio' or config['silence_gate'] in ('skip', 'mark')
+                    or dual_names):
+                pipeline = CapturePipeline(lambda: source_name, rate, channels,
+                                           source_factory=source_factory)
+                pipeline.start()
+                owns_pipeline = True
+
+        # 低いサンプリングレートでは、プリセットをそのレートで使える設定にする
+        preset = preset_for_rate(preset, rate)
+        audio_format = preset['format']
+        worker_logger.info(f"録音の形式: {rate}Hz {channels}ch, {audio_format}"
+                           f"（{'ソースの仕様のまま' if source_spec else 'ソースの仕様が不明なため既定値'}）")
+
+        if config['segment_minutes'] or config['segment_mb']:
+            manifest = SegmentManifest.create(base_path, segment_minutes=config['segment_minutes'],
+                                              segment_mb=config['segment_mb'])
+
+        if pipeline:
+            audio_format = pipeline_encoder_format(config, preset)
+            if manifest:
+                encoder = SegmentedEncoder(
+                    lambda path: open_pipeline_encoder(path, config, preset, rate, channels),
+                    lambda number: segment_path(base_path, number), rate, channels,
+                    segment_seconds=config['segment_minutes'] * 60,
+                    segment_bytes=config['segment_mb'] * 1024 * 1024)
+            else:
+                encoder = open_pipeline_encoder(final_ogg_filename, config, preset, rate, channels)
+            if config['silence_gate'] in ('skip', 'mark'):
+                try:
+                    index = SilenceIndex(silence_index_path(base_path), config['silence_gate'],
+                                         config['silence_db'], config['silence_seconds'])
+                    gate = encoder = SilenceGate(encoder, index, rate, channels, mode=config['silence_gate'],
+                                                 threshold_db=config['silence_db'],
+                                                 min_silence=config['silence_seconds'])
+                except RuntimeError as e:
+                    worker_logger.warning(f"無音の判定を使えません: {e}")
+            # 入力レベルは詰める前の音声で求める
+            meter = open_level_meter(rate, channels)
+            if meter:
+                encoder = PcmTap(encoder, meter)
+            preroll_seconds = pipeline.attach(encoder)
+            worker_logger.info(f"録音開始（{config['capture_engine']}, プリロール {preroll_seconds:.1f}秒）")
+        else:
+            if manifest:
+                # segmentマルチプレクサでパケットの境目ごとに切り替える（セグメント間の欠けなし）
+                output_args = [
+                    '-f', 'segment',
+                    '-segment_time', str(segment_seconds(config, preset, rate, channels)),
+                    '-segment_format', 'ogg',
+                    '-segment_start_number', '1',
+                    '-reset_timestamps', '1',
+                    # Oggページができるたびに書き出す（ライブ配信が録音中のファイルを追従できるように）
+                    '-segment_format_options', 'flush_packets=1',
+                    segment_pattern(base_path)
+                ]
+            else:
+                output_args = ['-flush_packets', '1', final_ogg_filename]
+
+            meter = open_level_meter(PEAKS_PCM_RATE, 1)
+            with_peaks = config['waveform_peaks'] and recorder_waveform.numpy is not None
+            if with_peaks or meter:
+                # 波形・入力レベル用に低いサンプリングレートのモノラルPCMを標準出力にも出す
+                output_args += ['-ac', '1', '-ar', str(PEAKS_PCM_RATE), '-f', 's16le', 'pipe:1']
+
+            # ffmpegで直接OGG録音（pulse入力の既定は48kHzステレオのため、ソースの仕様を指定する）
+            cmd = [
+                'ffmpeg',
+                '-f', 'pulse',
+                '-sample_rate', str(rate),
+                '-channels', str(channels),
+                '-i', source_name,
+                *preset['codec_args'],
+                '-y',  # 上書き許可
+                *output_args
+            ]
+
+            worker_logger.info(f"録音開始: {' '.join(cmd)}")
+
+            # プロセス開始（stderrは破棄）
+            process_started = time.monotonic()
+            process = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE,  # SIGINTを送るため
+                stdout=subprocess.PIPE if with_peaks or meter else subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL  # バッファ溢れ防止
+            )
+            if with_peaks or meter:
+                peaks_reader = PipePeaks(
+                    process.stdout,
+                    (lambda number: peaks_path(segment_path(base_path, number) if manifest else final_ogg_filename))
+                    if with_peaks else None,
+                    segment_seconds=segment_seconds(config, preset, rate, channels) if manifest else 0, meter=meter)
         
+        # 録音の形式（2トラック録音ではチャンネルの割り当て L: ソース, R: シンクのモニター）
+        stream_info = {
+            'format': audio_format,
+            'preset': preset_name,
+            'sample_rate': rate,
+            'sample_format': 's16le',
+            'source_spec': source_spec,
+            'channels': channels,
+            # ステレオのソースを1トラックで録音した場合と区別するため、チャンネル数では判断しない
+            'tracks': ['source', 'monitor'] if dual else ['source']
+        }
+
+        # 録音開始時刻はプリロールの分だけさかのぼる
+        started = time.time()
+        start_time = started - preroll_seconds
+        stop_at = None
+        if duration_seconds:
+            # 監視ループの間隔に関係なく、指定時間ちょうどで停止する
+            stop_at = started + duration_seconds
+            stop_timer = threading.Timer(duration_seconds, auto_stop_recording, args=(session, start_time))
+            stop_timer.daemon = True
+            stop_timer.start()
+
         # デバイス情報を含めてステータスを更新
-        update_status({
+        session.update({
             'recording': True,
             'status': 'recording',
-            'start_time': time.time(),
-            'filename': os.path.basename(final_ogg_filename),
-            'device': status.get('device'),  # グローバル変数から取得
+            'start_time': start_time,
+            'filename': os.path.basename(segment_path(base_path, 1) if manifest else final_ogg_filename),
             'error_message': None,
             'recording_info': {
-                'duration': 0,
+                'duration': int(preroll_seconds),
                 'file_size': 0,
-                'format': 'OGG Vorbis 128kbps'
+                **stream_info,
+                'preroll_seconds': round(preroll_seconds, 1),
+                'stop_at': stop_at,
+                'resumed_from': resumed_from
             }
         })
 
-        # プロセス開始（stderrは破棄）
-        process = subprocess.Popen(
-            cmd,
-            stdin=subprocess.PIPE,  # SIGINTを送るため
-            stderr=subprocess.DEVNULL  # バッファ溢れ防止
-        )
-        
         # 録音監視ループ
-        start_time = time.time()
         last_status_update = time.time()
+        last_file_size = 0
+        no_signal = False
         
-        while not stop_recording_flag.is_set():
+        while not stop_flag.is_set():
             # プロセスの生存確認
-            if process.poll() is not None:
+            if process and process.poll() is not None:
                 worker_logger.warning("録音プロセスが予期せず終了")
                 break
+            if encoder and (encoder.poll() is not None or not pipeline.is_attached(encoder)):
+                worker_logger.warning("エンコーダーが予期せず終了")
+                break
             
             # 現在の時間と経過時間
             current_time = time.time()
@@ -165,29 +473,77 @@ def record_audio_thread(device_mac, filename_base):
             
             # ファイルサイズを取得
             file_size = 0
-            if os.path.exists(final_ogg_filename):
+            if manifest:
+                file_size = manifest.total_size()
+            elif os.path.exists(final_ogg_filename):
                 file_size = os.path.getsize(final_ogg_filename)
             
+            new_status = {}
+            if meter:
+                # 入力レベル（無音が続いていれば警告する）
+                level = meter.snapshot()
+                level['no_signal'] = bool(config['no_signal_seconds']
+                                          and level['silent_seconds'] >= config['no_signal_seconds'])
+                if level['no_signal'] != no_signal:
+                    no_signal = level['no_signal']
+                    if no_signal:
+                        worker_logger.warning(f"入力が無音のままです（{level['silent_seconds']:.0f}秒）")
+                    else:
+                        worker_logger.info("入力の音声が戻りました")
+                new_status['level'] = level
+
             # ステータス更新
             if current_time - last_status_update >= STATUS_UPDATE_INTERVAL:
-                update_status({
-                    'recording_info': {
-                        'duration': duration,
-                        'file_size': file_size,
-                        'format': 'OGG Vorbis 128kbps',
-                        'last_update': current_time
-                    }
-                })
+                recording_info = {
+                    'duration': duration,
+                    'file_size': file_size,
+                    **stream_info,
+                    'preroll_seconds': round(preroll_seconds, 1),
+                    'stop_at': stop_at,
+                    'resumed_from': resumed_from,
+                    'last_update': current_time
+                }
+                new_status['recording_info'] = recording_info
+                # 書き込みの速さ（止まっていればエンコーダーやソースの異常）
+                written = max(0, file_size - last_file_size)
+                RECORDING_BYTES.inc(written)
+                session.bytes_per_second = round(written / (current_time - last_status_update))
+                RECORDING_BYTES_PER_SECOND.set(sum(active.bytes_per_second for active in session_manager.sessions()))
+                last_file_size = file_size
+                if pipeline:
+                    # バッファあふれ（overruns: ソース側, dropped_chunks: エンコーダーの遅れ）
+                    recording_info.update(pipeline.stats())
+                if gate:
+                    recording_info['skipped_seconds'] = round(gate.skipped_seconds(), 1)
+                if manifest:
+                    # 新しいセグメントができていればマニフェストに記録する
+                    manifest.refresh()
+                    recording_info['segments'] = len(manifest.data['segments'])
+                    if manifest.data['segments']:
+                        new_status['filename'] = manifest.data['segments'][-1]['file']
                 last_status_update = current_time
                 
                 # デバッグログ（10秒ごと）
                 if duration % 10 == 0 and duration > 0:
                     worker_logger.info(f"録音状態: {duration}秒経過, サイズ: {file_size} bytes")
+            if new_status:
+                session.update(new_status)
             
-            time.sleep(0.5)
+            # 停止（手動・タイマー）はすぐに反映する
+            stop_flag.wait(LEVEL_UPDATE_INTERVAL)
 
         # 適切な停止処理
-        if process.poll() is None:
+        if encoder:
+            worker_logger.info("録音を停止します")
+            # 待機録音に戻し（またはキャプチャを止め）、エンコーダーを閉じてファイルを確定させる
+            pipeline.detach()
+            if owns_pipeline:
+                pipeline.stop()
+            encoder.close()
+            stats = pipeline.stats()
+            if stats['overruns'] or stats['dropped_chunks']:
+                worker_logger.warning(f"バッファあふれが発生しました: {stats}")
+        elif process.poll() is None:
             worker_logger.info("録音を停止します")
             # ffmpegにqキーを送信（正常終了）
             try:
@@ -206,9 +562,21 @@ def record_audio_thread(device_mac, filename_base):
             if process.poll() is None:
                 process.terminate()
                 process.wait(timeout=5)
+        if peaks_reader:
+            peaks_reader.join()
+
+        if manifest:
+            # セグメントを確定し、設定があれば1ファイルに結合する
+            output = manifest.finish(concat=config['concat_segments'])
+            segment_count = len(manifest.data['segments'])
+            worker_logger.info(f"分割録音を終了しました: {output or f'{segment_count}個のセグメント'}")
+            if not output:
+                final_ogg_filename = None
 
         # 最終ファイルサイズをログ出力
-        if os.path.exists(final_ogg_filename):
+        if not final_ogg_filename:
+            worker_logger.info(f"録音が正常に終了しました。合計サイズ: {manifest.total_size()} bytes")
+        elif os.path.exists(final_ogg_filename):
             final_size = os.path.getsize(final_ogg_filename)
             worker_logger.info(f"録音が正常に終了しました。最終ファイルサイズ: {final_size} bytes")
         else:
@@ -221,109 +589,419 @@ def record_audio_thread(device_mac, filename_base):
         
     except Exception as e:
         worker_logger.error(f"録音エラー: {e}")
-        update_status({'status': 'error', 'error_message': str(e)})
+        session.update({'status': 'error', 'error_message': str(e)})
+        # セッションが終わってもエラーはワーカーのステータスに残す
+        update_status({'error_message': str(e)})
         if process and process.poll() is None:
             process.kill()
+        if encoder:
+            pipeline.detach()
+            encoder.close()
+        if owns_pipeline:
+            pipeline.stop()
+        if manifest and manifest.state == 'recording':
+            # 途中で止まったセグメントを確定させる
+            manifest.finish(concat=config['concat_segments'], finalize_last=True)
     finally:
-        # クリーンアップ
-        update_status({
-            'recording': False,
-            'status': 'idle',
-            'start_time': None,
-            'filename': None,
-            'device': None,
-            'recording_info': None
-        })
-        stop_recording_flag.clear()
-        worker_logger.info("録音処理が完了しました。")
+        if stop_timer:
+            stop_timer.cancel()
+        session.bytes_per_second = 0
+        RECORDING_BYTES_PER_SECOND.set(sum(active.bytes_per_second for active in session_manager.sessions()))
+        if process is not None and process.poll() is not None:
+            recorder_metrics.observe_command('ffmpeg', time.monotonic() - process_started, process.returncode)
+        # 予約録音の準備のためだけに開いていたソースは閉じる
+        if pipeline is not None and pipeline is preroll_capture and not pipeline.seconds:
+            disarm_preroll()
 
-def check_command():
-    """コマンドファイルを確認し、処理を実行する"""
-    global main_loop_running
-    if not os.path.exists(COMMAND_FILE):
+        # できあがったファイルを録音カタログに登録し、後処理ジョブに回す
+        if manifest and manifest.data['output']:
+            produced, produced_start = [os.path.join(RECORDINGS_DIR, manifest.data['output'])], start_time
+        elif manifest:
+            # セグメントの開始時刻はそれぞれのファイルから求める
+            produced, produced_start = list_segments(base_path), None
+        else:
+            produced, produced_start = [base_path + '.ogg'], start_time
+        produced = [path for path in produced if os.path.exists(path)]
+        catalog_recordings(produced, produced_start, session.device)
+        if produced and config['postprocess']:
+            for path in produced:
+                job_queue.enqueue(path, config['postprocess'])
+
+        # クリーンアップ（セッションを一覧から外す）
+        session_manager.remove(session)
+        worker_logger.info(f"録音処理が完了しました。(セッション {session.id})")
+
+def auto_stop_recording(session, start_time):
+    """録音時間に達した録音を停止する（タイマーから呼ばれる）"""
+    current = session.status()
+    if current['recording'] and current['start_time'] == start_time:
+        worker_logger.info(f"指定された録音時間に達したため、録音を停止します (セッション {session.id})")
+        session.stop()
+
+def catalog_recordings(paths, started_at, device):
+    """録音ファイルを録音カタログに登録する（失敗しても録音には影響させない）"""
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        try:
+            recording_catalog.add(path, device=device, started_at=started_at)
+        except Exception as e:
+            worker_logger.error(f"録音カタログへの登録に失敗: {e}")
+
+def catalog_processed_file(path):
+    """後処理の出力を録音カタログに登録する（開始時刻は元の録音のファイル名から求まる）"""
+    try:
+        recording_catalog.add(path)
+    except Exception as e:
+        worker_logger.error(f"録音カタログへの登録に失敗: {e}")
+
+def recover_recordings(started_before):
+    """中断された分割録音を確定させ、録音カタログに反映する"""
+    recover_sessions(RECORDINGS_DIR, load_recording_config()['concat_segments'], started_before)
+    try:
+        recording_catalog.sync(RECORDINGS_DIR)
+    except Exception as e:
+        worker_logger.error(f"録音カタログの更新に失敗: {e}")
+
+def capture_source_factory(config):
+    """設定のキャプチャ方式に応じたPCMソースのクラスを返す"""
+    if config['capture_engine'] == 'pyaudio':
+        return PyAudioSource
+    return PulseSource
+
+def use_soundfile_encoder(config, preset):
+    """プロセス内（libsndfile）でエンコードするか（プリセットが対応している場合のみ）"""
+    return (config['capture_engine'] == 'pyaudio' and recorder_capture.soundfile is not None
+            and preset['soundfile'] is not None)
+
+def pipeline_encoder_format(config, preset):
+    """パイプライン用エンコーダーの形式の説明"""
+    return f"{preset['format']} (libsndfile)" if use_soundfile_encoder(config, preset) else preset['format']
+
+def open_pipeline_encoder(filename, config, preset, rate=RATE, channels=CHANNELS):
+    """パイプライン用のエンコーダーを開く（設定があれば同じPCMから波形ファイルも作る）"""
+    if use_soundfile_encoder(config, preset):
+        encoder = SoundFileEncoder(filename, rate, channels, subtype=preset['soundfile'])
+    else:
+        encoder = PipeEncoder(filename, rate, channels, preset['codec_args'])
+    if config['waveform_peaks']:
+        try:
+            return PcmTap(encoder, PeaksWriter(peaks_path(filename), rate, channels))
+        except (OSError, RuntimeError) as e:
+            worker_logger.warning(f"波形ファイルを作成できません: {e}")
+    return encoder
+
+def open_level_meter(rate, channels):
+    """入力レベルの計算を用意する（numpyがなければNone）"""
+    try:
+        return LevelMeter(rate, channels)
+    except RuntimeError as e:
+        worker_logger.warning(f"入力レベルを計算できません: {e}")
+        return None
+
+def segment_seconds(config, preset, rate=RATE, channels=CHANNELS):
+    """ffmpegのsegmentマルチプレクサに渡す1セグメントの長さ（秒）
+
+    segmentマルチプレクサはサイズで区切れないため、segment_mbはプリセットのビットレートから時間に換算する。
+    """
+    limits = []
+    if config['segment_minutes']:
+        limits.append(config['segment_minutes'] * 60)
+    if config['segment_mb']:
+        limits.append(config['segment_mb'] * 1024 * 1024 / bytes_per_second(preset, rate, channels))
+    return max(1, int(min(limits)))
+
+def arm_preroll(device, prewarm=None, rebuilt=False):
+    """指定デバイスの待機録音（プリロール）を開始する
+
+    prewarm（秒）は予約録音の準備で、プリロールが無効でもPulseAudioのソースを開いておき、
+    録音開始時にすぐ書き込めるようにする。その秒数のうちに録音が始まらなければ閉じる。
+    rebuilt はソースの仕様に合わせて作り直した場合で、ステータスの armed に載せる。
+    """
+    global preroll_capture, preroll_device_mac, preroll_is_dual, preroll_source_spec, prewarm_until
+    config = load_recording_config()
+    seconds = config['preroll_seconds']
+    device_mac = device.get('mac') if isinstance(device, dict) else device
+
+    if prewarm and preroll_capture and preroll_device_mac == device_mac:
+        if not preroll_capture.seconds:
+            prewarm_until = time.time() + prewarm
+        return True, 'ソースは準備済みです'
+    if (preroll_capture and preroll_device_mac == device_mac and preroll_capture.seconds == seconds
+            and preroll_matches(config)):
+        return True, '待機録音中です'
+    if preroll_in_use():
+        return False, '録音中は待機録音を変更できません'
+    disarm_preroll()
+    if not (seconds or prewarm) or not device_mac:
+        return False, 'プリロールは無効です'
+
+    # ソースが既にあればそのサンプル仕様で開く（まだなければ RATE, CHANNELS で開き、
+    # ソースが現れて仕様が違えば preroll_resolver が作り直させる）
+    preroll_is_dual = config['capture_tracks'] == 'dual'
+    if not preroll_is_dual:
+        source_name = find_pulse_audio_device(device_mac, log_missing=False)
+        rate, channels = native_sample_spec(source_name)
+        source_factory = capture_source_factory(config)
+    else:
+        # 2トラック録音はソースとモニターの両方が揃ってから開く
+        dual_names = find_dual_track_devices(device_mac)
+        source_name = dual_names[0] if dual_names else None
+        rate, channels = native_sample_spec(source_name, dual=True)
+        source_factory = dual_source_factory(capture_source_factory(config))
+    preroll_capture = CapturePipeline(
+        preroll_resolver(device_mac, preroll_is_dual, rate, channels), rate, channels,
+        preroll_seconds=seconds, source_factory=source_factory)
+    preroll_device_mac = device_mac
+    preroll_source_spec = pulse_source_specs.get(source_name)
+    preroll_capture.start()
+    update_status({'armed': {'device': device_mac, 'seconds': seconds, 'sample_rate': rate,
+                             'channels': channels, 'rebuilt': rebuilt}})
+    if not seconds:
+        prewarm_until = time.time() + prewarm
+        worker_logger.info(f"予約録音に備えてソースを開きます: {device_mac}")
+        return True, 'ソースを準備しました'
+    worker_logger.info(f"待機録音を開始: {device_mac} ({seconds}秒)")
+    return True, f'{seconds}秒のプリロールで待機録音を開始しました'
+
+def preroll_resolver(device_mac, dual, rate, channels):
+    """待機録音の resolve_source
+
+    現れたソースの仕様が待機録音を開いた仕様と違えば、そのまま開かずに
+    メインループで作り直させる（ソースがないまま既定値で開いた場合など）。
+    録音中はソースを開き直すだけにする（PulseAudioが変換する）。
+    """
+    def resolve():
+        global preroll_source_spec, preroll_rearm_pending
+        found = (find_dual_track_devices(device_mac) if dual
+                 else find_pulse_audio_device(device_mac, log_missing=False))
+        if not found:
+            return None
+        source_name = found[0] if dual else found
+        native = native_sample_spec(source_name, dual=dual)
+        if native != (rate, channels) and not preroll_in_use():
+            if not preroll_rearm_pending:
+                worker_logger.info(f"ソースのサンプル仕様に合わせて待機録音を作り直します: {source_name} "
+                                   f"({rate}Hz {channels}ch → {native[0]}Hz {native[1]}ch)")
+            preroll_rearm_pending = True
+            return None
+        preroll_source_spec = pulse_source_specs.get(source_name)
+        return found
+    return resolve
+
+def rearm_preroll():
+    """preroll_resolver が求めた場合に、ソースの仕様で待機録音を開き直す"""
+    global preroll_rearm_pending
+    if not preroll_rearm_pending:
         return
+    preroll_rearm_pending = False
+    if not preroll_capture or preroll_in_use():
+        return
+    device_mac = preroll_device_mac
+    prewarm = prewarm_until - time.time() if prewarm_until else None
+    disarm_preroll()
+    if prewarm is not None and prewarm <= 0:
+        return
+    arm_preroll(device_mac, prewarm=prewarm, rebuilt=True)
+
+def preroll_matches(config):
+    """待機録音のパイプラインが設定のキャプチャ方式・トラック構成で開かれているか"""
+    factory = preroll_capture.source_factory
+    return (getattr(factory, 'source_factory', factory) is capture_source_factory(config)
+            and preroll_is_dual == (config['capture_tracks'] == 'dual'))
 
+def preroll_in_use():
+    """待機録音のソースを録音中のセッションが使っているか"""
+    return bool(preroll_capture and session_manager.find(preroll_device_mac))
+
+def disarm_preroll():
+    """待機録音を停止する"""
+    global preroll_capture, preroll_device_mac, prewarm_until
+    if preroll_capture:
+        preroll_capture.stop()
+        worker_logger.info("待機録音を停止しました")
+    preroll_capture = None
+    preroll_device_mac = None
+    prewarm_until = None
+    update_status({'armed': None})
+
+def publish_metrics():
+    """メトリクスを共有メモリに書き出す（Webサーバーが /metrics で返す）"""
     try:
-        with open(COMMAND_FILE, 'r') as f:
-            command_data = json.load(f)
-        
-        # 読み込んだらすぐにファイルを削除
-        os.remove(COMMAND_FILE)
-        
-        action = command_data.get('action')
-        worker_logger.info(f"コマンドを受信: {action}")
+        recorder_metrics.sample_children(psutil)
+        metrics_segment.publish(recorder_metrics.REGISTRY.snapshot())
+    except Exception as e:
+        worker_logger.error(f"メトリクスの公開に失敗: {e}")
 
-        if action == 'start':
-            if status['recording']:
-                worker_logger.warning("すでに録音中のため、新しい録音は開始しません。")
-                return
-            
-            device = command_data.get('device')
-            if not device:
-                update_status({'status': 'error', 'error_message': 'デバイスが指定されていません。'})
-                return
-            
-            # デバイス情報を保存
-            device_info = {
-                'name': device.get('name', 'Unknown Device'),
-                'mac': device.get('mac') if isinstance(device, dict) else device,
-                'type': 'Bluetooth Audio Source',
-                'adapter': device.get('adapter', 'unknown')
-            }
-            
-            # グローバル変数に保存
-            status['device'] = device_info
-            
-            device_mac = device.get('mac') if isinstance(device, dict) else device
-            
+def expire_prewarm():
+    """予約録音の準備で開いたソースが使われないまま期限を過ぎたら閉じる"""
+    if prewarm_until and time.time() > prewarm_until and not preroll_in_use():
+        worker_logger.info("予約録音が始まらなかったため、準備したソースを閉じます")
+        disarm_preroll()
+
+def handle_command(command_data):
+    """コマンドバスから受け取ったコマンドを実行し、(成否, メッセージ)を返す"""
+    global main_loop_running
+
+    action = command_data.get('action')
+    worker_logger.info(f"コマンドを受信: {action} (seq={command_data.get('seq')})")
+
+    if action == 'start':
+        device = command_data.get('device')
+        if not device:
+            update_status({'error_message': 'デバイスが指定されていません。'})
+            return False, 'デバイスが指定されていません'
+
+        # デバイス情報を保存（MACアドレスだけが届いた場合も受け付ける）
+        if not isinstance(device, dict):
+            device = {'mac': device}
+        device_info = {
+            'name': device.get('name') or 'Unknown Device',
+            'mac': device.get('mac'),
+            'type': 'Bluetooth Audio Source',
+            'adapter': device.get('adapter', 'unknown')
+        }
+        if not isinstance(device_info['mac'], str) or not device_info['mac']:
+            update_status({'error_message': 'デバイスのMACアドレスが指定されていません。'})
+            return False, 'デバイスのMACアドレスが指定されていません'
+
+        # エンコードのプリセット（指定がなければ設定の encoder_preset）
+        preset_name = command_data.get('preset')
+        if preset_name and not get_preset(preset_name):
+            return False, f'不明なエンコードのプリセットです: {preset_name}'
+
+        # デバイスごとのセッションを作る（同じデバイスで録音中・上限に達していれば開始しない）。
+        # セッションはロックの中で starting として登録されるため、録音スレッドがソースを待っている間の
+        # 停止コマンドも、続けて届いた同じデバイスの開始コマンドも、このセッションに対して処理される
+        session_manager.max_sessions = load_recording_config()['max_sessions']
+        concurrent = len(session_manager) > 0
+        try:
+            session = session_manager.create(device_info, command_data.get('session'))
+        except SessionError as e:
+            worker_logger.warning(f"録音を開始しません: {e}")
+            return False, str(e)
+
+        # 録音スレッドを起動するまでに失敗したら、セッションを残さない（残すと以後の開始が拒否される）
+        try:
             filename_base = f"recording_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
-            
-            stop_recording_flag.clear()
-            thread = threading.Thread(target=record_audio_thread, args=(device_mac, filename_base))
-            thread.daemon = True
-            thread.start()
-
-        elif action == 'stop':
-            if status['recording']:
-                stop_recording_flag.set()
-            else:
-                worker_logger.warning("録音中ではないため、停止コマンドは無視します。")
+            if concurrent:
+                # 同時に録音中のセッションとファイル名が重ならないよう、デバイスのMACアドレスの末尾を付ける
+                filename_base += f"_bt{device_info['mac'].replace(':', '')[-4:]}"
+
+            # 録音時間（分）。指定がなければ手動で停止するまで録音する
+            try:
+                duration_seconds = float(command_data.get('duration') or 0) * 60
+            except (TypeError, ValueError):
+                duration_seconds = 0
 
-        elif action == 'shutdown' or action == 'exit':
-            if status['recording']:
-                stop_recording_flag.set()
-                time.sleep(2)  # 録音スレッドの終了を待つ
-            main_loop_running = False
-            worker_logger.info("終了コマンドを受信しました。")
+            resumed_from = command_data.get('resumed_from')
+            if resumed_from:
+                worker_logger.warning(f"中断された録音を新しいファイルで再開します: {resumed_from}")
 
-    except Exception as e:
-        worker_logger.error(f"コマンド処理エラー: {e}")
-        if os.path.exists(COMMAND_FILE):
-            os.remove(COMMAND_FILE)
+            session.thread = threading.Thread(target=record_audio_thread,
+                                              args=(session, filename_base, duration_seconds or None, resumed_from,
+                                                    preset_name))
+            session.thread.daemon = True
+            session.thread.start()
+        except Exception as e:
+            session_manager.remove(session)
+            worker_logger.error(f"録音を開始できませんでした: {e}")
+            return False, f'録音を開始できませんでした: {e}'
+        update_status()
+        worker_logger.info(f"セッション {session.id} を開始: {device_info['name']} ({len(session_manager)}台録音中)")
+        return True, '録音を開始しました'
+
+    elif action == 'stop':
+        # セッションIDかデバイスを指定すればその録音だけ、指定がなければすべて停止する
+        # （開始中でまだ recording になっていないセッションも停止する）
+        if command_data.get('session'):
+            session = session_manager.get(command_data['session'])
+            sessions = [session] if session else []
+        elif command_data.get('device'):
+            device = command_data['device']
+            session = session_manager.find(device.get('mac') if isinstance(device, dict) else device)
+            sessions = [session] if session else []
+        else:
+            sessions = session_manager.sessions()
+        if not sessions:
+            worker_logger.warning("録音中ではないため、停止コマンドは無視します。")
+            return False, '録音中ではありません'
+        for session in sessions:
+            session.stop()
+        return True, '録音を停止しました'
+
+    elif action == 'shutdown' or action == 'exit':
+        sessions = session_manager.sessions()
+        for session in sessions:
+            session.stop()
+        # 録音スレッドがファイルを確定させるのを待つ
+        deadline = time.monotonic() + SHUTDOWN_WAIT_TIMEOUT
+        for session in sessions:
+            if session.thread:
+                session.thread.join(max(0, deadline - time.monotonic()))
+        main_loop_running = False
+        worker_logger.info("終了コマンドを受信しました。")
+        return True, 'ワーカーを終了します'
+
+    elif action == 'arm':
+        return arm_preroll(command_data.get('device'), prewarm=command_data.get('prewarm'))
+
+    elif action == 'disarm':
+        if preroll_in_use():
+            return False, '録音中は待機録音を停止できません'
+        disarm_preroll()
+        return True, '待機録音を停止しました'
+
+    elif action == 'ping':
+        return True, 'pong'
+
+    return False, f'不明なコマンドです: {action}'
 
 def cleanup():
     """終了処理"""
+    if preroll_capture:
+        preroll_capture.stop()
+    if job_queue:
+        job_queue.stop()
     update_status({'recording': False, 'status': 'offline'})
-    if os.path.exists(COMMAND_FILE):
-        os.remove(COMMAND_FILE)
+    command_server.close()
     worker_logger.info("ワーカープロセスをクリーンアップしました。")
 
 if __name__ == '__main__':
     if not os.path.exists(RECORDINGS_DIR):
         os.makedirs(RECORDINGS_DIR)
 
+    command_server = CommandServer(handle_command)
+    job_queue = JobQueue(JOBS_FILE, RECORDINGS_DIR, on_done=catalog_processed_file)
+    status_segment = StatusSegment().create()
+    metrics_segment = StatusSegment(METRICS_SEGMENT, METRICS_SEGMENT_SIZE).create()
+
     try:
         # 起動時にステータスを初期化
-        worker_logger.info(f"初期ステータスファイル書き込み試行: {STATUS_FILE}")
+        worker_logger.info(f"ステータス領域を初期化: {status_segment.path}")
         update_status({'recording': False, 'status': 'idle'})
-        worker_logger.info("初期ステータスファイル書き込み成功。")
+
+        command_server.start()
+        # コマンドを受け付けられるようになったことをWebサーバーに知らせる
+        notify_ready()
+
+        # 前回のセッションで中断された分割録音を、コマンドの受付と並行して確定させる
+        threading.Thread(target=recover_recordings, args=(time.time(),), daemon=True).start()
+        # 後処理ジョブの実行を開始（再起動前に残っていたジョブも続きから処理する）
+        job_queue.start(load_recording_config()['postprocess_workers'])
 
         worker_logger.info("コマンド待機ループを開始します...")
+        last_metrics_publish = 0
         while main_loop_running:
-            check_command()
+            # コマンドが届けば即座に処理し、なければ0.5秒でタイムアウトする
+            command_server.dispatch(timeout=0.5)
             # Webサーバーに生存を知らせるため、ステータスを定期的に更新する
             update_status()
-            time.sleep(0.5)
+            expire_prewarm()
+            rearm_preroll()
+            if time.monotonic() - last_metrics_publish >= METRICS_PUBLISH_INTERVAL:
+                publish_metrics()
+                last_metrics_publish = time.monotonic()
             
     except KeyboardInterrupt:
         worker_logger.info("キーボード割り込みにより終了します。")
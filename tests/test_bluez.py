@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+DeviceInventory のテスト
+python-dbusmock の bluez5 テンプレートでBlueZを模したシステムバスを起動し、
+InterfacesAdded / PropertiesChanged シグナルでキャッシュが更新されることを確かめる。
+dbus-python・PyGObject・python-dbusmock がなければスキップする。
+
+使い方: python3 -m unittest discover tests
+"""
+
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+try:
+    import dbus
+    import dbus.mainloop.glib
+    import dbusmock
+except ImportError:
+    dbusmock = None
+
+from recorder_bluez import DEVICE_INTERFACE, DeviceInventory
+
+DEVICE_MAC = '11:22:33:44:55:66'
+# シグナルがメインループのスレッドで処理されるまで待つ時間（秒）
+SIGNAL_TIMEOUT = 5
+
+
+def wait_until(predicate, timeout=SIGNAL_TIMEOUT):
+    """predicate() が真になるまで待ち、最後の結果を返す"""
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return predicate()
+
+
+@unittest.skipIf(dbusmock is None, "dbus-python・PyGObject・python-dbusmock が必要です")
+class DeviceInventoryTest(dbusmock.DBusTestCase if dbusmock else unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        cls.start_system_bus()
+        cls.bus = cls.get_dbus(system_bus=True)
+
+    def setUp(self):
+        self.server, self.server_obj = self.spawn_server_template('bluez5', {}, stdout=subprocess.PIPE)
+        self.bluez = dbus.Interface(self.server_obj, 'org.bluez.Mock')
+        self.bluez.AddAdapter('hci0', 'recorder')
+        self.inventory = DeviceInventory(bus=self.bus)
+        self.assertTrue(self.inventory.start())
+        self.notified = []
+        self.notified_lock = threading.Lock()
+
+    def tearDown(self):
+        self.inventory.stop()
+        self.server.terminate()
+        self.server.wait()
+
+    def listener(self, mac, connected):
+        with self.notified_lock:
+            self.notified.append((mac, connected))
+
+    def add_paired_device(self):
+        """デバイスを追加してペアリングし、オブジェクトパスを返す"""
+        path = self.bluez.AddDevice('hci0', DEVICE_MAC, 'My Phone')
+        self.bluez.PairDevice('hci0', DEVICE_MAC)
+        return path
+
+    def set_connected(self, path, connected):
+        """デバイスの Connected を変え、PropertiesChanged を送らせる"""
+        device = dbus.Interface(self.bus.get_object('org.bluez', path), dbusmock.MOCK_IFACE)
+        device.UpdateProperties(DEVICE_INTERFACE, {'Connected': dbus.Boolean(connected)})
+
+    def test_interfaces_added_updates_cache(self):
+        self.assertEqual(self.inventory.devices(), [])
+        path = self.add_paired_device()
+
+        self.assertTrue(wait_until(lambda: self.inventory.find_device(DEVICE_MAC)[0] == path))
+        self.assertTrue(wait_until(lambda: self.inventory.devices()))
+        device = self.inventory.devices()[0]
+        self.assertEqual(device['mac'], DEVICE_MAC)
+        self.assertEqual(device['adapter_name'], 'hci0')
+        self.assertFalse(device['connected'])
+
+    def test_properties_changed_updates_cache_and_notifies(self):
+        path = self.add_paired_device()
+        self.assertTrue(wait_until(lambda: self.inventory.devices()))
+        self.inventory.listeners.append(self.listener)
+
+        self.set_connected(path, True)
+
+        self.assertTrue(wait_until(lambda: self.inventory.devices()[0]['connected']))
+        self.assertTrue(wait_until(lambda: self.notified))
+        self.assertEqual(self.notified, [(DEVICE_MAC, True)])
+
+    def test_listeners_survive_restart(self):
+        path = self.add_paired_device()
+        self.assertTrue(wait_until(lambda: self.inventory.devices()))
+        self.inventory.listeners.append(self.listener)
+
+        self.inventory.stop()
+        self.assertTrue(self.inventory.start())
+        self.set_connected(path, True)
+
+        self.assertTrue(wait_until(lambda: self.notified))
+        # 再度start()してもシグナルは1回だけ受ける
+        time.sleep(0.5)
+        self.assertEqual(self.notified, [(DEVICE_MAC, True)])
+
+
+if __name__ == '__main__':
+    unittest.main()